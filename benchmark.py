@@ -0,0 +1,262 @@
+# benchmark.py
+"""
+Throughput benchmarks for garbling, evaluation, OT and serialization, printed as JSON so runs on
+different commits can be compared:
+
+    python benchmark.py --sizes 1000 10000 100000 --output results.json
+
+Every circuit is benchmarked in-process (no sockets): garbling (gates/sec), evaluation with
+receiver._solve_circuit (gates/sec and garbled rows/sec), the size of the serialized circuit (bytes
+per gate) and the peak memory of garbling and evaluating it; halfgates circuits are measured again
+garbled and evaluated a level at a time (`layered`), as a GarbledTable, and in parallel with each number of `--workers` above 1, using one process pool
+per number. OT is timed separately, as latency per transferred input bit for the public-key OT and
+for the IKNP extension.
+"""
+import argparse
+from bristol import load_bristol
+from circuit import EvaluationPlan
+from concurrent.futures import ProcessPoolExecutor
+from garbled_table import GarbledTable
+import circuit_library
+import json
+from oblivious_transfer.ot import Alice, Bob
+from ot_extension import OTExtensionReceiver, OTExtensionSender
+import platform
+import receiver
+import secrets
+import sender
+import time
+import tracemalloc
+import wire_format
+
+# Gates of circuit_library.adder per input bit, used to size the generated circuits
+ADDER_GATES_PER_BIT = 6
+
+
+def _best_time(function, repeat):
+    """
+    Returns:
+        the result of the last call, and the shortest wall time of `repeat` calls in seconds
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def _peak_memory(function):
+    """
+    Returns:
+        the peak memory allocated while running `function`, in bytes
+    """
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _choose_labels(garbled_circuit):
+    # Any label works for timing; keep the 0-label of every input wire
+    for entry in garbled_circuit.values():
+        if "inputs" not in entry:
+            entry["value"] = entry["value"][0]
+    return garbled_circuit
+
+
+def benchmark_circuit(name, circuit, scheme="halfgates", repeat=3, workers=1, executor=None):
+    """
+    Args:
+        name: label of the circuit in the results
+        circuit: Circuit to benchmark
+        scheme: garbling scheme passed to Circuit.garble
+        repeat: number of runs; the fastest is reported
+        workers: number of processes of `executor` garbling and evaluating each level in parallel
+                 (halfgates only); 1 runs everything in this process
+        executor: ProcessPoolExecutor with `workers` processes, reused for every run so its start-up
+                  is not measured
+
+    Returns:
+        dictionary of results
+    """
+    stats = circuit.stats()
+    gates = stats["gates"]
+    parallel = {"workers": workers, "executor": executor} if workers > 1 else dict()
+
+    def garble():
+        return circuit.garble(scheme, **parallel)
+
+    def evaluate():
+        return receiver._solve_circuit(plan, garbled_circuit, executor, workers) if parallel else \
+            receiver._solve_circuit(plan, garbled_circuit)
+
+    garbled_circuit, garble_time = _best_time(garble, repeat)
+    rows = sum(len(entry["rows"]) for entry in garbled_circuit.values() if "inputs" in entry)
+    serialized = wire_format.dump_circuit(garbled_circuit, scheme)
+
+    garbled_circuit = _choose_labels(garbled_circuit)
+    plan = EvaluationPlan.from_garbled(garbled_circuit)
+    _, evaluate_time = _best_time(evaluate, repeat)
+
+    results = {
+        "benchmark": "circuit",
+        "circuit": name,
+        "scheme": scheme,
+        "workers": workers,
+        "gates": gates,
+        "non_free": stats["non_free"],
+        "depth": stats["depth"],
+        "rows": rows,
+        "garble_seconds": garble_time,
+        "garble_gates_per_sec": gates / garble_time,
+        "evaluate_seconds": evaluate_time,
+        "evaluate_gates_per_sec": gates / evaluate_time,
+        "evaluate_rows_per_sec": rows / evaluate_time if rows else None,
+        "serialized_bytes": len(serialized),
+        "bytes_per_gate": len(serialized) / gates,
+        # Only this process is traced, not the workers
+        "garble_peak_bytes": _peak_memory(garble),
+        "evaluate_peak_bytes": _peak_memory(evaluate),
+    }
+    if scheme == "halfgates" and not parallel:
+        # Same circuit a level at a time, to compare with the gate-by-gate times above
+        layered_circuit, layered_garble_time = _best_time(lambda: circuit.garble(scheme, layered=True), repeat)
+        layered_circuit = _choose_labels(layered_circuit)
+        _, layered_evaluate_time = _best_time(
+            lambda: receiver._solve_circuit(plan, layered_circuit, layered=True), repeat)
+        results.update({
+            "layered_garble_seconds": layered_garble_time,
+            "layered_evaluate_seconds": layered_evaluate_time,
+            "layered_garble_speedup": garble_time / layered_garble_time,
+            "layered_evaluate_speedup": evaluate_time / layered_evaluate_time,
+        })
+        # Same circuit in the array-backed layout
+        table, table_garble_time = _best_time(lambda: GarbledTable.garble(circuit), repeat)
+        labels = {wire: table.label_pair(wire)[0] for wire in table.input_wires}
+        _, table_evaluate_time = _best_time(lambda: table.evaluate(labels), repeat)
+        results.update({
+            "table_garble_seconds": table_garble_time,
+            "table_evaluate_seconds": table_evaluate_time,
+            "table_bytes": len(table.dumps()),
+            "table_garble_peak_bytes": _peak_memory(lambda: GarbledTable.garble(circuit)),
+            "table_evaluate_peak_bytes": _peak_memory(lambda: table.evaluate(labels)),
+        })
+    return results
+
+
+def _base_ot(pairs, choices):
+    alice = Alice([label for pair in pairs for label in pair], len(pairs))
+    bob = Bob([2 * i + bit for i, bit in enumerate(choices)])
+    data = alice.setup()
+    f = bob.setup(data["pubkey"]["e"], data["pubkey"]["n"], data["hashes"], data["secret_length"])
+    return bob.receive(alice.transmit(f))
+
+
+def _extension_ot(pairs, choices):
+    ot_receiver, ot_sender = OTExtensionReceiver(), OTExtensionSender()
+    f = ot_sender.setup(ot_receiver.setup())
+    ot_sender.receive(ot_receiver.transmit(f))
+    return ot_receiver.receive(ot_sender.extend(ot_receiver.extend(choices), pairs))
+
+
+def benchmark_ot(bits, repeat=3, label_len=16):
+    """
+    Times transferring `bits` labels of `label_len` bytes, including every setup step.
+
+    Returns:
+        list of dictionaries of results, one per OT protocol
+    """
+    pairs = [(secrets.token_bytes(label_len), secrets.token_bytes(label_len)) for _ in range(bits)]
+    choices = [secrets.randbits(1) for _ in range(bits)]
+    results = []
+    for protocol, function in (("base", _base_ot), ("extension", _extension_ot)):
+        keys, seconds = _best_time(lambda: function(pairs, choices), repeat)
+        assert keys == [pair[c] for pair, c in zip(pairs, choices)], f"{protocol} OT returned wrong labels"
+        results.append({
+            "benchmark": "ot",
+            "protocol": protocol,
+            "bits": bits,
+            "seconds": seconds,
+            "seconds_per_bit": seconds / bits,
+        })
+    return results
+
+
+def circuits(sizes):
+    """
+    Returns:
+        list of (name, Circuit): the 2-bit comparator, then for each number of gates in `sizes` a
+        ripple-carry adder of about that many gates, one level per AND, and the parallel-prefix
+        adder of the same width, whose levels are wide
+    """
+    result = [("comparator", sender.comparator())]
+    for size in sizes:
+        bits = max(1, size // ADDER_GATES_PER_BIT)
+        result.append((f"adder{bits}", circuit_library.adder(bits)))
+        result.append((f"adder{bits}_low_depth", circuit_library.adder(bits, low_depth=True)))
+    return result
+
+
+def run(sizes=(1000, 10000, 100000), schemes=("classic", "halfgates"), classic_max_gates=2000,
+        ot_bits=(2, 128, 1024), repeat=3, bristol=(), workers=(1, 4)):
+    """
+    Runs every benchmark.
+
+    Args:
+        sizes: approximate gate counts of the generated circuits
+        schemes: garbling schemes to benchmark
+        classic_max_gates: largest circuit garbled with the classic scheme, which is much slower
+        ot_bits: numbers of input bits to transfer with OT
+        repeat: number of runs of each measurement; the fastest is reported
+        bristol: paths of Bristol Fashion netlists to benchmark as well
+        workers: numbers of processes to garble and evaluate halfgates circuits with; 1 is serial
+
+    Returns:
+        dictionary with the environment and a list of results
+    """
+    results = []
+    named_circuits = circuits(sizes) + [(path, load_bristol(path)) for path in bristol]
+    for name, circuit in named_circuits:
+        for scheme in schemes:
+            if scheme != "classic" or len(circuit) <= classic_max_gates:
+                results.append(benchmark_circuit(name, circuit, scheme, repeat))
+    if "halfgates" in schemes:
+        for count in sorted(set(workers) - {1}):
+            with ProcessPoolExecutor(max_workers=count) as executor:
+                for name, circuit in named_circuits:
+                    results.append(benchmark_circuit(name, circuit, "halfgates", repeat, count, executor))
+    for bits in ot_bits:
+        results += benchmark_ot(bits, repeat)
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="*", default=[1000, 10000, 100000],
+                        help="approximate gate counts of the generated circuits")
+    parser.add_argument("--schemes", nargs="+", default=["classic", "halfgates"])
+    parser.add_argument("--classic-max-gates", type=int, default=2000)
+    parser.add_argument("--ot-bits", type=int, nargs="*", default=[2, 128, 1024])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--bristol", nargs="*", default=[], help="Bristol Fashion netlists to benchmark")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4],
+                        help="numbers of processes for parallel halfgates garbling and evaluation")
+    parser.add_argument("--output", help="file to write the JSON results to (default: stdout)")
+    args = parser.parse_args()
+
+    report = run(args.sizes, args.schemes, args.classic_max_gates, args.ot_bits, args.repeat, args.bristol,
+                 args.workers)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
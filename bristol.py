@@ -0,0 +1,85 @@
+# bristol.py
+from array import array
+from circuit import Circuit, GATE_CODES
+import optimizer
+
+# Bristol Fashion gate names and the gate types they map to
+BRISTOL_GATES = {
+    "AND": "AND",
+    "XOR": "XOR",
+    "INV": "NOT",
+    "EQW": "BUF",
+}
+
+
+def load_bristol(path, optimize=False):
+    """
+    Loads a circuit in Bristol Fashion (e.g. adder64.txt, aes_128.txt, sha256.txt from
+    https://homes.esat.kuleuven.be/~nsmart/MPC/).
+
+    Args:
+        path: path of the netlist file
+        optimize: run the netlist through optimizer.optimize
+
+    Returns:
+        Circuit
+    """
+    with open(path) as f:
+        return parse_bristol(f, optimize)
+
+
+def parse_bristol(lines, optimize=False):
+    """
+    Parses a Bristol Fashion netlist into a Circuit. Gates are stored straight into the circuit's
+    parallel arrays, so no Gate object is created per gate.
+
+    The header gives the gate and wire counts, then the number of input values followed by the
+    bit width of each, then the same for the output values. Input values occupy the first wires in
+    order and output values the last wires. Every following line is one gate:
+        2 1 <in1> <in2> <out> XOR|AND
+        1 1 <in> <out> INV|EQW
+        2k k <in1_1..in1_k> <in2_1..in2_k> <out_1..out_k> MAND
+
+    Args:
+        lines: iterable of the lines of the netlist (e.g. an open file)
+        optimize: run the netlist through optimizer.optimize
+
+    Returns:
+        Circuit whose `inputs` has one group of wires per input value
+    """
+    lines = iter(lines)
+    header = [next(lines).split() for _ in range(3)]
+    num_gates, num_wires = int(header[0][0]), int(header[0][1])
+    input_sizes = [int(n) for n in header[1][1:1 + int(header[1][0])]]
+    output_sizes = [int(n) for n in header[2][1:1 + int(header[2][0])]]
+
+    types, input1, input2, output = array('B'), array('i'), array('i'), array('i')
+    for line in lines:
+        fields = line.split()
+        if not fields:
+            continue
+        num_in, num_out, name = int(fields[0]), int(fields[1]), fields[-1]
+        wires = fields[2:2 + num_in + num_out]
+        if name == "MAND":
+            # Multiple ANDs in one line: first all first inputs, then all second inputs, then outputs
+            for k in range(num_out):
+                types.append(GATE_CODES["AND"])
+                input1.append(int(wires[k]))
+                input2.append(int(wires[num_out + k]))
+                output.append(int(wires[num_in + k]))
+        elif name in BRISTOL_GATES:
+            types.append(GATE_CODES[BRISTOL_GATES[name]])
+            input1.append(int(wires[0]))
+            input2.append(int(wires[1]) if num_in == 2 else -1)
+            output.append(int(wires[num_in]))
+        else:
+            raise ValueError(f"Unsupported gate type: {name}")
+    assert len(types) >= num_gates, f"Expected {num_gates} gates, read {len(types)}"
+
+    inputs, start = [], 0
+    for size in input_sizes:
+        inputs.append(list(range(start, start + size)))
+        start += size
+    outputs = list(range(num_wires - sum(output_sizes), num_wires))
+    circuit = Circuit.from_arrays(types, input1, input2, output, outputs=outputs, inputs=inputs)
+    return optimizer.optimize(circuit) if optimize else circuit
@@ -1,8 +1,139 @@
 # circuit.py
-from common import SUFFIX_LEN
+from common import SUFFIX_LEN, process_pool, split_chunks
+from array import array
 from cryptography.fernet import Fernet
-import random
-from queue import PriorityQueue
+import halfgates
+import heapq
+import logging
+import os
+import secrets
+
+logger = logging.getLogger(__name__)
+
+# Gate types are stored as their index in this tuple when a circuit is kept in arrays
+GATE_TYPES = ("AND", "OR", "XOR", "XNOR", "NOT", "BUF")
+GATE_CODES = {gate_type: code for code, gate_type in enumerate(GATE_TYPES)}
+# Smallest number of gates worth shipping to a worker process in parallel mode
+PARALLEL_MIN_GATES = 256
+
+
+def new_label_pair():
+    """
+    Creates the two labels of a wire for the classic scheme. A label is a Fernet key followed by one
+    permute byte; the two labels of a wire always have opposite permute bits, so the bit reveals
+    nothing about the value but tells the evaluator which row of the next gate to decrypt.
+
+    Returns:
+        (zero, one) labels
+    """
+    p = secrets.randbits(1)
+    return Fernet.generate_key() + bytes([p]), Fernet.generate_key() + bytes([p ^ 1])
+
+
+def topological_order(outputs, inputs_of):
+    """
+    Iterative depth-first search, so arbitrarily deep circuits do not hit the recursion limit.
+
+    Args:
+        outputs: labels of the wires whose values are needed
+        inputs_of: function returning the input labels of the gate with the given output label,
+                   or None if the label is not the output of a gate
+
+    Returns:
+        list of gate labels ordered so that every gate comes after the gates feeding its inputs;
+        gates that do not lead to any of the outputs are left out
+    """
+    order = []
+    visited = set()
+    stack = [(label, False) for label in reversed(outputs)]
+    while stack:
+        label, expanded = stack.pop()
+        if expanded:
+            order.append(label)
+            continue
+        if label in visited or (inputs := inputs_of(label)) is None:
+            continue
+        visited.add(label)
+        stack.append((label, True))
+        for i in reversed(inputs):
+            if i is not None:
+                stack.append((i, False))
+    return order
+
+
+class EvaluationPlan:
+    def __init__(self, gates, input1, input2, outputs):
+        """
+        Flat arrays that can be evaluated in a single loop. Position i of `gates`, `input1` and
+        `input2` describes the i-th gate in topological order; a missing second input (NOT gate)
+        is stored as -1. Use `from_circuit` or `from_garbled` to compile one.
+
+        Args:
+            gates: output labels of the gates, in topological order
+            input1: label of the first input wire of each gate
+            input2: label of the second input wire of each gate
+            outputs: labels of the circuit's output wires
+        """
+        self.outputs = list(outputs)
+        self.gates = array('q', gates)
+        self.input1 = array('q', input1)
+        self.input2 = array('q', input2)
+        self.num_wires = 1 + max(max(self.gates, default=-1), max(self.input1, default=-1),
+                                 max(self.input2, default=-1))
+
+    @classmethod
+    def from_circuit(cls, circuit):
+        order = circuit.topological_order()
+        index = [circuit.gate_index(label) for label in order]
+        return cls(order, (circuit.input1[i] for i in index), (circuit.input2[i] for i in index),
+                   circuit.output_wires)
+
+    @classmethod
+    def from_garbled(cls, garbled_circuit):
+        """
+        Builds the plan for a garbled circuit (more info in Circuit.garble). The outputs are the
+        gates listed in the `positions` of the output gates, in the circuit's order.
+        """
+        gate_inputs = {label: entry["inputs"] for label, entry in garbled_circuit.items() if "inputs" in entry}
+        positions = sorted((position, label) for label, entry in garbled_circuit.items()
+                           for position in entry.get("positions", ()))
+        if not positions or [position for position, _ in positions] != list(range(len(positions))) or \
+                not all(label in gate_inputs for _, label in positions):
+            raise ValueError("The garbled circuit does not list its output gates")
+        outputs = [label for _, label in positions]
+        order = topological_order(outputs, gate_inputs.get)
+        return cls(order, (gate_inputs[label][0] for label in order),
+                   (-1 if (i := gate_inputs[label][1]) is None else i for label in order), outputs)
+
+    def levels(self):
+        """
+        Groups the plan by depth (see Circuit.levels); gates in the same level never depend on each other.
+
+        Returns:
+            list of levels, each a list of positions in the plan's arrays
+        """
+        depth = array('i', [0]) * self.num_wires
+        levels = []
+        for i, (gate, input1, input2) in enumerate(zip(self.gates, self.input1, self.input2)):
+            d = depth[input1]
+            if input2 >= 0 and depth[input2] > d:
+                d = depth[input2]
+            depth[gate] = d + 1
+            if d == len(levels):
+                levels.append([])
+            levels[d].append(i)
+        return levels
+
+    def __len__(self):
+        return len(self.gates)
+
+
+def label_key(label: bytes):
+    return label[:-1]
+
+
+def permute_bit(label: bytes):
+    return label[-1]
 
 
 class Gate:
@@ -26,6 +157,8 @@ class Gate:
             return [(0, 0, 0), (0, 1, 1), (1, 0, 1), (1, 1, 0)]
         elif self.type == "NOT":
             return [(0, None, 1), (1, None, 0)]
+        elif self.type == "BUF":
+            return [(0, None, 0), (1, None, 1)]
         else:
             raise ValueError(f"Unsupported gate type: {self.type}")
 
@@ -52,58 +185,321 @@ class Gate:
             enc_one_b: input key for 1 for the second wire
             encrypted_rows: A list of encrypted gate outputs for all possible combinations of input keys.
         """
-        print(f"Encrypting truth table: {self.get_truth_table()}")
+        debug = logger.isEnabledFor(logging.DEBUG)
+        truth_table = self.get_truth_table()
         # Initialize some variables; a is the first wire, b is the second wire
-        enc_zero_a = Fernet.generate_key() if enc_zero_a is None else enc_zero_a
-        enc_one_a = Fernet.generate_key() if enc_one_a is None else enc_one_a
-        enc_zero_b = Fernet.generate_key() if enc_zero_b is None else enc_zero_b
-        enc_one_b = Fernet.generate_key() if enc_one_b is None else enc_one_b
-        print(f"Encrypted keys:")
-        print(f"\t0a = {enc_zero_a[-SUFFIX_LEN:]}\n\t1a = {enc_one_a[-SUFFIX_LEN:]}")
-        print(f"\t0b = {enc_zero_b[-SUFFIX_LEN:]}\n\t1b = {enc_one_b[-SUFFIX_LEN:]}")
-        encrypted_rows = []  # holds each encrypted row of truth table
+        if enc_zero_a is None:
+            enc_zero_a, enc_one_a = new_label_pair()
+        if enc_zero_b is None:
+            enc_zero_b, enc_one_b = new_label_pair()
+        if debug:
+            logger.debug("Encrypting truth table: %s", truth_table)
+            logger.debug("Encrypted keys:\n\t0a = %s\n\t1a = %s\n\t0b = %s\n\t1b = %s",
+                         enc_zero_a[-SUFFIX_LEN:], enc_one_a[-SUFFIX_LEN:],
+                         enc_zero_b[-SUFFIX_LEN:], enc_one_b[-SUFFIX_LEN:])
+        encrypted_rows = [None] * len(truth_table)  # holds each encrypted row of truth table
         # Iterate over and encrypt each row in the truth table
-        for row in self.get_truth_table():
+        for row in truth_table:
             wa, wb, wc = row
             enc_a = enc_zero_a if wa == 0 else enc_one_a
             enc_b = enc_zero_b if wb == 0 else enc_one_b if wb is not None else b''
             enc_c = out_zero if wc == 0 else out_one
+            # Rows are stored by the permute bits of their input labels instead of by value,
+            # so the order reveals nothing and the evaluator can index straight to its row
             if wb is None:
-                enc_row = Fernet(enc_a).encrypt(enc_c)
+                index = permute_bit(enc_a)
+                enc_row = Fernet(label_key(enc_a)).encrypt(enc_c)
             else:
-                enc_row = Fernet(enc_a).encrypt(Fernet(enc_b).encrypt(enc_c))
-            encrypted_rows.append(enc_row)
-            print(f"Encrypting inputs wa={wa}, wb={wb}, wc={wc} | encrypted output row: {enc_row[-SUFFIX_LEN:]}")
-        # Shuffle the order of the encrypted rows, otherwise one can deduce the truth table by convention
-        random.shuffle(encrypted_rows)  # the shuffling occurs in-place
+                index = 2 * permute_bit(enc_a) + permute_bit(enc_b)
+                enc_row = Fernet(label_key(enc_a)).encrypt(Fernet(label_key(enc_b)).encrypt(enc_c))
+            encrypted_rows[index] = enc_row
+            if debug:
+                logger.debug("Encrypting inputs wa=%s, wb=%s, wc=%s | encrypted output row %d: %s",
+                             wa, wb, wc, index, enc_row[-SUFFIX_LEN:])
         return enc_zero_a, enc_one_a, enc_zero_b, enc_one_b, encrypted_rows
 
 
 class Circuit:
-    def __init__(self, gates: [Gate]):
+    def __init__(self, gates: [Gate], outputs=None, inputs=None):
         """
         Args:
             gates: list of Gate objects that comprise the circuit
+            outputs: labels of the output wires, in order; defaults to every gate whose output is
+                     not used as an input elsewhere, sorted by label
+            inputs: labels of the input wires grouped by input value (for example one list per
+                    party); defaults to a single group with every input wire
         """
-        self.gates = dict()  # store the gates by their output labels
-        output_wires = set()  # keep track of all wires used as outputs
-        input_wires = set()  # keep track of all wires used as inputs
-        self.input_combos = dict()  # keep track of all input combinations; used for starting wires
+        types, input1, input2, output = array('B'), array('i'), array('i'), array('i')
         for gate in gates:
-            input_wires.update(gate.get_input_wires())
-            output_wires.add(gate.output)
-            self.input_combos[frozenset(gate.get_input_wires(include_none=True))] = gate.output
-            self.gates[gate.output] = gate
+            if gate.type not in GATE_CODES:
+                raise ValueError(f"Unsupported gate type: {gate.type}")
+            types.append(GATE_CODES[gate.type])
+            input1.append(gate.input1)
+            input2.append(-1 if gate.input2 is None else gate.input2)
+            output.append(gate.output)
+        self._load_arrays(types, input1, input2, output, outputs, inputs)
+
+    @classmethod
+    def from_arrays(cls, types, input1, input2, output, outputs=None, inputs=None):
+        """
+        Builds a circuit straight from parallel arrays, without creating a Gate object per gate.
 
-        self.last_gate = output_wires.difference(input_wires)
-        assert len(self.last_gate) == 1, \
-            "More than one gate is an output of other gates but an input to none"
-        self.last_gate = self.last_gate.pop()
+        Args:
+            types: array('B') of gate type codes (the index of the type in GATE_TYPES)
+            input1: array('i') with the label of the first input wire of each gate
+            input2: array('i') with the label of the second input wire of each gate, -1 if none
+            output: array('i') with the label of the output wire of each gate
+            outputs: see __init__
+            inputs: see __init__
+        """
+        circuit = cls.__new__(cls)
+        circuit._load_arrays(types, input1, input2, output, outputs, inputs)
+        return circuit
+
+    def _load_arrays(self, types, input1, input2, output, outputs, inputs):
+        assert len(types) == len(input1) == len(input2) == len(output), "Gate arrays differ in length"
+        self.types = types
+        self.input1 = input1
+        self.input2 = input2
+        self.output = output
+        self.num_wires = 1 + max(max(output, default=-1), max(input1, default=-1), max(input2, default=-1))
+        # Index of the gate producing each wire (-1 for input wires), and whether a gate reads it
+        self._gate_index = array('i', [-1]) * self.num_wires
+        consumed = bytearray(self.num_wires)
+        for i in range(len(output)):
+            assert self._gate_index[output[i]] < 0, f"Wire {output[i]} is the output of more than one gate"
+            self._gate_index[output[i]] = i
+            consumed[input1[i]] = 1
+            if input2[i] >= 0:
+                consumed[input2[i]] = 1
+
+        if outputs is None:
+            outputs = [w for w in range(self.num_wires) if self._gate_index[w] >= 0 and not consumed[w]]
+        assert len(outputs) > 0 and all(self.is_gate(i) for i in outputs), \
+            "Every output wire must be the output of a gate"
+        self.output_wires = list(outputs)
+        # Wires that are not produced by any gate are the inputs of the circuit
+        self.input_wires = [w for w in range(self.num_wires) if consumed[w] and self._gate_index[w] < 0]
+        if inputs is None:
+            self.inputs = [self.input_wires]
+        else:
+            self.inputs = [list(group) for group in inputs]
+            # Declared inputs get labels even if no gate reads them
+            self.input_wires = sorted(set(self.input_wires).union(*self.inputs))
+
+    def __len__(self):
+        return len(self.types)
+
+    def __iter__(self):
+        return (self.gate(label) for label in self.output)
+
+    def is_gate(self, label):
+        return 0 <= label < self.num_wires and self._gate_index[label] >= 0
+
+    def gate_index(self, label):
+        """
+        Returns:
+            position in the gate arrays of the gate whose output is `label`, -1 for an input wire
+        """
+        return self._gate_index[label] if 0 <= label < self.num_wires else -1
+
+    def gate(self, label):
+        """
+        Returns:
+            Gate object for the gate whose output is `label`, None for an input wire
+        """
+        if not self.is_gate(label):
+            return None
+        i = self._gate_index[label]
+        return Gate(GATE_TYPES[self.types[i]], self.input1[i], self.input2[i] if self.input2[i] >= 0 else None,
+                    label)
+
+    def _inputs_of(self, label):
+        if not self.is_gate(label):
+            return None
+        i = self._gate_index[label]
+        return self.input1[i], self.input2[i] if self.input2[i] >= 0 else None
+
+    def output_positions(self, instance=0):
+        """
+        Args:
+            instance: number of the instance in garble_batch, whose outputs follow those of the
+                      previous instances
+
+        Returns:
+            dictionary of output wire -> its positions in `output_wires` (usually just one)
+        """
+        positions = dict()
+        for position, wire in enumerate(self.output_wires):
+            positions.setdefault(self.batch_wire(wire, instance), []).append(
+                instance * len(self.output_wires) + position)
+        return positions
+
+    def topological_order(self):
+        """
+        Returns:
+            list of gate labels ordered so that every gate comes after the gates feeding its inputs
+        """
+        return topological_order(self.output_wires, self._inputs_of)
 
-    def garble(self):
+    def plan(self):
+        """
+        Returns:
+            EvaluationPlan for this circuit
+        """
+        return EvaluationPlan.from_circuit(self)
+
+    def levels(self):
+        """
+        Groups the gates by depth: a gate's depth is one more than the deepest gate feeding it, and
+        input wires have depth 0. Gates in the same level never depend on each other.
+
+        Returns:
+            list of levels, each a list of gate labels
+        """
+        depth = array('i', [0]) * self.num_wires
+        levels = []
+        for label in self.topological_order():
+            i = self._gate_index[label]
+            d = depth[self.input1[i]]
+            if self.input2[i] >= 0 and depth[self.input2[i]] > d:
+                d = depth[self.input2[i]]
+            depth[label] = d + 1
+            if d == len(levels):
+                levels.append([])
+            levels[d].append(label)
+        return levels
+
+    def stats(self):
+        """
+        Returns:
+            dictionary with the number of gates of each type in GATE_TYPES, `gates` (total),
+            `non_free` (AND and OR gates, the only ones that need a garbled table), `depth` (number of
+            levels) and `non_free_depth` (largest number of AND/OR gates on a path from an input to an
+            output, which bounds the levels that need hashing)
+        """
+        counts = {gate_type: 0 for gate_type in GATE_TYPES}
+        for code in self.types:
+            counts[GATE_TYPES[code]] += 1
+        non_free = (GATE_CODES["AND"], GATE_CODES["OR"])
+        depth = array('i', [0]) * self.num_wires
+        non_free_depth = array('i', [0]) * self.num_wires
+        for label in self.topological_order():
+            i = self._gate_index[label]
+            inputs = [self.input1[i]] + ([self.input2[i]] if self.input2[i] >= 0 else [])
+            depth[label] = 1 + max(depth[w] for w in inputs)
+            non_free_depth[label] = (self.types[i] in non_free) + max(non_free_depth[w] for w in inputs)
+        return {
+            **counts,
+            "gates": len(self),
+            "non_free": counts["AND"] + counts["OR"],
+            "depth": max((depth[w] for w in self.output_wires), default=0),
+            "non_free_depth": max((non_free_depth[w] for w in self.output_wires), default=0),
+        }
+
+    def input_bits(self, value, group=0):
+        """
+        Maps an integer onto the wires of an input group, least significant bit on the first wire.
+
+        Args:
+            value: non-negative integer that fits in the group
+            group: index of the group in `inputs`
+
+        Returns:
+            list of (wire label, bit)
+        """
+        wires = self.inputs[group]
+        assert 0 <= value < 2 ** len(wires) and int(value) == value, \
+            f"Input must be a non-negative integer less than {2 ** len(wires)}"
+        return [(wire, (value >> i) & 1) for i, wire in enumerate(wires)]
+
+    def garble(self, scheme="classic", layered=False, workers=None, executor=None):
+        """
+        Args:
+            scheme: `classic` encrypts the full truth table of every gate with Fernet keys;
+                    `halfgates` uses Free-XOR with half-gates (see `_garble_halfgates`)
+            layered: garble a whole level of the circuit at a time, with the label arithmetic of
+                     its AND/OR gates packed into big ints and one AES call (`halfgates` only;
+                     benchmark.py reports the measured `layered_*` speedups)
+            workers: number of processes that garble each level in parallel; implies `layered`
+                     (`halfgates` only)
+            executor: ProcessPoolExecutor owned by the caller, used instead of starting `workers`
+                      processes for this call; `workers` is then the number of chunks each level is
+                      split into (defaults to the number of CPUs). Implies `layered`. Several
+                      threads may garble with the same executor at once (see common.process_pool).
+
+        Returns:
+            garbled_circuit: see the garbling scheme's method
+        """
+        if scheme == "classic":
+            if layered or workers or executor is not None:
+                raise ValueError("Layered and parallel garbling require the halfgates scheme")
+            return self._garble_classic()
+        elif scheme == "halfgates":
+            with process_pool(workers, executor) as pool:
+                if pool is None:
+                    return self._garble_halfgates(layered)
+                return self._garble_halfgates(layered=True, executor=pool, workers=workers or os.cpu_count())
+        else:
+            raise ValueError(f"Unsupported garbling scheme: {scheme}")
+
+    def batch_wire(self, wire, instance):
+        """
+        Returns:
+            label of `wire` in instance number `instance` of garble_batch
+        """
+        return instance * self.num_wires + wire
+
+    def garble_batch(self, count):
+        """
+        Garbles `count` independent instances of the circuit with the halfgates scheme in a single
+        pass: the levels are computed once, and each level of every instance is garbled with one
+        AES call. Instance k uses the wire labels of the circuit shifted by k * num_wires (see
+        batch_wire), so the instances form one larger circuit sharing the Free-XOR offset, and the
+        evaluator decodes all of them with receiver.solve_batch.
+
+        Returns:
+            garbled_circuit: see `_garble_halfgates`
+        """
+        offset = halfgates.random_offset()
+        n = self.num_wires
+        zero_labels = [None] * (n * count)  # 0-label of every wire of every instance
+        garbled_circuit = dict()
+        wires = [self.batch_wire(wire, k) for k in range(count) for wire in self.input_wires]
+        for wire, zero in zip(wires, halfgates.random_labels(len(wires))):
+            zero_labels[wire] = zero
+            garbled_circuit[wire] = {"value": (halfgates.to_bytes(zero), halfgates.to_bytes(zero ^ offset))}
+
+        positions = dict()
+        for k in range(count):
+            positions.update(self.output_positions(k))
+        for level in self.levels():
+            index = [self._gate_index[label] for label in level]
+            shifts = [k * n for k in range(count)]
+            zeros_c, tables = halfgates.garble_gates(
+                [GATE_TYPES[self.types[i]] for i in index] * count,
+                [zero_labels[shift + self.input1[i]] for shift in shifts for i in index],
+                [zero_labels[shift + self.input2[i]] if self.input2[i] >= 0 else None
+                 for shift in shifts for i in index],
+                offset, [shift + label for shift in shifts for label in level])
+            gates = ((shift, label, i) for shift in shifts for label, i in zip(level, index))
+            for (shift, label, i), zero_c, table in zip(gates, zeros_c, tables):
+                zero_labels[shift + label] = zero_c
+                garbled_gate = {
+                    "type": GATE_TYPES[self.types[i]],
+                    "inputs": [shift + self.input1[i], shift + self.input2[i] if self.input2[i] >= 0 else None],
+                    "rows": [halfgates.to_bytes(t) for t in table]
+                }
+                if shift + label in positions:
+                    garbled_gate["decode"] = zero_c & 1
+                    garbled_gate["positions"] = positions[shift + label]
+                garbled_circuit[shift + label] = garbled_gate
+        return garbled_circuit
+
+    def _garble_classic(self):
         """
         Approach:
-            1. Start with the last gate – aka the gate whose output is never used an input elsewhere
+            1. Start with the output gates – aka the gates whose output is never used an input elsewhere
             2. Encrypt a truth table for this gate
             3. Use the encrypted inputs for this gate as the output for the neighbor gates
             4. Evaluate steps 2 and 3 for all neighbor gates
@@ -114,25 +510,31 @@ class Circuit:
         Returns:
             garbled_circuit: a dictionary where the key is the gate label and the value is another
             dictionary: one key `inputs` that specifies the labels of the inputs (key will not exist if
-            the gate has no inputs), and another key `rows` that has a list of the encrypted rows. The
-            `rows` keys should be replaced with `value` once the gate is evaluated.
+            the gate has no inputs), and another key `rows` that has a list of the encrypted rows.
+            Output gates also have `positions`, their places in `output_wires`; an output that
+            another gate reads has real labels, and `decode` like in `_garble_halfgates`.
         """
         garbled_circuit = dict()
         enc_outputs = dict()  # gate_label: (out_zero, out_one)
-        visited = {self.last_gate}
-        pq = PriorityQueue()  # (level, gate_label, out_zero, out_one)
-        pq.put((0, self.last_gate, b'0', b'1'))
-        while not pq.empty():
+        positions = self.output_positions()
+        consumed = set(self.input1).union(self.input2)
+        # Outputs decrypt to the plain bits, unless another gate needs real labels to decrypt with
+        for label in positions:
+            enc_outputs[label] = new_label_pair() if label in consumed else (b'0', b'1')
+        visited = set(positions)
+        pq = [(0, label, *enc_outputs[label]) for label in positions]  # (level, gate_label, out_zero, out_one)
+        heapq.heapify(pq)
+        while pq:
             # Get the next gate and its output values
-            level, curr_label, out_zero, out_one = pq.get()
+            level, curr_label, out_zero, out_one = heapq.heappop(pq)
             # If this label isn't registered as a gate, then it is one of the original inputs
-            if curr_label not in self.gates:
+            if not self.is_gate(curr_label):
                 # Store the zero and one keys at this label's index in the garbled circuit dict
                 garbled_circuit[curr_label] = {"value": (out_zero, out_one)}
                 enc_outputs[curr_label] = (out_zero, out_one)
                 continue
             else:
-                curr_gate = self.gates[curr_label]
+                curr_gate = self.gate(curr_label)
             if curr_label in enc_outputs:
                 assert enc_outputs[curr_label] == (out_zero, out_one), \
                     f"Gate {curr_label} was assigned different output keys"
@@ -151,6 +553,11 @@ class Circuit:
             else:
                 enc_zero_b = None
                 enc_one_b = None
+            # A gate that reads the same wire twice (e.g. XOR(a, a)) must use its labels for both inputs
+            if curr_gate.input2 == curr_gate.input1:
+                if enc_zero_a is None:
+                    enc_zero_a, enc_one_a = new_label_pair()
+                enc_zero_b, enc_one_b = enc_zero_a, enc_one_a
 
             # Encrypt the gate
             enc_zero_a, enc_one_a, enc_zero_b, enc_one_b, enc_rows = curr_gate.encrypt(
@@ -170,9 +577,135 @@ class Circuit:
                                      (enc_zero_b, enc_one_b, curr_gate.input2)]:
                 if input is not None and input not in visited:
                     visited.add(input)
-                    pq.put((level + 1, input, zero, one))
+                    heapq.heappush(pq, (level + 1, input, zero, one))
                     enc_outputs[input] = (zero, one)
 
+        # Inputs that lead to no output (e.g. replaced by constants in optimizer.optimize) still get
+        # labels, like in the halfgates scheme, so every input bit can be chosen and transferred
+        for wire in self.input_wires:
+            if wire not in garbled_circuit:
+                garbled_circuit[wire] = {"value": new_label_pair()}
+        for label, label_positions in positions.items():
+            garbled_circuit[label]["positions"] = label_positions
+            if label in consumed:
+                garbled_circuit[label]["decode"] = permute_bit(enc_outputs[label][0])
+        self.garbled = garbled_circuit
+        return garbled_circuit
+
+    def garble_stream(self, chunk_size=1024, layered=False, workers=None, executor=None):
+        """
+        Garbles the circuit with the halfgates scheme lazily, so gate tables can be sent (and
+        evaluated) while the rest of the circuit is still being garbled. Only one chunk of tables
+        is held in memory at a time, and every gate lists in `release` the wires whose labels the
+        evaluator no longer needs once the gate is evaluated: the gate's inputs it is the last to
+        read, and its own output if no gate reads it.
+
+        Args:
+            chunk_size: number of gates per chunk
+            layered, workers, executor: see garble
+
+        Returns:
+            generator of dictionaries in the format of `_garble_halfgates`: the first holds only the
+            input wires, every following one up to `chunk_size` gates in topological order
+        """
+        with process_pool(workers, executor) as pool:
+            pieces = self._halfgates_pieces(layered or pool is not None, pool, workers or os.cpu_count(),
+                                            release=True)
+            # The input wires are a piece of their own
+            yield next(pieces)
+            chunk = dict()
+            for piece in pieces:
+                chunk.update(piece)
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = dict()
+            if chunk:
+                yield chunk
+
+    def _garble_halfgates(self, layered=False, executor=None, workers=1):
+        """
+        Approach:
+            1. Pick a global offset R and a random 0-label for every input wire; the 1-label is 0-label ^ R
+            2. Walk the gates in topological order (or level by level if `layered`), deriving the
+               0-label of each output wire: XOR, XNOR, NOT and BUF are free (labels are XORed, no
+               table), while AND and OR are garbled with two half gates (two ciphertexts each)
+            3. Publish the permute bit of each output wire so the evaluator can decode it
+
+        With an `executor`, each level is split into `workers` chunks garbled in separate processes.
+
+        Returns:
+            garbled_circuit: a dictionary where the key is the wire label. Input wires map to a
+            dictionary with key `value` holding the (zero, one) labels. Gates map to a dictionary with
+            `type`, `inputs` (labels of the input wires) and `rows` (empty for free gates, otherwise
+            the two half-gate ciphertexts). Output gates also have `decode`, the permute bit of their
+            0-label, and `positions`, their places in `output_wires`.
+        """
+        garbled_circuit = dict()
+        for piece in self._halfgates_pieces(layered, executor, workers):
+            garbled_circuit.update(piece)
         self.garbled = garbled_circuit
         return garbled_circuit
 
+    def _halfgates_pieces(self, layered=False, executor=None, workers=1, release=False):
+        """
+        Generator behind `_garble_halfgates` and `garble_stream`: yields the input wires first, then
+        the garbled gates one level (or one gate if not `layered`) at a time, with their `release`
+        lists if `release` (see garble_stream)
+        """
+        offset = halfgates.random_offset()
+        zero_labels = [None] * self.num_wires  # 0-label of every wire as an integer
+        garbled_inputs = dict()
+        for wire, zero in zip(self.input_wires, halfgates.random_labels(len(self.input_wires))):
+            zero_labels[wire] = zero
+            garbled_inputs[wire] = {"value": (halfgates.to_bytes(zero), halfgates.to_bytes(zero ^ offset))}
+        yield garbled_inputs
+
+        positions = self.output_positions()
+        groups = self.levels() if layered else [[label] for label in self.topological_order()]
+        last_reader = dict()  # wire -> the last gate, in the order they are yielded, that reads it
+        if release:
+            for level in groups:
+                for label in level:
+                    i = self._gate_index[label]
+                    last_reader[self.input1[i]] = label
+                    if self.input2[i] >= 0:
+                        last_reader[self.input2[i]] = label
+        for level in groups:
+            index = [self._gate_index[label] for label in level]
+            gate_types = [GATE_TYPES[self.types[i]] for i in index]
+            inputs = [(self.input1[i], self.input2[i] if self.input2[i] >= 0 else None) for i in index]
+            zeros_a = [zero_labels[a] for a, _ in inputs]
+            zeros_b = [zero_labels[b] if b is not None else None for _, b in inputs]
+            if executor is not None and len(level) >= 2 * PARALLEL_MIN_GATES:
+                zeros_c, tables = [], []
+                chunks = [split_chunks(items, workers, PARALLEL_MIN_GATES)
+                          for items in (gate_types, zeros_a, zeros_b, level)]
+                for chunk_zeros, chunk_tables in executor.map(
+                        halfgates.garble_gates, *chunks[:3], [offset] * len(chunks[0]), chunks[3]):
+                    zeros_c += chunk_zeros
+                    tables += chunk_tables
+            elif layered:
+                zeros_c, tables = halfgates.garble_gates(gate_types, zeros_a, zeros_b, offset, level)
+            else:
+                zero_c, table = halfgates.garble_gate(gate_types[0], zeros_a[0], zeros_b[0], offset, level[0])
+                zeros_c, tables = [zero_c], [table]
+            piece = dict()
+            for label, gate_type, (input1, input2), zero_c, table in zip(level, gate_types, inputs, zeros_c, tables):
+                zero_labels[label] = zero_c
+                piece[label] = {
+                    "type": gate_type,
+                    "inputs": [input1, input2],
+                    "rows": [halfgates.to_bytes(t) for t in table]
+                }
+                if label in positions:
+                    piece[label]["decode"] = zero_c & 1
+                    piece[label]["positions"] = positions[label]
+                if release:
+                    freed = [w for w in dict.fromkeys((input1, input2)) if w is not None and last_reader[w] == label]
+                    if label not in last_reader:
+                        freed.append(label)
+                    for wire in freed:
+                        zero_labels[wire] = None
+                    if freed:
+                        piece[label]["release"] = freed
+            yield piece
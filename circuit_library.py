@@ -0,0 +1,321 @@
+# circuit_library.py
+"""
+Generators of n-bit circuits. Every input group and every output value is least significant bit
+first, so Circuit.input_bits and receiver.output_value map integers onto them.
+
+The circuits are built for garbling with Free-XOR: XOR, XNOR and NOT cost nothing, so every
+generator uses as few AND gates as the construction allows (one per bit for comparison, addition
+and selection). Where a shorter critical path costs extra ANDs, `low_depth=True` selects the
+logarithmic-depth variant. Circuit.stats reports the resulting gate counts and depths.
+"""
+from array import array
+from circuit import Circuit, GATE_CODES
+
+
+class CircuitBuilder:
+    def __init__(self, inputs=None, num_wires=0):
+        """
+        Appends gates to the parallel arrays of a Circuit, allocating a new wire for every gate
+
+        Args:
+            inputs: input groups to start from (e.g. those of an existing circuit)
+            num_wires: number of wire labels already in use; new wires are numbered after them
+        """
+        self.types, self.input1, self.input2, self.output = array('B'), array('i'), array('i'), array('i')
+        self.num_wires = num_wires
+        self.inputs = [list(group) for group in inputs] if inputs is not None else []
+
+    def input(self, bits):
+        """
+        Returns:
+            the wires of a new input group of `bits` bits
+        """
+        group = list(range(self.num_wires, self.num_wires + bits))
+        self.num_wires += bits
+        self.inputs.append(group)
+        return group
+
+    def gate(self, gate_type, a, b=None):
+        wire = self.num_wires
+        self.num_wires += 1
+        self.types.append(GATE_CODES[gate_type])
+        self.input1.append(a)
+        self.input2.append(-1 if b is None else b)
+        self.output.append(wire)
+        return wire
+
+    def and_(self, a, b):
+        return self.gate("AND", a, b)
+
+    def xor(self, a, b):
+        return self.gate("XOR", a, b)
+
+    def xnor(self, a, b):
+        return self.gate("XNOR", a, b)
+
+    def not_(self, a):
+        return self.gate("NOT", a)
+
+    def build(self, outputs):
+        """
+        Drops the gates that no output depends on, and buffers the outputs that are input wires,
+        since every output must be the output of a gate. The remaining gates are renumbered right
+        after the highest input wire, so the wire labels stay dense (wire_format.load_circuit only
+        accepts labels below the number of wires of the circuit).
+
+        Args:
+            outputs: wires of the output bits, in order
+
+        Returns:
+            Circuit
+        """
+        index = {wire: i for i, wire in enumerate(self.output)}
+        live = bytearray(len(self.output))
+        stack = [index[w] for w in outputs if w in index]
+        while stack:
+            i = stack.pop()
+            if live[i]:
+                continue
+            live[i] = 1
+            for w in (self.input1[i], self.input2[i]):
+                if w in index and not live[index[w]]:
+                    stack.append(index[w])
+
+        next_wire = 1 + max((w for group in self.inputs for w in group), default=-1)
+        renamed = dict()  # old label -> new label of every live gate; input wires keep theirs
+        types, input1, input2, output = array('B'), array('i'), array('i'), array('i')
+        for i in range(len(self.output)):
+            if live[i]:
+                # Gates are appended after the gates they read, so their inputs are already renamed
+                types.append(self.types[i])
+                input1.append(renamed.get(self.input1[i], self.input1[i]))
+                input2.append(renamed.get(self.input2[i], self.input2[i]))
+                output.append(next_wire)
+                renamed[self.output[i]] = next_wire
+                next_wire += 1
+
+        final = []
+        for wire in outputs:
+            if wire not in index:
+                types.append(GATE_CODES["BUF"])
+                input1.append(wire)
+                input2.append(-1)
+                output.append(next_wire)
+                wire, next_wire = next_wire, next_wire + 1
+            else:
+                wire = renamed[wire]
+            final.append(wire)
+        return Circuit.from_arrays(types, input1, input2, output, outputs=final, inputs=self.inputs)
+
+
+def _less_than(builder, a, b):
+    """
+    a < b with one AND per bit: c is the comparison of the bits seen so far, and
+    c' = ((b_i ^ c) & (a_i ^ c)) ^ b_i keeps c when a_i == b_i and becomes b_i otherwise
+    """
+    c = builder.and_(b[0], builder.not_(a[0]))
+    for a_i, b_i in zip(a[1:], b[1:]):
+        c = builder.xor(builder.and_(builder.xor(b_i, c), builder.xor(a_i, c)), b_i)
+    return c
+
+
+def _less_than_tree(builder, a, b, need_equal=False):
+    """
+    a < b as a balanced tree over the bits: (lt, eq) of the high half and the low half combine into
+    lt = lt_hi ^ (eq_hi & lt_lo), where XOR replaces OR because both terms cannot be 1 together
+
+    Returns:
+        (lt, eq) wires; eq is None unless `need_equal`
+    """
+    if len(a) == 1:
+        lt = builder.and_(b[0], builder.not_(a[0]))
+        return lt, builder.xnor(a[0], b[0]) if need_equal else None
+    half = len(a) // 2
+    lt_lo, eq_lo = _less_than_tree(builder, a[:half], b[:half], need_equal)
+    lt_hi, eq_hi = _less_than_tree(builder, a[half:], b[half:], True)
+    lt = builder.xor(lt_hi, builder.and_(eq_hi, lt_lo))
+    return lt, builder.and_(eq_hi, eq_lo) if need_equal else None
+
+
+def _select(builder, s, a, b):
+    """
+    s ? b : a, bit by bit, with one AND per bit
+    """
+    return [builder.xor(a_i, builder.and_(s, builder.xor(a_i, b_i))) for a_i, b_i in zip(a, b)]
+
+
+def _add(builder, a, b, carry=None):
+    """
+    Ripple-carry addition with one AND per full adder: c' = c ^ ((a_i ^ c) & (b_i ^ c)). `a` may be
+    longer than `b`; its extra bits go through half adders.
+
+    Returns:
+        the len(a) + 1 bits of a + b + carry
+    """
+    assert len(a) >= len(b), "The first operand must be the longest"
+    total = []
+    for i, a_i in enumerate(a):
+        if i < len(b):
+            p = builder.xor(a_i, b[i])
+            if carry is None:
+                total.append(p)
+                carry = builder.and_(a_i, b[i])
+            else:
+                total.append(builder.xor(p, carry))
+                carry = builder.xor(carry, builder.and_(builder.xor(a_i, carry), builder.xor(b[i], carry)))
+        elif carry is None:
+            total.append(a_i)
+        else:
+            total.append(builder.xor(a_i, carry))
+            carry = builder.and_(a_i, carry)
+    return total + [carry] if carry is not None else total
+
+
+def _add_prefix(builder, a, b):
+    """
+    Sklansky parallel-prefix addition: logarithmic depth for about n / 2 * log2(n) extra ANDs.
+    Combining (g, p) of a high block with g' of the block below gives g ^ (p & g'), as g and
+    p & g' cannot be 1 together.
+    """
+    p = [builder.xor(a_i, b_i) for a_i, b_i in zip(a, b)]
+    g = [builder.and_(a_i, b_i) for a_i, b_i in zip(a, b)]
+    propagate = list(p)
+    size = 1
+    while size < len(a):
+        for i in range(len(a)):
+            if i & size:
+                j = (i & ~(2 * size - 1)) + size - 1  # last bit of the lower half of the block
+                g[i] = builder.xor(g[i], builder.and_(propagate[i], g[j]))
+                propagate[i] = builder.and_(propagate[i], propagate[j])
+        size *= 2
+    # g[i] is now the carry out of bit i
+    return [p[0]] + [builder.xor(p[i], g[i - 1]) for i in range(1, len(a))] + [g[-1]]
+
+
+def _popcount(builder, bits):
+    """
+    Number of 1 bits, adding the counts of both halves with the remaining bit as carry-in, so
+    every full adder absorbs one more bit
+    """
+    if len(bits) == 1:
+        return list(bits)
+    carry, rest = bits[-1], bits[:-1]
+    if len(rest) == 1:
+        x, y = rest, [carry]
+        carry = None
+    else:
+        x, y = _popcount(builder, rest[:len(rest) // 2]), _popcount(builder, rest[len(rest) // 2:])
+    x, y = (x, y) if len(x) >= len(y) else (y, x)
+    # The count never exceeds len(bits), so the higher bits are always 0
+    return _add(builder, x, y, carry)[:len(bits).bit_length()]
+
+
+def less_than(bits, low_depth=False):
+    """
+    a < b for two `bits`-bit unsigned integers: `bits` ANDs and depth `bits`, or with `low_depth`
+    about 3 * `bits` ANDs and depth log2(`bits`) + 1.
+
+    Returns:
+        Circuit with inputs [a, b] and one output bit
+    """
+    builder = CircuitBuilder()
+    a, b = builder.input(bits), builder.input(bits)
+    lt = _less_than_tree(builder, a, b)[0] if low_depth else _less_than(builder, a, b)
+    return builder.build([lt])
+
+
+def equality(bits):
+    """
+    a == b: `bits` - 1 ANDs in a balanced tree of depth log2(`bits`).
+
+    Returns:
+        Circuit with inputs [a, b] and one output bit
+    """
+    builder = CircuitBuilder()
+    a, b = builder.input(bits), builder.input(bits)
+    level = [builder.xnor(a_i, b_i) for a_i, b_i in zip(a, b)]
+    while len(level) > 1:
+        level = [builder.and_(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+    return builder.build(level)
+
+
+def adder(bits, low_depth=False):
+    """
+    a + b for two `bits`-bit unsigned integers: `bits` ANDs with a ripple carry, or with
+    `low_depth` a parallel-prefix adder of depth log2(`bits`) + 1.
+
+    Returns:
+        Circuit with inputs [a, b] and `bits` + 1 output bits
+    """
+    builder = CircuitBuilder()
+    a, b = builder.input(bits), builder.input(bits)
+    return builder.build(_add_prefix(builder, a, b) if low_depth else _add(builder, a, b))
+
+
+def mux(bits):
+    """
+    s ? b : a for two `bits`-bit values: `bits` ANDs, all in one level.
+
+    Returns:
+        Circuit with inputs [a, b, [s]] and `bits` output bits
+    """
+    builder = CircuitBuilder()
+    a, b, (s,) = builder.input(bits), builder.input(bits), builder.input(1)
+    return builder.build(_select(builder, s, a, b))
+
+
+def hamming_distance(bits):
+    """
+    Number of positions where a and b differ: the XORs are free and the count takes about `bits`
+    ANDs.
+
+    Returns:
+        Circuit with inputs [a, b] and `bits`.bit_length() output bits
+    """
+    builder = CircuitBuilder()
+    a, b = builder.input(bits), builder.input(bits)
+    return builder.build(_popcount(builder, [builder.xor(a_i, b_i) for a_i, b_i in zip(a, b)]))
+
+
+def _min_max(bits, low_depth, maximum):
+    builder = CircuitBuilder()
+    a, b = builder.input(bits), builder.input(bits)
+    lt = _less_than_tree(builder, a, b)[0] if low_depth else _less_than(builder, a, b)
+    smallest = _select(builder, lt, b, a)
+    if maximum:
+        # a ^ b ^ min(a, b) == max(a, b), for free
+        return builder.build([builder.xor(builder.xor(a_i, b_i), m) for a_i, b_i, m in zip(a, b, smallest)])
+    return builder.build(smallest)
+
+
+def minimum(bits, low_depth=False):
+    """
+    min(a, b): the comparison of less_than plus `bits` ANDs to select the result.
+
+    Returns:
+        Circuit with inputs [a, b] and `bits` output bits
+    """
+    return _min_max(bits, low_depth, maximum=False)
+
+
+def maximum(bits, low_depth=False):
+    """
+    max(a, b): same cost as minimum.
+
+    Returns:
+        Circuit with inputs [a, b] and `bits` output bits
+    """
+    return _min_max(bits, low_depth, maximum=True)
+
+
+# Generators by name, each taking the bit width of the inputs
+GENERATORS = {
+    "less_than": less_than,
+    "equality": equality,
+    "adder": adder,
+    "mux": mux,
+    "hamming_distance": hamming_distance,
+    "minimum": minimum,
+    "maximum": maximum,
+}
@@ -1,3 +1,39 @@
 # common.py
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 
 SUFFIX_LEN = 15
+
+
+def split_chunks(items, count, min_size=1):
+    """
+    Splits a list into at most `count` contiguous chunks of nearly equal size, none smaller than
+    `min_size` (except when the list itself is smaller)
+    """
+    count = max(1, min(count, len(items) // max(min_size, 1)))
+    size, extra = divmod(len(items), count)
+    chunks, start = [], 0
+    for k in range(count):
+        end = start + size + (k < extra)
+        chunks.append(items[start:end])
+        start = end
+    return chunks
+
+
+@contextmanager
+def process_pool(workers=None, executor=None):
+    """
+    Yields the executor for parallel work: `executor` if given (owned by the caller, which reuses it
+    across calls), otherwise a new ProcessPoolExecutor of `workers` processes shut down on exit, or
+    None when `workers` is not set.
+
+    A caller-owned executor may be shared by threads that garble or evaluate different circuits at
+    the same time (e.g. the sessions of a ReceiverService): the executor itself is thread-safe, and
+    the levels too small to ship to a worker are processed in the calling thread, whose AES hashes
+    use an encryptor of their own (see halfgates._aes).
+    """
+    if executor is not None or not workers:
+        yield executor
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield executor
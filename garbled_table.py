@@ -0,0 +1,304 @@
+# garbled_table.py
+"""
+Array-backed half-gates garbled circuit. Circuit.garble returns a dictionary with one dictionary
+and one `bytes` object per row for every gate, which is millions of Python objects for a large
+circuit. A GarbledTable holds the same circuit in a few flat buffers instead:
+    - `types`, `input1`, `input2` and `output`: the gates in level order (every level after the
+      gates it reads), ending at the positions in `level_ends`
+    - `rows`: 2 * LABEL_LEN bytes per gate, the two half-gate ciphertexts (zeros for free gates)
+    - `input_wires` and `input_labels`: the (zero, one) labels of each input wire, only on the
+      garbler's side
+    - `outputs` and `decode`: the output wires and the permute bit of their 0-label
+Evaluation keeps its state in one more buffer, LABEL_LEN bytes per wire.
+
+The table is stored as the same buffers one after the other (ints little-endian), so `load` maps a
+file into memory and evaluates it without reading it all or copying it:
+    header := MAGIC VERSION labels_per_input:byte num_wires gates levels inputs outputs
+    body   := input1 input2 output level_ends input_wires outputs   (int32 each)
+              types decode                                          (byte each)
+              rows input_labels
+"""
+from array import array
+from bisect import bisect_left
+from circuit import EvaluationPlan, GATE_CODES, GATE_TYPES
+import halfgates
+from halfgates import LABEL_LEN
+import mmap
+import struct
+import sys
+
+MAGIC = b'GT'
+VERSION = 1
+HEADER = struct.Struct('<2sBB5I')  # 24 bytes, so the int32 arrays after it stay aligned
+ROW_LEN = 2 * LABEL_LEN  # both ciphertexts of a gate
+_TABLE_CODES = (GATE_CODES["AND"], GATE_CODES["OR"])
+
+
+def _int_bytes(values):
+    values = array('i', values)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values.tobytes()
+
+
+def _int_view(view):
+    if sys.byteorder == "little":
+        return view.cast('i')
+    values = array('i', bytes(view))
+    values.byteswap()
+    return values
+
+
+class GarbledTable:
+    def __init__(self, types, input1, input2, output, level_ends, rows, input_wires, input_labels,
+                 outputs, decode, num_wires):
+        """
+        Use `garble`, `from_garbled` or `load` to create one; every argument is described in the
+        module docstring. Arrays of ints may be any sequences of ints, including memoryviews cast
+        to 'i'.
+        """
+        assert len(types) == len(input1) == len(input2) == len(output), "Gate arrays differ in length"
+        assert len(rows) == ROW_LEN * len(output), "The rows must hold two ciphertexts per gate"
+        assert len(input_labels) in (0, 2 * LABEL_LEN * len(input_wires)), \
+            "Input labels must hold a (zero, one) pair per input wire, or nothing"
+        self.types = types
+        self.input1 = input1
+        self.input2 = input2
+        self.output = output
+        self.level_ends = level_ends
+        self.rows = rows
+        self.input_wires = input_wires
+        self.input_labels = input_labels
+        self.outputs = outputs
+        self.decode = decode
+        self.num_wires = num_wires
+        self._mmap = None
+
+    @classmethod
+    def garble(cls, circuit):
+        """
+        Garbles a Circuit with the halfgates scheme straight into a table, one level at a time
+        with a single AES call per level (same labels and tweaks as Circuit.garble("halfgates")).
+
+        Returns:
+            GarbledTable holding the label pairs of the input wires
+        """
+        offset = halfgates.random_offset()
+        zero_labels = [None] * circuit.num_wires  # 0-label of every wire, only while garbling
+        input_labels = bytearray()
+        for wire, zero in zip(circuit.input_wires, halfgates.random_labels(len(circuit.input_wires))):
+            zero_labels[wire] = zero
+            input_labels += halfgates.to_bytes(zero) + halfgates.to_bytes(zero ^ offset)
+
+        types, input1, input2, output, level_ends = array('B'), array('i'), array('i'), array('i'), array('i')
+        rows = bytearray()
+        empty_row = bytes(ROW_LEN)
+        for level in circuit.levels():
+            index = [circuit.gate_index(label) for label in level]
+            zeros_c, tables = halfgates.garble_gates(
+                [GATE_TYPES[circuit.types[i]] for i in index],
+                [zero_labels[circuit.input1[i]] for i in index],
+                [zero_labels[circuit.input2[i]] if circuit.input2[i] >= 0 else None for i in index],
+                offset, level)
+            for label, i, zero_c, table in zip(level, index, zeros_c, tables):
+                zero_labels[label] = zero_c
+                types.append(circuit.types[i])
+                input1.append(circuit.input1[i])
+                input2.append(circuit.input2[i])
+                output.append(label)
+                rows += b''.join(halfgates.to_bytes(t) for t in table) if table else empty_row
+            level_ends.append(len(output))
+        decode = array('B', [zero_labels[wire] & 1 for wire in circuit.output_wires])
+        return cls(types, input1, input2, output, level_ends, rows, array('i', circuit.input_wires),
+                   input_labels, array('i', circuit.output_wires), decode, circuit.num_wires)
+
+    @classmethod
+    def from_garbled(cls, garbled_circuit):
+        """
+        Converts a halfgates garbled circuit from Circuit.garble. The input label pairs are kept
+        only if every input wire still holds its (zero, one) pair.
+
+        Returns:
+            GarbledTable
+        """
+        if any("inputs" in entry and "type" not in entry for entry in garbled_circuit.values()):
+            raise ValueError("Only halfgates garbled circuits can be stored in a GarbledTable")
+        plan = EvaluationPlan.from_garbled(garbled_circuit)
+        types, input1, input2, output, level_ends = array('B'), array('i'), array('i'), array('i'), array('i')
+        rows = bytearray()
+        for level in plan.levels():
+            for i in level:
+                entry = garbled_circuit[plan.gates[i]]
+                types.append(GATE_CODES[entry["type"]])
+                input1.append(plan.input1[i])
+                input2.append(plan.input2[i])
+                output.append(plan.gates[i])
+                rows += b''.join(entry["rows"]) if entry["rows"] else bytes(ROW_LEN)
+            level_ends.append(len(output))
+
+        input_wires = array('i', sorted(wire for wire, entry in garbled_circuit.items() if "inputs" not in entry))
+        values = [garbled_circuit[wire]["value"] for wire in input_wires]
+        input_labels = bytearray()
+        if all(isinstance(value, tuple) for value in values):
+            input_labels = bytearray(b''.join(label for pair in values for label in pair))
+        decode = array('B', [garbled_circuit[wire]["decode"] for wire in plan.outputs])
+        return cls(types, input1, input2, output, level_ends, rows, input_wires, input_labels,
+                   array('i', plan.outputs), decode, max(plan.num_wires, max(input_wires, default=-1) + 1))
+
+    def __len__(self):
+        return len(self.output)
+
+    def label_pair(self, wire):
+        """
+        Returns:
+            (zero, one) labels of an input wire, on the garbler's side
+        """
+        assert self.input_labels, "The table holds no input labels"
+        # input_wires is sorted
+        k = bisect_left(self.input_wires, wire)
+        if k == len(self.input_wires) or self.input_wires[k] != wire:
+            raise KeyError(f"Wire {wire} is not an input wire")
+        pair = self.input_labels[2 * LABEL_LEN * k:2 * LABEL_LEN * (k + 1)]
+        return bytes(pair[:LABEL_LEN]), bytes(pair[LABEL_LEN:])
+
+    def evaluate(self, input_labels):
+        """
+        Evaluates the table one level at a time, with a single AES call per level.
+
+        Args:
+            input_labels: dictionary of input wire -> the label held for it (e.g. obtained by OT)
+
+        Returns:
+            decrypted output in the format of receiver.solve_circuit
+        """
+        labels = bytearray(LABEL_LEN * self.num_wires)
+        for wire in self.input_wires:
+            labels[LABEL_LEN * wire:LABEL_LEN * (wire + 1)] = input_labels[wire]
+
+        def label(wire):
+            return halfgates.from_bytes(labels[LABEL_LEN * wire:LABEL_LEN * (wire + 1)])
+
+        def table(i):
+            if self.types[i] not in _TABLE_CODES:
+                return ()
+            row = self.rows[ROW_LEN * i:ROW_LEN * (i + 1)]
+            return halfgates.from_bytes(row[:LABEL_LEN]), halfgates.from_bytes(row[LABEL_LEN:])
+
+        start = 0
+        for end in self.level_ends:
+            if end - start == 1:
+                # Deep, narrow circuits have many single-gate levels: skip the batching
+                gate = self.output[start]
+                label_c = halfgates.evaluate_gate(GATE_TYPES[self.types[start]], label(self.input1[start]),
+                                                  label(self.input2[start]) if self.input2[start] >= 0 else None,
+                                                  table(start), gate)
+                labels[LABEL_LEN * gate:LABEL_LEN * (gate + 1)] = halfgates.to_bytes(label_c)
+                start = end
+                continue
+            gates = list(self.output[start:end])
+            labels_c = halfgates.evaluate_gates(
+                [GATE_TYPES[code] for code in self.types[start:end]],
+                [label(wire) for wire in self.input1[start:end]],
+                [label(wire) if wire >= 0 else None for wire in self.input2[start:end]],
+                [table(i) for i in range(start, end)],
+                gates)
+            for gate, label_c in zip(gates, labels_c):
+                labels[LABEL_LEN * gate:LABEL_LEN * (gate + 1)] = halfgates.to_bytes(label_c)
+            start = end
+
+        # The permute bit is the lowest bit of the label's last byte
+        outputs = [b'1' if (labels[LABEL_LEN * (wire + 1) - 1] & 1) ^ bit else b'0'
+                   for wire, bit in zip(self.outputs, self.decode)]
+        return outputs[0] if len(outputs) == 1 else outputs
+
+    def dumps(self, input_labels=True):
+        """
+        Args:
+            input_labels: include the (zero, one) labels of the input wires, which only the garbler
+                          may know; leave them out for a table given to the evaluator
+
+        Returns:
+            the table serialized as described in the module docstring
+        """
+        labels = self.input_labels if input_labels else b''
+        out = bytearray(HEADER.pack(MAGIC, VERSION, 2 if labels else 0, self.num_wires, len(self),
+                                    len(self.level_ends), len(self.input_wires), len(self.outputs)))
+        for values in (self.input1, self.input2, self.output, self.level_ends, self.input_wires, self.outputs):
+            out += _int_bytes(values)
+        for section in (self.types, self.decode, self.rows, labels):
+            out += section
+        return out
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        """
+        Reads a table serialized with dumps without copying it: every array of the table is a view
+        of `buffer`, which must stay alive (and unchanged) while the table is used.
+
+        Returns:
+            GarbledTable
+        """
+        view = memoryview(buffer)
+        if len(view) < HEADER.size:
+            raise ValueError("Truncated garbled table")
+        magic, version, labels_per_input, num_wires, gates, levels, inputs, outputs = HEADER.unpack(view[:HEADER.size])
+        if magic != MAGIC:
+            raise ValueError("Not a garbled table")
+        if version != VERSION:
+            raise ValueError(f"Unsupported garbled table version: {version}")
+        sizes = [4 * gates] * 3 + [4 * levels, 4 * inputs, 4 * outputs, gates, outputs, ROW_LEN * gates,
+                                   labels_per_input * LABEL_LEN * inputs]
+        if len(view) != HEADER.size + sum(sizes):
+            raise ValueError("Garbled table size does not match its header")
+        sections, pos = [], HEADER.size
+        for size in sizes:
+            sections.append(view[pos:pos + size])
+            pos += size
+        input1, input2, output, level_ends, input_wires, output_wires = map(_int_view, sections[:6])
+        types, decode, rows, input_labels = sections[6:]
+        return cls(types, input1, input2, output, level_ends, rows, input_wires, input_labels,
+                   output_wires, decode, num_wires)
+
+    def save(self, path, input_labels=True):
+        """
+        Writes the table to a file; see dumps
+        """
+        with open(path, "wb") as f:
+            f.write(self.dumps(input_labels))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Maps a file written by save into memory; pages of the table are only read when evaluation
+        reaches them. Call close (or use the table as a context manager) to unmap it.
+
+        Returns:
+            GarbledTable
+        """
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            table = cls.from_buffer(mapped)
+        except ValueError:
+            mapped.close()
+            raise
+        table._mmap = mapped
+        return table
+
+    def close(self):
+        if self._mmap is None:
+            return
+        # The map can only be closed once no view of it is left
+        for name in ("types", "input1", "input2", "output", "level_ends", "rows", "input_wires",
+                     "input_labels", "outputs", "decode"):
+            value = getattr(self, name)
+            if isinstance(value, memoryview):
+                value.release()
+        self._mmap.close()
+        self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,297 @@
+# halfgates.py
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+import secrets
+import threading
+
+LABEL_LEN = 16  # wire labels are a single AES block
+_MASK = (1 << 128) - 1
+# Batches with fewer AND/OR gates are garbled and evaluated gate by gate, which is cheaper than packing
+PACKED_MIN_GATES = 8
+
+# Fixed-key AES acts as a public random permutation, so the key does not need to be secret.
+# Each thread reuses its own ECB encryptor for every hash; ECB keeps no state between blocks, but an
+# encryptor cannot be used by two threads at once.
+_FIXED_KEY = bytes.fromhex("000102030405060708090a0b0c0d0e0f")
+_local = threading.local()
+
+
+def _aes():
+    """
+    Returns:
+        the fixed-key AES encryptor of the calling thread
+    """
+    try:
+        return _local.aes
+    except AttributeError:
+        _local.aes = Cipher(algorithms.AES(_FIXED_KEY), modes.ECB()).encryptor()
+        return _local.aes
+
+
+def random_label():
+    return secrets.randbits(128)
+
+
+def random_labels(count):
+    """
+    Draws `count` labels from a single call to the random source.
+    """
+    buffer = memoryview(secrets.token_bytes(LABEL_LEN * count))
+    return [from_bytes(buffer[i:i + LABEL_LEN]) for i in range(0, len(buffer), LABEL_LEN)]
+
+
+def random_offset():
+    """
+    Global Free-XOR offset R. Every wire's 1-label is its 0-label XOR R. The lowest bit is
+    forced to 1 so the two labels of a wire always have different permute bits.
+    """
+    return secrets.randbits(128) | 1
+
+
+def to_bytes(label):
+    return label.to_bytes(LABEL_LEN, "big")
+
+
+def from_bytes(label):
+    return int.from_bytes(label, "big")
+
+
+def _double(x):
+    # Multiplication by 2 in GF(2^128)
+    x <<= 1
+    if x >> 128:
+        x = (x & _MASK) ^ 0x87
+    return x
+
+
+def hash_label(label, tweak):
+    """
+    Tweakable hash H(X, j) = pi(2X ^ j) ^ (2X ^ j), where pi is fixed-key AES.
+    """
+    k = _double(label) ^ tweak
+    return from_bytes(_aes().update(to_bytes(k))) ^ k
+
+
+def _and_from_hashes(zero_a, pa, pb, offset, ha0, ha1, hb0, hb1):
+    # Generator half gate (garbler knows pb), then evaluator half gate (evaluator knows b ^ pb)
+    tg = ha0 ^ ha1 ^ (offset if pb else 0)
+    wg = ha0 ^ (tg if pa else 0)
+    te = hb0 ^ hb1 ^ zero_a
+    we = hb0 ^ ((te ^ zero_a) if pb else 0)
+    return wg ^ we, (tg, te)
+
+
+def garble_and(zero_a, zero_b, offset, gate_id):
+    """
+    Garbles an AND gate with two half gates.
+
+    Args:
+        zero_a: 0-label of the first input wire
+        zero_b: 0-label of the second input wire
+        offset: global Free-XOR offset R
+        gate_id: unique integer for this gate, used to tweak the hash
+
+    Returns:
+        zero_c: 0-label of the output wire
+        table: the two ciphertexts (TG, TE) sent to the evaluator
+    """
+    j0, j1 = 2 * gate_id, 2 * gate_id + 1
+    ha0, ha1 = hash_label(zero_a, j0), hash_label(zero_a ^ offset, j0)
+    hb0, hb1 = hash_label(zero_b, j1), hash_label(zero_b ^ offset, j1)
+    return _and_from_hashes(zero_a, zero_a & 1, zero_b & 1, offset, ha0, ha1, hb0, hb1)
+
+
+def evaluate_and(label_a, label_b, table, gate_id):
+    """
+    Evaluates a half-gates AND gate from one label per input wire.
+
+    Args:
+        label_a: label held for the first input wire
+        label_b: label held for the second input wire
+        table: the two ciphertexts (TG, TE) produced by garble_and
+        gate_id: the same integer passed to garble_and
+
+    Returns:
+        label of the output wire
+    """
+    tg, te = table
+    sa = label_a & 1
+    sb = label_b & 1
+    j0, j1 = 2 * gate_id, 2 * gate_id + 1
+    wg = hash_label(label_a, j0) ^ (tg if sa else 0)
+    we = hash_label(label_b, j1) ^ ((te ^ label_a) if sb else 0)
+    return wg ^ we
+
+
+def garble_gate(gate_type, zero_a, zero_b, offset, gate_id):
+    """
+    Args:
+        gate_type: one of circuit.GATE_TYPES
+        zero_a: 0-label of the first input wire
+        zero_b: 0-label of the second input wire (None for NOT and BUF)
+        offset: global Free-XOR offset R
+        gate_id: unique integer for this gate, used to tweak the hash
+
+    Returns:
+        zero_c: 0-label of the output wire
+        table: ciphertexts for the evaluator; empty for free gates
+    """
+    if gate_type == "XOR":
+        return zero_a ^ zero_b, ()
+    elif gate_type == "XNOR":
+        return zero_a ^ zero_b ^ offset, ()
+    elif gate_type == "NOT":
+        return zero_a ^ offset, ()
+    elif gate_type == "BUF":
+        return zero_a, ()
+    elif gate_type == "AND":
+        return garble_and(zero_a, zero_b, offset, gate_id)
+    elif gate_type == "OR":
+        # a | b == ~(~a & ~b); negating a wire only swaps the meaning of its labels
+        zero_c, table = garble_and(zero_a ^ offset, zero_b ^ offset, offset, gate_id)
+        return zero_c ^ offset, table
+    else:
+        raise ValueError(f"Unsupported gate type: {gate_type}")
+
+
+def _lanes(count):
+    """
+    Returns:
+        an int with a 1 at the bottom of each of `count` LABEL_LEN-byte lanes; multiplying a packed
+        int of 0/1 lanes by _MASK turns it into a mask of whole lanes
+    """
+    return int.from_bytes((bytes(LABEL_LEN - 1) + b'\x01') * count, "big")
+
+
+def _pack(values):
+    # One int holding a LABEL_LEN-byte lane per value, the first value in the most significant lane
+    return int.from_bytes(b''.join([v.to_bytes(LABEL_LEN, "big") for v in values]), "big")
+
+
+def _unpack(packed, count):
+    buffer = memoryview(packed.to_bytes(LABEL_LEN * count, "big"))
+    return [from_bytes(buffer[i:i + LABEL_LEN]) for i in range(0, len(buffer), LABEL_LEN)]
+
+
+def _double_lanes(x, ones):
+    # _double of every lane at once: each lane's top bit is cleared before the shift and folded back
+    top = (x >> 127) & ones
+    return ((x ^ (top << 127)) << 1) ^ (top * 0x87)
+
+
+def _hash_lanes(keys, count):
+    """
+    pi(K) ^ K for every lane of the packed keys `keys`, which hold `count` lanes in total (several
+    packed ints of the same batch can be concatenated by the caller), with a single AES call
+    """
+    return int.from_bytes(_aes().update(keys.to_bytes(LABEL_LEN * count, "big")), "big") ^ keys
+
+
+def garble_gates(gate_types, zeros_a, zeros_b, offset, gate_ids):
+    """
+    Same as garble_gate for a batch of gates that do not depend on each other (e.g. one level of
+    the circuit). The AND/OR gates of the batch are garbled together: their labels are packed into
+    one int per operand, one LABEL_LEN-byte lane per gate, so every XOR, doubling and permute-bit
+    selection of the half gates is a single big-int operation, and the hashes take one AES call.
+
+    Returns:
+        zeros_c: list of 0-labels of the output wires
+        tables: list of ciphertext pairs; empty for free gates
+    """
+    zeros_c = [None] * len(gate_types)
+    tables = [()] * len(gate_types)
+    hashed = []  # positions of the gates that need the hash
+    for i, gate_type in enumerate(gate_types):
+        if gate_type == "AND" or gate_type == "OR":
+            hashed.append(i)
+        else:
+            zeros_c[i], tables[i] = garble_gate(gate_type, zeros_a[i], zeros_b[i], offset, gate_ids[i])
+    if len(hashed) < PACKED_MIN_GATES:
+        for i in hashed:
+            zeros_c[i], tables[i] = garble_gate(gate_types[i], zeros_a[i], zeros_b[i], offset, gate_ids[i])
+        return zeros_c, tables
+
+    n = len(hashed)
+    ones = _lanes(n)
+    r = offset * ones
+    # OR gates garble an AND of the negated inputs and negate the output (see garble_gate)
+    negated = _pack([_MASK if gate_types[i] == "OR" else 0 for i in hashed]) & r
+    a = _pack([zeros_a[i] for i in hashed]) ^ negated
+    b = _pack([zeros_b[i] for i in hashed]) ^ negated
+    tweak_a = _pack([2 * gate_ids[i] for i in hashed])
+    tweak_b = tweak_a ^ ones
+    key_a, key_b = _double_lanes(a, ones) ^ tweak_a, _double_lanes(b, ones) ^ tweak_b
+    # 2(X ^ R) == 2X ^ 2R, so the keys of the 1-labels only differ by 2R
+    r2 = _double(offset) * ones
+    bits = 128 * n
+    hashes = _hash_lanes((key_a << 3 * bits) | ((key_a ^ r2) << 2 * bits) | (key_b << bits) | (key_b ^ r2), 4 * n)
+    lanes = (1 << bits) - 1
+    hb1, hb0 = hashes & lanes, (hashes >> bits) & lanes
+    ha1, ha0 = (hashes >> 2 * bits) & lanes, hashes >> 3 * bits
+    # Lane masks of the permute bits of the 0-labels
+    pa, pb = (a & ones) * _MASK, (b & ones) * _MASK
+    tg = ha0 ^ ha1 ^ (r & pb)
+    te = hb0 ^ hb1 ^ a
+    zero_c = ha0 ^ (tg & pa) ^ hb0 ^ ((te ^ a) & pb) ^ negated
+    for i, z, g, e in zip(hashed, _unpack(zero_c, n), _unpack(tg, n), _unpack(te, n)):
+        zeros_c[i], tables[i] = z, (g, e)
+    return zeros_c, tables
+
+
+def evaluate_gates(gate_types, labels_a, labels_b, tables, gate_ids):
+    """
+    Same as evaluate_gate for a batch of gates that do not depend on each other. Like in
+    garble_gates, the AND/OR gates are evaluated together on packed lanes, with a single AES call.
+
+    Returns:
+        list of labels of the output wires
+    """
+    labels_c = [None] * len(gate_types)
+    hashed = []  # positions of the gates that need the hash
+    for i, gate_type in enumerate(gate_types):
+        if gate_type == "AND" or gate_type == "OR":
+            hashed.append(i)
+        else:
+            labels_c[i] = evaluate_gate(gate_type, labels_a[i], labels_b[i], tables[i], gate_ids[i])
+    if len(hashed) < PACKED_MIN_GATES:
+        for i in hashed:
+            labels_c[i] = evaluate_and(labels_a[i], labels_b[i], tables[i], gate_ids[i])
+        return labels_c
+
+    n = len(hashed)
+    ones = _lanes(n)
+    a = _pack([labels_a[i] for i in hashed])
+    b = _pack([labels_b[i] for i in hashed])
+    tweak_a = _pack([2 * gate_ids[i] for i in hashed])
+    bits = 128 * n
+    hashes = _hash_lanes(((_double_lanes(a, ones) ^ tweak_a) << bits) | (_double_lanes(b, ones) ^ tweak_a ^ ones),
+                         2 * n)
+    ha, hb = hashes >> bits, hashes & ((1 << bits) - 1)
+    tg, te = _pack([tables[i][0] for i in hashed]), _pack([tables[i][1] for i in hashed])
+    # The evaluator's permute bits select which ciphertexts to fold in
+    sa, sb = (a & ones) * _MASK, (b & ones) * _MASK
+    for i, label in zip(hashed, _unpack(ha ^ (tg & sa) ^ hb ^ ((te ^ a) & sb), n)):
+        labels_c[i] = label
+    return labels_c
+
+
+def evaluate_gate(gate_type, label_a, label_b, table, gate_id):
+    """
+    Args:
+        gate_type: one of circuit.GATE_TYPES
+        label_a: label held for the first input wire
+        label_b: label held for the second input wire (None for NOT and BUF)
+        table: ciphertexts produced by garble_gate
+        gate_id: the same integer passed to garble_gate
+
+    Returns:
+        label of the output wire
+    """
+    if gate_type == "NOT" or gate_type == "BUF":
+        # For NOT the garbler swapped the meaning of the labels, so the label passes through unchanged
+        return label_a
+    elif gate_type == "XOR" or gate_type == "XNOR":
+        return label_a ^ label_b
+    elif gate_type == "AND" or gate_type == "OR":
+        return evaluate_and(label_a, label_b, table, gate_id)
+    else:
+        raise ValueError(f"Unsupported gate type: {gate_type}")
@@ -0,0 +1,127 @@
+# metrics.py
+"""
+Per-phase measurements of a protocol run. sender.run and receiver.run (and their run_batch
+variants) record into a Metrics object and return it; pass one in to collect several runs together
+or to turn on profiling:
+
+    metrics = sender.run(3, scheme="halfgates", metrics=Metrics(profile=True))
+    print(json.dumps(metrics.as_dict(), indent=2))
+    print(metrics.profile_stats())
+
+Each phase records its wall time, the CPU time of the calling thread (worker processes are not
+included), the counters (see Metrics.count) incremented while it runs, and, when it runs over a
+FramedConnection, the bytes sent and received and the time spent waiting for messages to arrive.
+Phases may nest (e.g. "receiver deserialization" inside "receiver circuit transfer"), in which case
+the counters add to both, and a phase that runs again adds to its previous totals. Every phase is
+also a tracing.span, so it is logged when spans are enabled.
+"""
+from collections import Counter
+from contextlib import contextmanager
+import cProfile
+import io
+import pstats
+import time
+import tracemalloc
+from tracing import span
+
+_FIELDS = ("wall_seconds", "cpu_seconds", "wait_seconds", "bytes_sent", "bytes_received", "count")
+
+
+class Metrics:
+    def __init__(self, profile=False, memory=False):
+        """
+        Args:
+            profile (bool): run cProfile on the thread of the run (see profile_stats). Defaults to False.
+            memory (bool): record the peak memory allocated during the run with tracemalloc, which
+                           traces every thread of the process. Defaults to False.
+        """
+        self.phases = dict()  # name -> dictionary of _FIELDS, and "counters"
+        self.counters = Counter()
+        self._active = []  # counters of the phases running now, outermost first
+        self.peak_memory = None
+        self._profile = cProfile.Profile() if profile else None
+        self._memory = memory
+
+    def count(self, name, n=1):
+        """
+        Adds `n` to a counter, e.g. of cryptographic operations, in the totals and in every phase
+        running now
+        """
+        self.counters[name] += n
+        for counters in self._active:
+            counters[name] += n
+
+    @contextmanager
+    def phase(self, name, connection=None):
+        """
+        Measures the `with` block as the phase `name`
+
+        Args:
+            connection: FramedConnection whose traffic during the block is attributed to the phase
+        """
+        traffic = (connection.bytes_sent, connection.bytes_received, connection.wait_seconds) if connection else None
+        wall, cpu = time.perf_counter(), time.thread_time()
+        counters = Counter()
+        self._active.append(counters)
+        try:
+            with span(name):
+                yield
+        finally:
+            # By identity: Counters compare equal by content, and phases of other threads may interleave
+            del self._active[next(i for i, active in enumerate(self._active) if active is counters)]
+            totals = self.phases.setdefault(name, {**dict.fromkeys(_FIELDS, 0), "counters": Counter()})
+            totals["counters"].update(counters)
+            totals["wall_seconds"] += time.perf_counter() - wall
+            totals["cpu_seconds"] += time.thread_time() - cpu
+            totals["count"] += 1
+            if traffic is not None:
+                totals["bytes_sent"] += connection.bytes_sent - traffic[0]
+                totals["bytes_received"] += connection.bytes_received - traffic[1]
+                totals["wait_seconds"] += connection.wait_seconds - traffic[2]
+
+    @contextmanager
+    def capture(self):
+        """
+        Runs the profiler and the memory tracing requested in __init__ during the `with` block
+        """
+        started = False
+        if self._memory:
+            # Someone else may already be tracing: keep their trace running
+            started = not tracemalloc.is_tracing()
+            if started:
+                tracemalloc.start()
+            else:
+                tracemalloc.reset_peak()
+        if self._profile is not None:
+            self._profile.enable()
+        try:
+            yield self
+        finally:
+            if self._profile is not None:
+                self._profile.disable()
+            if self._memory:
+                self.peak_memory = max(self.peak_memory or 0, tracemalloc.get_traced_memory()[1])
+                if started:
+                    tracemalloc.stop()
+
+    def profile_stats(self, sort="cumulative", limit=25):
+        """
+        Returns:
+            the cProfile report of the captured runs as text, or None if profiling is off
+        """
+        if self._profile is None:
+            return None
+        out = io.StringIO()
+        pstats.Stats(self._profile, stream=out).sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def as_dict(self):
+        """
+        Returns:
+            the phases, counters and peak memory as a JSON-serializable dictionary
+        """
+        return {
+            "phases": {name: {**totals, "counters": dict(totals["counters"])} for name, totals in self.phases.items()},
+            "counters": dict(self.counters),
+            "peak_memory": self.peak_memory,
+        }
@@ -0,0 +1,207 @@
+# optimizer.py
+"""
+Optimization pass over a Circuit. Every wire is rewritten as a literal, a node plus a negation
+flag, so NOT gates disappear into the edges while the circuit is rebuilt:
+    - constants (from `constants` or from gates such as XOR(a, a)) are propagated
+    - gates not reachable from the outputs are dropped
+    - gates with the same type and inputs are merged (structural hashing); XOR and XNOR share nodes,
+      as do AND and OR
+    - NOT(NOT a), XOR(NOT a, b) and AND(NOT a, NOT b) turn into a, XNOR(a, b) and NOT(OR(a, b))
+When the circuit is emitted again, negations are only materialized where a gate needs them, as
+XNOR instead of XOR or OR instead of AND where possible, and as a NOT gate otherwise.
+"""
+from circuit import GATE_TYPES
+from circuit_library import CircuitBuilder
+from collections import Counter
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Literals are 2 * node + negated; the two constants are the only negative literals
+FALSE = -2
+TRUE = -1
+
+
+class _Nodes:
+    """
+    Hash-consed XOR and AND nodes, numbered after the wires of the original circuit
+    """
+    def __init__(self, first):
+        self.kinds = dict()  # node -> ("XOR" or "AND", literal, literal)
+        self._table = dict()
+        self._next = first
+
+    def _node(self, kind, a, b):
+        key = (kind, min(a, b), max(a, b))
+        if key not in self._table:
+            self._table[key] = self._next
+            self.kinds[self._next] = key
+            self._next += 1
+        return self._table[key] << 1
+
+    def xor(self, a, b):
+        if a < 0:
+            return b ^ (a & 1)
+        if b < 0:
+            return a ^ (b & 1)
+        negated = (a ^ b) & 1
+        a, b = a & ~1, b & ~1
+        if a == b:
+            return FALSE ^ negated
+        return self._node("XOR", a, b) ^ negated
+
+    def and_(self, a, b):
+        if a < 0:
+            return b if a == TRUE else FALSE
+        if b < 0:
+            return a if b == TRUE else FALSE
+        if a == b:
+            return a
+        if a == b ^ 1:
+            return FALSE
+        return self._node("AND", a, b)
+
+
+def optimize(circuit, constants=None):
+    """
+    Args:
+        circuit: Circuit to optimize
+        constants: dictionary of input wire -> 0 or 1 for inputs whose value is public; the wires
+                   stay in `inputs` but no gate reads them anymore
+
+    Returns:
+        an equivalent Circuit with the same input groups and the outputs in the same order; the
+        circuit itself if no constants are given and the rewrite has no fewer AND/OR gates and no
+        fewer gates overall
+    """
+    constants = constants or dict()
+    nodes = _Nodes(circuit.num_wires)
+    literal = dict()
+    for wire in circuit.input_wires:
+        literal[wire] = (TRUE if constants[wire] else FALSE) if wire in constants else wire << 1
+
+    for label in circuit.topological_order():
+        i = circuit.gate_index(label)
+        gate_type = GATE_TYPES[circuit.types[i]]
+        a = literal[circuit.input1[i]]
+        b = literal[circuit.input2[i]] if circuit.input2[i] >= 0 else None
+        if gate_type == "NOT":
+            literal[label] = a ^ 1
+        elif gate_type == "BUF":
+            literal[label] = a
+        elif gate_type == "XOR":
+            literal[label] = nodes.xor(a, b)
+        elif gate_type == "XNOR":
+            literal[label] = nodes.xor(a, b) ^ 1
+        elif gate_type == "AND":
+            literal[label] = nodes.and_(a, b)
+        elif gate_type == "OR":
+            literal[label] = nodes.and_(a ^ 1, b ^ 1) ^ 1
+        else:
+            raise ValueError(f"Unsupported gate type: {gate_type}")
+
+    optimized = _emit(circuit, nodes, [literal[wire] for wire in circuit.output_wires])
+    changes = report(circuit, optimized)
+    before, after = zip(changes["non_free"], changes["gates"])
+    if not constants and after >= before:
+        logger.info("No gates saved, keeping the circuit (%d gates)", len(circuit))
+        return circuit
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(", ".join(f"{key} {before} -> {after}" for key, (before, after) in changes.items()
+                              if key in ("gates", "non_free", "depth")))
+    return optimized
+
+
+def report(before, after):
+    """
+    Returns:
+        dictionary of every key of Circuit.stats -> (value before, value after)
+    """
+    stats_before, stats_after = before.stats(), after.stats()
+    return {key: (stats_before[key], stats_after[key]) for key in stats_before}
+
+
+def _emit(circuit, nodes, outputs):
+    """
+    Rebuilds a circuit from the nodes the output literals depend on. Going from the outputs back to
+    the inputs, each node picks the form that needs the fewest NOT gates, given the literals its
+    consumers already asked for:
+        - AND(a, b) as AND of a and b, or as OR of NOT a and NOT b, whose output is the negation
+        - XOR(a, b) as XOR or XNOR, reading whichever polarity of each input is emitted
+    """
+    reachable = set()
+    stack = [literal >> 1 for literal in outputs if literal >= 0]
+    while stack:
+        node = stack.pop()
+        if node in reachable or node not in nodes.kinds:
+            continue
+        reachable.add(node)
+        _, a, b = nodes.kinds[node]
+        stack += [a >> 1, b >> 1]
+
+    needed = set(literal for literal in outputs if literal >= 0)
+    # How many AND nodes still to be decided read each literal as it is
+    pending = Counter(literal for node in reachable if nodes.kinds[node][0] == "AND"
+                      for literal in nodes.kinds[node][1:])
+
+    def cost(literal):
+        # NOT gates added if `literal` becomes needed: its other polarity is needed, or it is a
+        # negated input wire (plain input wires and the first polarity of a node are free). A
+        # literal that another pending node reads as it is will most likely be needed anyway.
+        if literal in needed or pending[literal] > 0:
+            return 0
+        return 1 if (literal ^ 1) in needed or (literal & 1 and literal >> 1 not in nodes.kinds) else 0
+
+    forms = dict()  # node -> (gate type, literal, literal); the gate computes the node, negated for OR
+    for node in sorted(reachable, reverse=True):
+        kind, a, b = nodes.kinds[node]
+        if kind == "XOR":
+            # An XOR reads whichever polarity of its inputs ends up available, flipping between XOR
+            # and XNOR, so it does not ask for either
+            forms[node] = ("XOR", a, b)
+            continue
+        pending[a] -= 1
+        pending[b] -= 1
+        if (cost(a ^ 1) + cost(b ^ 1) + ((node << 1) in needed)
+                < cost(a) + cost(b) + (((node << 1) | 1) in needed)):
+            # NOT(AND(a, b)) == OR(NOT a, NOT b)
+            forms[node] = ("OR", a ^ 1, b ^ 1)
+        else:
+            forms[node] = ("AND", a, b)
+        needed.update(forms[node][1:])
+
+    builder = CircuitBuilder(circuit.inputs, circuit.num_wires)
+    wires = dict()  # literal -> wire in the new circuit
+    for wire in circuit.input_wires:
+        wires[wire << 1] = wire
+        if (wire << 1) | 1 in needed:
+            wires[(wire << 1) | 1] = builder.not_(wire)
+
+    def available(literal):
+        # A polarity of the literal's node that was emitted, and whether it is the negation
+        return (wires[literal], 0) if literal in wires else (wires[literal ^ 1], 1)
+
+    for node in sorted(reachable):
+        gate_type, a, b = forms[node]
+        plain, negated = node << 1, (node << 1) | 1
+        if gate_type == "XOR":
+            (wire_a, flip_a), (wire_b, flip_b) = available(a), available(b)
+            for literal in [literal for literal in (plain, negated) if literal in needed] or [plain]:
+                # XOR of the emitted wires is the node negated once per flipped input
+                same = (literal & 1) == flip_a ^ flip_b
+                wires[literal] = (builder.xor if same else builder.xnor)(wire_a, wire_b)
+        else:
+            natural = negated if gate_type == "OR" else plain
+            wires[natural] = builder.gate(gate_type, wires[a], wires[b])
+            if natural ^ 1 in needed:
+                wires[natural ^ 1] = builder.not_(wires[natural])
+
+    final = []
+    for literal in outputs:
+        if literal < 0:
+            # Constant output: a free gate that is 0 (XOR) or 1 (XNOR) whatever its input
+            wire = circuit.input_wires[0]
+            final.append(builder.xnor(wire, wire) if literal == TRUE else builder.xor(wire, wire))
+        else:
+            final.append(wires[literal])
+    return builder.build(final)
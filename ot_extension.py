@@ -0,0 +1,157 @@
+# ot_extension.py
+"""
+IKNP oblivious transfer extension (Ishai, Kilian, Nissim, Petrank 2003) on top of the
+public-key OT in `oblivious_transfer`. SECURITY base OTs are run once, with the roles of the two
+parties swapped; afterwards any number of 1-out-of-2 transfers costs only AES and SHAKE.
+
+Message flow (R chooses, S holds the pairs of messages):
+    R -> S: OTExtensionReceiver.setup()          (base OT public key)
+    S -> R: OTExtensionSender.setup(data)        (base OT selections)
+    R -> S: OTExtensionReceiver.transmit(f), OTExtensionReceiver.extend(choices)
+    S -> R: OTExtensionSender.receive(G), then OTExtensionSender.extend(u, pairs)
+    R:      OTExtensionReceiver.receive(y)       (one message per choice)
+"""
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+import hashlib
+from oblivious_transfer.ot import Alice, Bob
+import secrets
+
+SECURITY = 128  # number of base OTs, and bit length of the rows of the extension matrix
+SEED_LEN = 16
+# Below this many transfers, one public-key OT per bit is cheaper than the SECURITY base OTs
+MIN_EXTENSION_BITS = SECURITY
+
+
+def _prg(seed, offset, length):
+    """
+    Expands a base-OT seed into `length` pseudorandom bits. The AES-CTR counter starts at
+    `offset`, the number of OTs already extended, so every extension uses a fresh part of the stream.
+    """
+    encryptor = Cipher(algorithms.AES(seed), modes.CTR(offset.to_bytes(16, "big"))).encryptor()
+    stream = encryptor.update(bytes((length + 7) // 8))
+    return int.from_bytes(stream, "little") & ((1 << length) - 1)
+
+
+def _transpose(columns, length):
+    """
+    Turns SECURITY columns of `length` bits into `length` rows of SECURITY bits: bit i of row j is
+    bit j of column i.
+    """
+    # Bit strings with bit j at index j, so zip walks all the columns one row at a time
+    strings = [format(column, f"0{length}b")[::-1] for column in columns]
+    return [int("".join(bits)[::-1], 2) for bits in zip(*strings)]
+
+
+def _mask(index, row, size, session_key=b''):
+    """
+    Hashes the row of the extension matrix for OT number `index` into a `size`-byte one-time pad.
+    The session key separates the pads of different sessions that could share the same index.
+    """
+    digest = hashlib.shake_128(session_key + index.to_bytes(8, "big") + row.to_bytes(SECURITY // 8, "big"))
+    return int.from_bytes(digest.digest(size), "big")
+
+
+def _xor(message: bytes, pad):
+    return (int.from_bytes(message, "big") ^ pad).to_bytes(len(message), "big")
+
+
+class OTExtensionReceiver:
+    def __init__(self, session_key=b''):
+        """
+        The party choosing one message out of each pair. It acts as the sender of the base OTs,
+        offering two random seeds per base OT.
+
+        Args:
+            session_key: bytes shared with the sender, mixed into every pad
+        """
+        self.session_key = session_key
+        self._seeds = [(secrets.token_bytes(SEED_LEN), secrets.token_bytes(SEED_LEN)) for _ in range(SECURITY)]
+        self._alice = Alice([seed for pair in self._seeds for seed in pair], SECURITY)
+        self._offset = 0  # number of OTs extended so far
+        self._pending = None
+
+    def setup(self):
+        return self._alice.setup()
+
+    def transmit(self, f):
+        return self._alice.transmit(f)
+
+    def extend(self, choices):
+        """
+        Args:
+            choices: list of bits, one per transfer
+
+        Returns:
+            u: list of SECURITY integers to send to OTExtensionSender.extend
+        """
+        length = len(choices)
+        r = sum(bit << j for j, bit in enumerate(choices))
+        t = [_prg(seed0, self._offset, length) for seed0, _ in self._seeds]
+        u = [t_i ^ _prg(seed1, self._offset, length) ^ r for t_i, (_, seed1) in zip(t, self._seeds)]
+        self._pending = (list(choices), _transpose(t, length), self._offset)
+        self._offset += length
+        return u
+
+    def receive(self, y):
+        """
+        Args:
+            y: list of message pairs sent by OTExtensionSender.extend for the last `extend` call
+
+        Returns:
+            list with the chosen message of each pair
+        """
+        choices, rows, offset = self._pending
+        self._pending = None
+        assert len(y) == len(choices), f"Expected {len(choices)} transfers, got {len(y)}"
+        return [_xor(pair[c], _mask(offset + j, rows[j], len(pair[c]), self.session_key))
+                for j, (c, pair) in enumerate(zip(choices, y))]
+
+
+class OTExtensionSender:
+    def __init__(self, session_key=b''):
+        """
+        The party holding the pairs of messages. It acts as the receiver of the base OTs, learning
+        one seed of each pair according to its secret SECURITY-bit string s.
+
+        Args:
+            session_key: bytes shared with the receiver, mixed into every pad
+        """
+        self.session_key = session_key
+        self._s = secrets.randbits(SECURITY)
+        self._bob = Bob([2 * i + ((self._s >> i) & 1) for i in range(SECURITY)])
+        self._seeds = None
+        self._offset = 0  # number of OTs extended so far
+
+    def setup(self, data):
+        """
+        Args:
+            data: the message from OTExtensionReceiver.setup
+        """
+        return self._bob.setup(data["pubkey"]["e"], data["pubkey"]["n"], data["hashes"], data["secret_length"])
+
+    def receive(self, G):
+        self._seeds = self._bob.receive(G)
+
+    def extend(self, u, pairs):
+        """
+        Args:
+            u: the message from OTExtensionReceiver.extend
+            pairs: list of (message for 0, message for 1), one per transfer; both messages of a
+                   pair must have the same length
+
+        Returns:
+            y: list of masked pairs to send to OTExtensionReceiver.receive
+        """
+        assert self._seeds is not None, "Base OTs have not been received"
+        assert len(u) == SECURITY, f"Expected {SECURITY} columns, got {len(u)}"
+        length = len(pairs)
+        q = [_prg(seed, self._offset, length) ^ (u_i if (self._s >> i) & 1 else 0)
+             for i, (seed, u_i) in enumerate(zip(self._seeds, u))]
+        rows = _transpose(q, length)
+        y = []
+        for j, ((x0, x1), row) in enumerate(zip(pairs, rows)):
+            index = self._offset + j
+            y.append((_xor(x0, _mask(index, row, len(x0), self.session_key)),
+                      _xor(x1, _mask(index, row ^ self._s, len(x1), self.session_key))))
+        self._offset += length
+        return y
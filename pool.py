@@ -0,0 +1,164 @@
+# pool.py
+"""
+Offline/online split for the sender. A GarbledPool garbles circuits ahead of time in a background
+thread, so a request only has to pick the labels of the sender's input, run the OT and send the
+circuit. Every garbled instance is handed out once and then dropped: reusing the labels of a
+garbled circuit for a second evaluation would leak the inputs.
+"""
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def circuit_key(circuit):
+    """
+    Returns:
+        a digest identifying the gates, inputs and outputs of the circuit, so equal circuits share
+        instances; inputs that no gate reads still get labels, so they are part of the key
+    """
+    digest = hashlib.sha256()
+    for values in (circuit.types, circuit.input1, circuit.input2, circuit.output):
+        digest.update(len(values).to_bytes(8, "big"))
+        digest.update(values.tobytes())
+    digest.update(repr((circuit.inputs, circuit.output_wires)).encode())
+    return digest.hexdigest()
+
+
+class GarbledPool:
+    def __init__(self, capacity=8, scheme="halfgates", workers=None, max_circuits=4):
+        """
+        Args:
+            capacity (int): Number of garbled instances kept ready per circuit. Defaults to 8.
+            scheme (str): The garbling scheme passed to Circuit.garble. Defaults to "halfgates".
+            workers (int): Number of processes used to garble each instance, started once for the
+                           pool. Defaults to None (serial).
+            max_circuits (int): Number of different circuits kept in the pool; when a new circuit
+                                is added, the least recently used one is evicted with its instances.
+                                Defaults to 4.
+        """
+        assert capacity > 0 and max_circuits > 0, "Capacity must be positive"
+        self.capacity = capacity
+        self.scheme = scheme
+        self.workers = workers
+        self._executor = ProcessPoolExecutor(max_workers=workers) if workers else None
+        self.max_circuits = max_circuits
+        self.hits = 0
+        self.misses = 0
+        self._circuits = OrderedDict()  # key -> (circuit, deque of garbled instances), most recent last
+        self._lock = threading.Condition()
+        self._closed = False
+        self._worker = threading.Thread(target=self._refill, daemon=True)
+        self._worker.start()
+
+    def add(self, circuit):
+        """
+        Starts keeping garbled instances of the circuit ready, evicting the least recently used
+        circuit if the pool is full.
+
+        Returns:
+            the key of the circuit in the pool
+        """
+        key = circuit_key(circuit)
+        with self._lock:
+            if key in self._circuits:
+                self._circuits.move_to_end(key)
+            else:
+                while len(self._circuits) >= self.max_circuits:
+                    self._circuits.popitem(last=False)
+                self._circuits[key] = (circuit, deque())
+                self._lock.notify_all()
+        return key
+
+    def take(self, circuit):
+        """
+        Removes a garbled instance of the circuit from the pool, garbling one right away if none is
+        ready. The circuit is added to the pool if it was not in it.
+
+        Returns:
+            garbled circuit in the format of Circuit.garble, with both labels of every input wire
+        """
+        # The lock is reentrant: adding and popping happen under one acquisition, so the circuit
+        # cannot be evicted in between
+        with self._lock:
+            instances = self._circuits[self.add(circuit)][1]
+            if instances:
+                self.hits += 1
+                garbled_circuit = instances.popleft()
+                self._lock.notify_all()
+                return garbled_circuit
+            self.misses += 1
+        return circuit.garble(self.scheme, workers=self.workers, executor=self._executor)
+
+    def ready(self, circuit):
+        """
+        Returns:
+            the number of garbled instances of the circuit ready to be taken
+        """
+        with self._lock:
+            entry = self._circuits.get(circuit_key(circuit))
+            return len(entry[1]) if entry is not None else 0
+
+    def wait(self, circuit, count=None, timeout=None):
+        """
+        Blocks until `count` instances of the circuit are ready (the full capacity by default).
+
+        Returns:
+            True if they are ready, False on timeout
+        """
+        key = self.add(circuit)
+        count = self.capacity if count is None else count
+        with self._lock:
+            return self._lock.wait_for(
+                lambda: key not in self._circuits or len(self._circuits[key][1]) >= count, timeout)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._circuits.clear()
+            self._lock.notify_all()
+        self._worker.join()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _next_missing(self):
+        # Most recently used circuits are refilled first
+        for key in reversed(self._circuits):
+            circuit, instances = self._circuits[key]
+            if len(instances) < self.capacity:
+                return key, circuit
+        return None
+
+    def _refill(self):
+        while True:
+            with self._lock:
+                self._lock.wait_for(lambda: self._closed or self._next_missing() is not None)
+                if self._closed:
+                    return
+                key, circuit = self._next_missing()
+            # Garbling happens outside the lock, so take() is never blocked by it
+            try:
+                garbled_circuit = circuit.garble(self.scheme, workers=self.workers, executor=self._executor)
+            except Exception:
+                # Drop the circuit instead of retrying it forever; take() garbles it on the spot,
+                # which raises the error to the caller
+                logger.exception("Garbling a circuit for the pool failed, evicting it")
+                with self._lock:
+                    self._circuits.pop(key, None)
+                    self._lock.notify_all()
+                continue
+            with self._lock:
+                entry = self._circuits.get(key)
+                # The circuit may have been evicted while it was garbled
+                if entry is not None and len(entry[1]) < self.capacity:
+                    entry[1].append(garbled_circuit)
+                    self._lock.notify_all()
@@ -1,152 +1,497 @@
 # receiver.py (Party P_B)
-from common import SUFFIX_LEN
+from common import SUFFIX_LEN, process_pool, split_chunks
+from circuit import EvaluationPlan, PARALLEL_MIN_GATES, label_key, permute_bit
+from contextlib import contextmanager
 from cryptography.fernet import Fernet, InvalidToken
+from garbled_table import GarbledTable
+import halfgates
+from itertools import islice
+from metrics import Metrics
 from oblivious_transfer.ot import Bob
-import pickle
-from pprint_custom import CustomPrettyPrinter as CPP
+from ot_extension import OTExtensionReceiver
+import logging
+import os
 import socket
-import struct
+from tracing import pretty
+from transport import DEFAULT_BUFFER_SIZE, FramedConnection
+import wire_format
 
-# ID for printed logs coming from this file
-ME = "[RECEIVER] "
+logger = logging.getLogger(__name__)
 
 
-def solve_circuit(garbled_circuit):
+def solve_circuit(garbled_circuit, workers=None, metrics=None, executor=None):
     """
-    Approach: start from the gate with the highest value label, assuming that is the last gate.
-              Recursively decrypt the gates that are its inputs.
+    Approach: compile the garbled circuit into an EvaluationPlan (gates in topological order),
+              then evaluate every gate in a single loop.
     Args:
         garbled_circuit: garbled circuit sent by receiver (more info in Circuit.garble)
+        workers: number of processes that evaluate each level of the circuit in parallel;
+                 None evaluates everything in this process
+        metrics: Metrics that get the counts of evaluated gates, decryptions, hashes and
+                 InvalidToken failures
+        executor: ProcessPoolExecutor owned by the caller, used instead of starting `workers`
+                  processes for this call; `workers` is then the number of chunks each level is
+                  split into (defaults to the number of CPUs); it can be shared by threads
+                  evaluating other circuits at the same time (see common.process_pool)
     Returns:
-        decrypted output
+        decrypted output; a list of outputs in the circuit's order if the circuit has several
     """
-    last_gate = max(garbled_circuit.keys())
-    print(ME + f"Starting to solve circuit from gate {last_gate}")
-    return _solve_circuit(last_gate, garbled_circuit)
+    plan = EvaluationPlan.from_garbled(garbled_circuit)
+    logger.info("Solving %d gates for outputs %s", len(plan), plan.outputs)
+    with process_pool(workers, executor) as pool:
+        if pool is None:
+            labels = _solve_circuit(plan, garbled_circuit, metrics=metrics)
+        else:
+            labels = _solve_circuit(plan, garbled_circuit, pool, workers or os.cpu_count(), metrics=metrics)
+    outputs = [_decode_output(labels[gate], garbled_circuit[gate]) for gate in plan.outputs]
+    return outputs[0] if len(outputs) == 1 else outputs
 
 
-def _solve_circuit(gate, garbled_circuit):
+def solve_batch(garbled_circuit, count, workers=None, metrics=None, executor=None):
     """
-    Private recursive function that will recursively solve all gates
+    Evaluates the `count` instances of a circuit from Circuit.garble_batch, one level of all the
+    instances at a time, so each level costs a single AES call.
+    Args:
+        garbled_circuit: garbled circuit sent by receiver, with the labels of every instance assigned
+        count: number of instances
+        workers, metrics, executor: see solve_circuit
+    Returns:
+        list with the decrypted output of each instance, each in the format of solve_circuit
+    """
+    plan = EvaluationPlan.from_garbled(garbled_circuit)
+    logger.info("Solving %d instances of %d gates", count, len(plan) // count)
+    with process_pool(workers, executor) as pool:
+        if pool is None:
+            labels = _solve_circuit(plan, garbled_circuit, layered=True, metrics=metrics)
+        else:
+            labels = _solve_circuit(plan, garbled_circuit, pool, workers or os.cpu_count(), metrics=metrics)
+    # Instance k holds positions k * size to (k + 1) * size - 1 of the outputs (see Circuit.output_positions)
+    outputs = [_decode_output(labels[gate], garbled_circuit[gate]) for gate in plan.outputs]
+    if len(outputs) % count:
+        raise ValueError(f"{len(outputs)} outputs cannot be split between {count} instances")
+    size = len(outputs) // count
+    return [outputs[k * size] if size == 1 else outputs[k * size:(k + 1) * size] for k in range(count)]
+
+
+def solve_table(table, input_labels):
+    """
+    Evaluates a garbled circuit stored as a GarbledTable
+    Args:
+        table: GarbledTable, or the path of a file written by GarbledTable.save, which is mapped
+               into memory for the evaluation
+        input_labels: dictionary of input wire -> the label held for it
+    Returns:
+        decrypted output in the format of solve_circuit
+    """
+    if isinstance(table, GarbledTable):
+        return table.evaluate(input_labels)
+    with GarbledTable.load(table) as loaded:
+        return loaded.evaluate(input_labels)
+
+
+def solve_stream(garbled_inputs, chunks, metrics=None):
+    """
+    Evaluates a garbled circuit that arrives in chunks (more info in Circuit.garble_stream). Each
+    chunk is evaluated as soon as it is available and dropped afterwards, and every label is dropped
+    once the last gate reading it is evaluated, so memory is bounded by one chunk and the wires
+    still to be read.
+    Args:
+        garbled_inputs: the input wires of the garbled circuit, each holding its chosen label in `value`
+        chunks: iterable of dictionaries of garbled gates, in topological order
+        metrics: see solve_circuit
+    Returns:
+        decrypted output; a list of outputs in the circuit's order if the circuit has several
+    """
+    labels, outputs = start_stream(garbled_inputs)
+    for chunk in chunks:
+        solve_chunk(chunk, labels, outputs, metrics)
+    return stream_output(outputs)
+
+
+def start_stream(garbled_inputs):
+    """
+    Returns:
+        the evaluation state of a streamed circuit for solve_chunk: labels of the wires that are still
+        to be read and decoded outputs by position
+    """
+    return {wire: garbled_wire["value"] for wire, garbled_wire in garbled_inputs.items()}, dict()
+
+
+def solve_chunk(chunk, labels, outputs, metrics=None):
+    """
+    Evaluates one chunk of a streamed circuit, updating the state from start_stream in place and
+    dropping the labels the gates release
+    """
+    done = -1
+    try:
+        for done, (gate, garbled_gate) in enumerate(chunk.items()):
+            input1, input2 = garbled_gate["inputs"]
+            labels[gate] = _evaluate_gate(gate, garbled_gate, labels[input1],
+                                          labels[input2] if input2 is not None else None)
+            for position in garbled_gate.get("positions", ()):
+                outputs[position] = _decode_output(labels[gate], garbled_gate)
+            for wire in garbled_gate.get("release", ()):
+                labels.pop(wire, None)
+    except InvalidToken:
+        if metrics is not None:
+            metrics.count("invalid_token")
+        raise
+    finally:
+        if metrics is not None:
+            _count_work(metrics, islice(chunk.values(), done + 1))
+
+
+def stream_output(outputs):
+    """
+    Returns:
+        the output of a streamed circuit once all chunks are solved, in the format of solve_circuit
+    """
+    outputs = [outputs[position] for position in sorted(outputs)]
+    return outputs[0] if len(outputs) == 1 else outputs
+
+
+def assign_input_labels(garbled_circuit, wires, keys):
+    """
+    Puts the label obtained by OT on each of the receiver's input wires, which the sender leaves out
+    of the garbled circuit
     Args:
-        gate: label for the gate to solve in this step
         garbled_circuit: garbled circuit sent by receiver (more info in Circuit.garble)
+        wires: labels of the receiver's input wires, in the order of its input bits
+        keys: labels received by OT, one per input bit
+    """
+    if len(wires) != len(keys):
+        raise ValueError(f"Received {len(keys)} labels by OT for {len(wires)} input wires")
+    debug = logger.isEnabledFor(logging.DEBUG)
+    for i, (wire, key) in enumerate(zip(wires, keys)):
+        if wire in garbled_circuit:
+            raise ValueError(f"The garbled circuit already holds labels for input wire {wire}")
+        if debug:
+            logger.debug("Chose value for bit %d: %s", i, key[-SUFFIX_LEN:])
+        garbled_circuit[wire] = {"value": key}
+
+
+def input_choices(receiver_input, bits=2):
+    """
     Returns:
-        decrypted output of the gate
-    """
-    # Base case: gate is None (this happens in case of 'not' gate which requires only 1 input
-    if gate is None:
-        return None
-    # Base case: this gate has a value
-    if "value" in garbled_circuit[gate]:
-        value = garbled_circuit[gate]["value"]
-        print(ME + f"Gate {gate} already has a value: {value[-SUFFIX_LEN:]}")
-        return value
-    # Otherwise, try to solve gates needed to solve this one
-    assert "inputs" in garbled_circuit[gate], f"Gate {gate} has no value and does not list inputs"
-    input1 = _solve_circuit(garbled_circuit[gate]["inputs"][0], garbled_circuit)
-    input2 = _solve_circuit(garbled_circuit[gate]["inputs"][1], garbled_circuit)
-    # Use these inputs to solve for an encrypted row
-    value = None
-    for row in garbled_circuit[gate]["rows"]:
-        try:
-            # input2 may not exist if we are decrypting the not gate
-            if input2:
-                value = Fernet(input2).decrypt(Fernet(input1).decrypt(row))
-                break
+        the `bits` bits of the receiver's input, least significant first
+    """
+    if not (0 <= receiver_input < 2 ** bits and int(receiver_input) == receiver_input):
+        raise ValueError(f"Input must be a non-negative integer less than {2 ** bits}")
+    return [(receiver_input >> i) & 1 for i in range(bits)]
+
+
+def output_value(output):
+    """
+    Returns:
+        the output of solve_circuit or solve_stream as an integer, the first bit being the least
+        significant
+    """
+    bits = output if isinstance(output, list) else [output]
+    return sum(int(bit) << i for i, bit in enumerate(bits))
+
+
+def _receive_chunks(connection, metrics):
+    """
+    Yields the chunks of a streamed garbled circuit until the empty end-of-stream message
+    """
+    while serialized_data := connection.recv():
+        with metrics.phase("receiver deserialization"):
+            chunk = wire_format.load_circuit(serialized_data, extra_wires=None)
+        yield chunk
+
+
+def _decode_output(value, garbled_gate):
+    # Half-gates circuits (and classic outputs read by other gates) end in a wire label; its permute
+    # bit decodes to the plain output
+    if "decode" in garbled_gate:
+        return b'1' if (halfgates.from_bytes(value) & 1) ^ garbled_gate["decode"] else b'0'
+    return value
+
+
+def _count_work(metrics, garbled_gates):
+    """
+    Adds the cryptographic work of evaluating `garbled_gates` to the metrics: one Fernet decryption
+    per input of a classic gate, one AES hash per input of a half-gates AND/OR gate
+    """
+    gates = decrypts = hashes = 0
+    for garbled_gate in garbled_gates:
+        gates += 1
+        if "type" in garbled_gate:
+            hashes += 2 if garbled_gate["rows"] else 0
+        else:
+            decrypts += 1 if garbled_gate["inputs"][1] is None else 2
+    metrics.count("evaluated_gates", gates)
+    metrics.count("decrypt_attempts", decrypts)
+    metrics.count("aes_hashes", hashes)
+
+
+def _solve_circuit(plan, garbled_circuit, executor=None, workers=1, layered=False, metrics=None):
+    """
+    Private function that evaluates every gate of the plan in order
+    Args:
+        plan: EvaluationPlan built from the garbled circuit
+        garbled_circuit: garbled circuit sent by receiver (more info in Circuit.garble)
+        executor: if given, each level of the plan is split into `workers` chunks evaluated in
+                  separate processes
+        layered: evaluate a whole level at a time in this process, batching its AES calls; implied
+                 by `executor`
+        metrics: Metrics that get the work of the gates evaluated (also when a decryption fails)
+                 and the InvalidToken failures
+    Returns:
+        list indexed by wire label holding the label obtained for every wire
+    """
+    labels = [None] * plan.num_wires
+    # Input wires hold the label chosen by (or obliviously transferred to) the receiver
+    for wire, garbled_gate in garbled_circuit.items():
+        if "inputs" not in garbled_gate:
+            if "value" not in garbled_gate:
+                raise ValueError(f"Input wire {wire} has no value")
+            # Wires past the plan's arrays are read by no gate
+            if wire < len(labels):
+                labels[wire] = garbled_gate["value"]
+    gates, input1, input2 = plan.gates, plan.input1, plan.input2
+    levels = plan.levels() if executor is not None or layered else None
+    done = -1  # last gate (or level) handed to evaluation
+    try:
+        if levels is None:
+            for done in range(len(gates)):
+                gate = gates[done]
+                # input2 may not exist if we are decrypting the not gate
+                labels[gate] = _evaluate_gate(gate, garbled_circuit[gate], labels[input1[done]],
+                                              labels[input2[done]] if input2[done] >= 0 else None)
+            return labels
+
+        for done, level in enumerate(levels):
+            if len(level) < halfgates.PACKED_MIN_GATES:
+                # Too narrow to gain from batching (e.g. a ripple carry)
+                for i in level:
+                    labels[gates[i]] = _evaluate_gate(gates[i], garbled_circuit[gates[i]], labels[input1[i]],
+                                                      labels[input2[i]] if input2[i] >= 0 else None)
+                continue
+            level_gates = [gates[i] for i in level]
+            args = (level_gates,
+                    [garbled_circuit[gate] for gate in level_gates],
+                    [labels[input1[i]] for i in level],
+                    [labels[input2[i]] if input2[i] >= 0 else None for i in level])
+            if executor is not None and len(level) >= 2 * PARALLEL_MIN_GATES:
+                values = []
+                for chunk_values in executor.map(_evaluate_gates, *(split_chunks(a, workers, PARALLEL_MIN_GATES)
+                                                                     for a in args)):
+                    values += chunk_values
             else:
-                value = Fernet(input1).decrypt(row)
-                break
-        except InvalidToken:
-            value = None
-    assert value is not None, f"Unable to decrypt gate {gate}"
-    # Insert this value into the garbled circuit, so we don't need to re-calculate later
-    garbled_circuit[gate]["value"] = value
-    print(ME + f"Decrypted gate {gate} at row = {row[-SUFFIX_LEN:]}: {value[-SUFFIX_LEN:]}")
+                values = _evaluate_gates(*args)
+            for gate, value in zip(level_gates, values):
+                labels[gate] = value
+        return labels
+    except InvalidToken:
+        if metrics is not None:
+            metrics.count("invalid_token")
+        raise
+    finally:
+        if metrics is not None:
+            attempted = range(done + 1) if levels is None else (i for level in levels[:done + 1] for i in level)
+            _count_work(metrics, (garbled_circuit[gates[i]] for i in attempted))
+
+
+def _evaluate_gate(gate, garbled_gate, value1, value2):
+    """
+    Args:
+        gate: label of the gate
+        garbled_gate: the gate's entry in the garbled circuit
+        value1: label held for the first input wire
+        value2: label held for the second input wire (None for a single-input gate)
+    Returns:
+        label of the gate's output wire
+    """
+    # Half-gates circuits record the gate type, since free gates have no rows to decrypt
+    if "type" in garbled_gate:
+        table = [halfgates.from_bytes(row) for row in garbled_gate["rows"]]
+        value = halfgates.to_bytes(halfgates.evaluate_gate(
+            garbled_gate["type"], halfgates.from_bytes(value1),
+            halfgates.from_bytes(value2) if value2 is not None else None, table, gate))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Evaluated %s gate %d: %s", garbled_gate["type"], gate, value[-SUFFIX_LEN:])
+        return value
+    # The permute bits of the input labels point at the only row these labels can decrypt
+    rows = garbled_gate["rows"]
+    if value2 is not None:
+        row = rows[2 * permute_bit(value1) + permute_bit(value2)]
+        value = Fernet(label_key(value2)).decrypt(Fernet(label_key(value1)).decrypt(row))
+    else:
+        row = rows[permute_bit(value1)]
+        value = Fernet(label_key(value1)).decrypt(row)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Decrypted gate %d at row = %s: %s", gate, row[-SUFFIX_LEN:], value[-SUFFIX_LEN:])
     return value
 
 
+def _evaluate_gates(gates, garbled_gates, values1, values2):
+    """
+    Evaluates a batch of gates that do not depend on each other; runs in worker processes in
+    parallel mode. Half-gates batches share a single AES call (see halfgates.evaluate_gates).
+    Returns:
+        list of labels of the gates' output wires
+    """
+    if not all("type" in garbled_gate for garbled_gate in garbled_gates):
+        return [_evaluate_gate(*args) for args in zip(gates, garbled_gates, values1, values2)]
+    labels = halfgates.evaluate_gates(
+        [garbled_gate["type"] for garbled_gate in garbled_gates],
+        [halfgates.from_bytes(value) for value in values1],
+        [halfgates.from_bytes(value) if value is not None else None for value in values2],
+        [[halfgates.from_bytes(row) for row in garbled_gate["rows"]] for garbled_gate in garbled_gates],
+        gates)
+    return [halfgates.to_bytes(label) for label in labels]
+
+
 # Receive garbled circuit from sender and evaluate
-def run(receiver_input, host="localhost", port=9999, store_output=None):
+def run(receiver_input, host="localhost", port=9999, store_output=None, workers=None,
+        buffer_size=DEFAULT_BUFFER_SIZE, nodelay=True, metrics=None, server=None):
     """
     Receives a garbled circuit from the sender and evaluates it.
 
     Args:
-        receiver_input: 0-3; the intended 2-bit input for the receiver
+        receiver_input: non-negative integer that fits in the receiver's input group, whose size the
+                        sender announces
         host (str): The host address to listen on. Defaults to "localhost".
         port (int): The port number to listen on. Defaults to 9999.
+        workers (int): Number of processes used to evaluate the circuit. Defaults to None (serial).
+        buffer_size (int): Initial size of the receive buffer, reused for every message. Defaults to
+                           DEFAULT_BUFFER_SIZE.
+        nodelay (bool): Disable Nagle's algorithm on the connection. Defaults to True.
+        metrics (Metrics): Record the phases of the run into this object. Defaults to None, which
+                           records into a new one.
+        server (socket): Listening socket to accept the sender on instead of binding `host`:`port`,
+                         e.g. bound before running the receiver in another thread, so the sender
+                         cannot connect before it listens. Left open. Defaults to None.
+
+    Returns:
+        Metrics of the run
     """
-    assert 0 <= receiver_input <= 3 and int(receiver_input) == receiver_input, \
-        "Input must be a positive integer less than 4"
-
-    # Create a server socket and start listening for connections
-    with socket.create_server((host, port)) as server:
-        print(ME + f"Waiting to receive connection from sender...")
-        # Accept initial connection from sender
-        connection, _ = server.accept()
-        with connection:
-            print(ME + "Connected with sender")
-            # First message from sender contains the public key for OT
-            serialized_data = b''
-            while serialized_data == b'':
-                serialized_data = connection.recv(4096)
-            data = pickle.loads(serialized_data)
-            print(ME + f"Received first message from sender")
-
-            # Bob must choose 2 keys for the 2 bits in his number
-            # bit1 * 2^1 + bit2 * 2^0 = receiver_input
-            bit1 = 1 if receiver_input >= 2 else 0
-            bit2 = (receiver_input & 0b1) + 2
-            bob = Bob([bit1, bit2])
-            f = bob.setup(data["pubkey"]["e"], data["pubkey"]["n"], data["hashes"], data["secret_length"])
-            serialized_data = pickle.dumps({"f": f})
-            connection.sendall(serialized_data)
-            print(ME + f"Sending selections to the sender...")
-
-            # Receive the size of the incoming data first
-            raw_msglen = connection.recv(4)
-            if not raw_msglen:
-                raise ValueError("Invalid message length received")
-            msglen = struct.unpack('!I', raw_msglen)[0]
-
-            # Receive the actual data based on the length
-            serialized_data = b''
-            while len(serialized_data) < msglen:
-                packet = connection.recv(4096)
-                if not packet:
-                    break
-                serialized_data += packet
-            print(ME + "Received garbled circuit from the sender")
-
-            data = pickle.loads(serialized_data)
-            G = data["G"]
-            garbled_circuit = data["garbled_circuit"]
-            key2, key3 = bob.receive(G)
-            # Find where these keys belong in the garbled circuit
-            print(ME + f"My input is {receiver_input}")
-            found = [False, False]
-            for gate_label in garbled_circuit:
-                if "value" in garbled_circuit[gate_label]:
-                    if key2 in garbled_circuit[gate_label]["value"]:
-                        print(ME + f"Chose value for bit 0: {key2[-SUFFIX_LEN:]}")
-                        garbled_circuit[gate_label]["value"] = key2
-                        found[0] = True
-                    elif key3 in garbled_circuit[gate_label]["value"]:
-                        print(ME + f"Chose value for bit 1: {key3[-SUFFIX_LEN:]}")
-                        garbled_circuit[gate_label]["value"] = key3
-                        found[1] = True
-                if found == [True, True]:
-                    break
-            assert found == [True, True], "Decrypted keys were not found in garbled circuit"
-
-            print("Garbled circuit just before solving:")
-            CPP(indent=1).pprint(garbled_circuit)
-
-            # Try to solve the circuit
-            output = solve_circuit(garbled_circuit)
-            print(f"[{ME}] Decrypted output: {output}")
-
-            # Store output (used to verify solution in tests)
-            if store_output is not None:
-                store_output[0] = output
+    metrics = Metrics() if metrics is None else metrics
+    with metrics.capture(), _accept(host, port, server, buffer_size=buffer_size, nodelay=nodelay) as connection:
+        # Bob must choose one key per bit of the input, as many bits as the sender announced
+        garbled_circuit, data = _receive_garbled(connection, lambda data: input_choices(receiver_input, data["bits"]),
+                                                 metrics)
+        logger.debug("My input is %d", receiver_input)
+        logger.debug("Garbled circuit just before solving:\n%s", pretty(garbled_circuit))
+
+        # Try to solve the circuit; a streamed circuit is evaluated chunk by chunk as it arrives
+        with metrics.phase("receiver evaluation", connection):
+            if data.get("stream"):
+                output = solve_stream(garbled_circuit, _receive_chunks(connection, metrics), metrics)
+            else:
+                output = solve_circuit(garbled_circuit, workers, metrics)
+        logger.info("Decrypted output: %s", output)
+
+    # Store output (used to verify solution in tests)
+    if store_output is not None:
+        store_output[0] = output
+    return metrics
+
+
+def run_batch(receiver_inputs, host="localhost", port=9999, store_output=None, workers=None,
+              buffer_size=DEFAULT_BUFFER_SIZE, nodelay=True, metrics=None, server=None):
+    """
+    Receives the instances garbled by sender.run_batch and evaluates them all, the k-th with
+    receiver_inputs[k].
+
+    Args:
+        receiver_inputs: list of non-negative integers that fit in the receiver's input group, as
+                         many as the sender has inputs
+        host, port, workers, buffer_size, nodelay, metrics, server: see run
+        store_output: list whose first item is set to the list of decrypted outputs
+
+    Returns:
+        Metrics of the run
+    """
+    def choices(data):
+        if data.get("count") != len(receiver_inputs):
+            raise ValueError(f"The sender has {data.get('count')} inputs, the receiver {len(receiver_inputs)}")
+        bits = data["bits"] // data["count"]
+        return [bit for receiver_input in receiver_inputs for bit in input_choices(receiver_input, bits)]
+
+    metrics = Metrics() if metrics is None else metrics
+    with metrics.capture(), _accept(host, port, server, buffer_size=buffer_size, nodelay=nodelay) as connection:
+        garbled_circuit, _ = _receive_garbled(connection, choices, metrics)
+        with metrics.phase("receiver evaluation", connection):
+            outputs = solve_batch(garbled_circuit, len(receiver_inputs), workers, metrics)
+        logger.info("Decrypted %d outputs", len(outputs))
+
+    if store_output is not None:
+        store_output[0] = outputs
+    return metrics
+
+
+@contextmanager
+def _accept(host, port, server=None, **transport_options):
+    """
+    Listens on `host`:`port`, or on the already listening socket `server`, and yields the
+    FramedConnection of the first sender to connect
+    """
+    if server is None:
+        # Create a server socket and start listening for connections
+        with socket.create_server((host, port)) as server:
+            with _accept(host, port, server, **transport_options) as connection:
+                yield connection
+        return
+    logger.info("Waiting to receive connection from sender...")
+    # Accept initial connection from sender
+    connection, _ = server.accept()
+    with FramedConnection(connection, **transport_options) as connection:
+        logger.info("Connected with sender")
+        yield connection
+
+
+def _receive_garbled(connection, choose, metrics):
+    """
+    Runs the OT for the receiver's input labels and receives the garbled circuit.
+
+    Args:
+        connection: FramedConnection to the sender
+        choose: function from the sender's first message to the list of choice bits
+        metrics: Metrics of the run
+
+    Returns:
+        garbled_circuit: the garbled circuit (only its input wires when streamed) with the
+                         receiver's labels assigned
+        data: last message of the OT, which lists the receiver's input wires and says whether the
+              circuit is streamed
+    """
+    with metrics.phase("receiver OT", connection):
+        # First message from sender says which OT is used, with the public key for base OT
+        data = wire_format.loads(connection.recv())
+        logger.info("Received first message from sender")
+
+        choices = choose(data)
+        metrics.count("ot_transfers", len(choices))
+        if data["ot"] == "extension":
+            # Run the base OTs as their sender, then extend them to one OT per input bit
+            extension = OTExtensionReceiver()
+            with metrics.phase("receiver OT setup"):
+                setup = extension.setup()
+            connection.send(wire_format.dumps(setup))
+            data = wire_format.loads(connection.recv())
+            connection.send(wire_format.dumps({"G": extension.transmit(data["f"]), "u": extension.extend(choices)}))
+            logger.info("Sending base OTs and extension to the sender...")
+            data = wire_format.loads(connection.recv())
+            keys = extension.receive(data["y"])
+        else:
+            # Choice i picks one of the two labels at positions 2i and 2i + 1
+            bob = Bob([2 * i + bit for i, bit in enumerate(choices)])
+            with metrics.phase("receiver OT setup"):
+                f = bob.setup(data["pubkey"]["e"], data["pubkey"]["n"], data["hashes"], data["secret_length"])
+            serialized_data = wire_format.dumps({"f": f})
+            connection.send(serialized_data)
+            logger.info("Sending selections to the sender...")
+            data = wire_format.loads(connection.recv())
+            keys = bob.receive(data["G"])
+    with metrics.phase("receiver circuit transfer", connection):
+        serialized_data = connection.recv()
+        with metrics.phase("receiver deserialization"):
+            # A streamed circuit starts with its input wires only, and is evaluated with dictionaries
+            garbled_circuit = wire_format.load_circuit(serialized_data, None if data["stream"] else len(keys))
+    logger.info("Received garbled circuit from the sender")
 
+    # The keys belong on the input wires the sender listed, in order
+    assign_input_labels(garbled_circuit, data["wires"], keys)
+    return garbled_circuit, data
@@ -3,8 +3,10 @@ import receiver
 import sender
 from threading import Thread
 import time
+import tracing
 
 if __name__ == "__main__":
+    tracing.configure(spans=True)
     sender_input = int(input("Enter the value for the sender's input (0-3): "))
     receiver_input = int(input("Enter the value for the receiver's input (0-3): "))
 
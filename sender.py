@@ -1,19 +1,20 @@
 # sender.py (Party P_A)
 from common import SUFFIX_LEN
 from oblivious_transfer.ot import Alice
-import pickle
-from pprint_custom import CustomPrettyPrinter as CPP
-import socket
+import logging
 from circuit import Circuit, Gate
-import struct
+from metrics import Metrics
+from ot_extension import MIN_EXTENSION_BITS, OTExtensionSender
+from tracing import pretty
+from transport import DEFAULT_BUFFER_SIZE, FramedConnection
+import wire_format
 
-# ID for printed logs coming from this file
-ME = "[SENDER] "
+logger = logging.getLogger(__name__)
 
 
 def get_comparator_circuit():
     # this circuit will compare two 2-bit inputs a, b, and return 1 a < b
-    # Inputs are 0-3, output is 12
+    # Inputs are 0-3 (0 and 2 are the most significant bits of a and b), output is 12
     return [
         Gate("NOT", 0, None, 4),
         Gate("AND", 2, 4, 5),  # b1 & a1'
@@ -27,63 +28,250 @@ def get_comparator_circuit():
     ]
 
 
-def run(sender_input, host="localhost", port=9999):
+def comparator():
+    """
+    Returns:
+        the circuit of get_comparator_circuit, with the sender's input on wires [1, 0] and the
+        receiver's on wires [3, 2] (least significant bit first)
+    """
+    return Circuit(get_comparator_circuit(), inputs=[[1, 0], [3, 2]])
+
+
+def garble_input(circuit, sender_input, scheme="classic", workers=None, stream=False, chunk_size=1024,
+                 executor=None):
+    """
+    Garbles the circuit and keeps only the labels of the sender's own input.
+
+    Args:
+        circuit: Circuit to garble; its first input group belongs to the sender
+        sender_input: non-negative integer that fits in the sender's input group
+        scheme, workers, stream, chunk_size: see run
+        executor: see Circuit.garble
+
+    Returns:
+        garbled_circuit: the garbled circuit (only its input wires when streaming)
+        chunks: generator of the remaining chunks of gates when streaming, otherwise None
+    """
+    chunks = None
+    if stream:
+        if scheme != "halfgates":
+            raise ValueError("Streaming requires the halfgates scheme")
+        chunks = circuit.garble_stream(chunk_size, workers=workers, executor=executor)
+        # Only the input wires are garbled up front; the gates follow after the OT
+        garbled_circuit = next(chunks)
+    else:
+        garbled_circuit = circuit.garble(scheme, workers=workers, executor=executor)
+    logger.debug("Initial garbled circuit:\n%s", pretty(garbled_circuit))
+
+    return select_input(circuit, garbled_circuit, sender_input), chunks
+
+
+def select_input(circuit, garbled_circuit, sender_input, instance=0):
+    """
+    Keeps only the labels of the sender's own input on its input wires (the online part of
+    garbling, e.g. for a circuit taken from a pool.GarbledPool).
+
+    Args:
+        instance: number of the instance in a circuit from Circuit.garble_batch
+
+    Returns:
+        garbled_circuit, updated in place
+    """
+    logger.debug("My input is %d", sender_input)
+    debug = logger.isEnabledFor(logging.DEBUG)
+    for i, (wire, bit) in enumerate(circuit.input_bits(sender_input, group=0)):
+        wire = circuit.batch_wire(wire, instance)
+        garbled_circuit[wire]["value"] = garbled_circuit[wire]["value"][bit]
+        if debug:
+            logger.debug("Chose value for bit %d: %s", i, garbled_circuit[wire]["value"][-SUFFIX_LEN:])
+    return garbled_circuit
+
+
+def take_receiver_labels(circuit, garbled_circuit, instance=0):
+    """
+    Removes the receiver's input wires from the garbled circuit, so their labels only reach the
+    receiver through the OT: with both labels of a wire, the receiver would learn the Free-XOR offset
+    and with it the sender's input.
+
+    Args:
+        instance: number of the instance in a circuit from Circuit.garble_batch
+
+    Returns:
+        wires: labels of the receiver's input wires, least significant bit first
+        pairs: the (zero, one) labels of each of these wires
+    """
+    wires = [circuit.batch_wire(wire, instance) for wire in circuit.inputs[1]]
+    return wires, [garbled_circuit.pop(wire)["value"] for wire in wires]
+
+
+def send_circuit(connection, garbled_circuit, chunks, scheme, metrics=None):
+    """
+    Sends the garbled circuit over a FramedConnection, followed by the streamed chunks and an empty
+    end-of-stream message if `chunks` is given.
+
+    Args:
+        metrics: Metrics that get the serialization time and the number of garbled gates and rows
+    """
+    # A wire still holding both labels would let the receiver bypass the OT (see take_receiver_labels)
+    if any(isinstance(entry.get("value"), tuple) for entry in garbled_circuit.values()):
+        raise ValueError("The garbled circuit still holds both labels of an input wire")
+
+    def dump(piece):
+        if metrics is None:
+            return wire_format.dump_circuit(piece, scheme)
+        gates = [entry for entry in piece.values() if "inputs" in entry]
+        metrics.count("garbled_gates", len(gates))
+        metrics.count("garbled_rows", sum(len(entry["rows"]) for entry in gates))
+        with metrics.phase("sender serialization"):
+            return wire_format.dump_circuit(piece, scheme)
+
+    connection.send(dump(garbled_circuit))
+    if chunks is not None:
+        # Each chunk is garbled only when the previous one has been handed to the socket
+        for chunk in chunks:
+            connection.send(dump(chunk))
+        # An empty message marks the end of the circuit
+        connection.send(b'')
+
+
+def run(sender_input, host="localhost", port=9999, scheme="classic", workers=None, stream=False,
+        chunk_size=1024, ot_extension=None, pool=None, circuit=None, buffer_size=DEFAULT_BUFFER_SIZE,
+        nodelay=True, cork=False, metrics=None):
     """
     Constructs and sends a garbled circuit to a receiver.
 
     Args:
-        sender_input: 0-3; the intended 2-bit input for the sender
+        sender_input: non-negative integer that fits in the sender's input group
         host (str): The host address to listen on. Defaults to "localhost".
         port (int): The port number to listen on. Defaults to 9999.
+        scheme (str): The garbling scheme passed to Circuit.garble. Defaults to "classic".
+        workers (int): Number of processes used to garble the circuit. Defaults to None (serial).
+        stream (bool): Garble the gates while sending them in chunks of `chunk_size`, instead of
+                       sending the whole circuit at once (halfgates scheme only). Defaults to False.
+        chunk_size (int): Number of gates per streamed chunk. Defaults to 1024.
+        ot_extension (bool): Transfer the receiver's labels with IKNP OT extension instead of one
+                             public-key OT per bit. Defaults to None, which uses the extension
+                             once the receiver has at least MIN_EXTENSION_BITS input bits.
+        pool (GarbledPool): Take a pre-garbled circuit from this pool instead of garbling it now,
+                            using the pool's scheme. Cannot be combined with `stream`.
+                            Defaults to None.
+        circuit (Circuit): Circuit with two input groups, the sender's and the receiver's (e.g. from
+                           circuit_library). Defaults to None, the 2-bit comparator a < b.
+        buffer_size (int): Initial size of the receive buffer. Defaults to DEFAULT_BUFFER_SIZE.
+        nodelay (bool): Disable Nagle's algorithm on the connection. Defaults to True.
+        cork (bool): Send the last OT message and the circuit in full TCP segments (Linux only).
+                     Defaults to False.
+        metrics (Metrics): Record the phases of the run into this object. Defaults to None, which
+                           records into a new one.
+
+    Returns:
+        Metrics of the run
     """
-    assert 0 <= sender_input <= 3 and int(sender_input) == sender_input, \
-        "Input must be a positive integer less than 4"
+    metrics = Metrics() if metrics is None else metrics
+    circuit = comparator() if circuit is None else circuit
+    assert len(circuit.inputs) == 2, "The circuit must have one input group per party"
+    with metrics.capture():
+        if pool is not None:
+            if stream:
+                raise ValueError("Pre-garbled circuits cannot be streamed")
+            scheme = pool.scheme
+            garbled_circuit, chunks = select_input(circuit, pool.take(circuit), sender_input), None
+        else:
+            # Streamed gates are garbled while they are sent, so that time counts as circuit transfer
+            with metrics.phase("sender garbling"):
+                garbled_circuit, chunks = garble_input(circuit, sender_input, scheme, workers, stream, chunk_size)
+
+        wires, pairs = take_receiver_labels(circuit, garbled_circuit)
+        _send_garbled(host, port, garbled_circuit, chunks, wires, pairs, scheme, ot_extension, metrics, stream,
+                      buffer_size=buffer_size, nodelay=nodelay, cork=cork)
+    return metrics
+
 
-    gates = get_comparator_circuit()
-    circuit = Circuit(gates)
-    garbled_circuit = circuit.garble()
-    print("Initial garbled circuit:")
-    CPP(indent=1).pprint(garbled_circuit)
+def run_batch(sender_inputs, host="localhost", port=9999, ot_extension=None, circuit=None,
+              buffer_size=DEFAULT_BUFFER_SIZE, nodelay=True, cork=False, metrics=None):
+    """
+    Evaluates the circuit once per input, pairing sender_inputs[k] with the k-th input of
+    receiver.run_batch, over a single connection: the instances are garbled together with
+    Circuit.garble_batch (halfgates scheme), the receiver's labels of every instance go through one
+    OT, and the receiver gets one output per instance.
 
-    # Choose sender's input w0,w1 where w0 ** 2^1 + w1 ** 2^0 == input
-    print(ME + f"My input is {sender_input}")
-    garbled_circuit[0]["value"] = garbled_circuit[0]["value"][int(sender_input >= 2)]
-    print(ME + f"Chose value for bit 0: {garbled_circuit[0]['value'][-SUFFIX_LEN:]}")
-    garbled_circuit[1]["value"] = garbled_circuit[1]["value"][sender_input & 0b1]
-    print(ME + f"Chose value for bit 1: {garbled_circuit[1]['value'][-SUFFIX_LEN:]}")
+    Args:
+        sender_inputs: list of non-negative integers that fit in the sender's input group
+        host, port, ot_extension, circuit, buffer_size, nodelay, cork, metrics: see run
 
-    print(ME + "Initiating contact with the receiver...")
+    Returns:
+        Metrics of the run
+    """
+    metrics = Metrics() if metrics is None else metrics
+    circuit = comparator() if circuit is None else circuit
+    assert len(circuit.inputs) == 2, "The circuit must have one input group per party"
+    count = len(sender_inputs)
+    with metrics.capture():
+        with metrics.phase("sender garbling"):
+            garbled_circuit = circuit.garble_batch(count)
+            for instance, sender_input in enumerate(sender_inputs):
+                select_input(circuit, garbled_circuit, sender_input, instance)
+        wires, pairs = [], []
+        for instance in range(count):
+            instance_wires, instance_pairs = take_receiver_labels(circuit, garbled_circuit, instance)
+            wires += instance_wires
+            pairs += instance_pairs
+        _send_garbled(host, port, garbled_circuit, None, wires, pairs, "halfgates", ot_extension, metrics,
+                      announce={"count": count}, buffer_size=buffer_size, nodelay=nodelay, cork=cork)
+    return metrics
+
+
+def _send_garbled(host, port, garbled_circuit, chunks, wires, pairs, scheme, ot_extension, metrics, stream=False,
+                  announce=None, **transport_options):
+    """
+    Connects to the receiver, transfers the labels of `pairs` by OT, then sends the circuit, which no
+    longer holds the receiver's input `wires`. `announce` adds entries to the first message.
+    """
+    logger.info("Initiating contact with the receiver...")
 
     # Create a socket connection to the receiver
-    with socket.create_connection((host, port)) as server:
-
-        # Send first set of data for OT
-        # Allow receiver to choose 2 inputs, 1 from the first 2 and 1 from the last 2
-        alice = Alice([garbled_circuit[2]["value"][0], garbled_circuit[2]["value"][1],
-                       garbled_circuit[3]["value"][0], garbled_circuit[3]["value"][1]], 2)
-        data = alice.setup()
-        serialized_data = pickle.dumps(data)
-        print(ME + f"Sending initial OT data to the receiver...")
-        server.sendall(serialized_data)
-
-        # Get OT message back from Bob and send him the final info
-        serialized_data = b''
-        while serialized_data == b'':
-            serialized_data = server.recv(4096)
-        data = pickle.loads(serialized_data)
-        print(ME + f"Received selection from receiver")
-        f = data["f"]
-        G = alice.transmit(f)
-        data = {
-            "G": G,
-            "garbled_circuit": garbled_circuit
-        }
-        print(ME + "Sending final msg for OT and the garbled circuit...")
-        serialized_data = pickle.dumps(data)
-        
-        # Send data length first
-        server.sendall(struct.pack('!I', len(serialized_data)))
-        # Then send actual data
-        server.sendall(serialized_data)
-        print(ME + "Done")
+    announce = {"bits": len(pairs), **(announce or dict())}
+    with FramedConnection.connect(host, port, **transport_options) as server:
+
+        with metrics.phase("sender OT", server):
+            metrics.count("ot_transfers", len(pairs))
+            # The receiver obliviously chooses one label of each of its input wires
+            if ot_extension is None:
+                ot_extension = len(pairs) >= MIN_EXTENSION_BITS
+            if ot_extension:
+                # The receiver runs the base OTs as their sender, so it sends the OT public key
+                server.send(wire_format.dumps({"ot": "extension", **announce}))
+                extension = OTExtensionSender()
+                data = wire_format.loads(server.recv())
+                logger.info("Received base OT setup from receiver")
+                with metrics.phase("sender OT setup"):
+                    f = extension.setup(data)
+                server.send(wire_format.dumps({"f": f}))
+                data = wire_format.loads(server.recv())
+                logger.info("Received base OTs and extension from receiver")
+                extension.receive(data["G"])
+                data = {"y": extension.extend(data["u"], pairs)}
+            else:
+                # Send first set of data for OT
+                # Allow receiver to choose one label of each pair, at positions 2i and 2i + 1
+                alice = Alice([label for pair in pairs for label in pair], len(pairs))
+                with metrics.phase("sender OT setup"):
+                    data = alice.setup()
+                serialized_data = wire_format.dumps({"ot": "base", **announce, **data})
+                logger.info("Sending initial OT data to the receiver...")
+                server.send(serialized_data)
 
+                # Get OT message back from Bob and send him the final info
+                data = wire_format.loads(server.recv())
+                logger.info("Received selection from receiver")
+                f = data["f"]
+                G = alice.transmit(f)
+                data = {"G": G}
+        # The receiver puts the label obtained for bit i on wires[i]
+        data["wires"] = wires
+        data["stream"] = stream
+        logger.info("Sending final msg for OT and the garbled circuit...")
+        with metrics.phase("sender circuit transfer", server), server.corked():
+            server.send(wire_format.dumps(data))
+            send_circuit(server, garbled_circuit, chunks, scheme, metrics)
+        logger.info("Done")
@@ -0,0 +1,264 @@
+# session.py
+"""
+Long-lived sessions that run many secure evaluations over one connection. The base OTs and a
+session key are set up once per connection; every evaluation afterwards only costs an OT extension
+and the garbled circuit itself.
+
+Message flow per connection (S is the sender/garbler, R the receiver/evaluator):
+    R -> S: {"nonce"} and the base OT public key (OTExtensionReceiver.setup)
+    S -> R: {"nonce", "f"}
+    R -> S: {"G"}
+    then, for every evaluation:
+    S -> R: {"op": "evaluate", "bits": n}
+    R -> S: {"u"}
+    S -> R: {"y", "wires", "stream"} and the garbled circuit, without the receiver's input wires (chunks and an empty message when streaming)
+    R -> S: {"evaluated": count}
+    and finally S -> R: {"op": "close"}, or simply closes the connection.
+If the receiver fails, it answers the next message it owes with {"error": message} and closes the
+connection, and the sender raises SessionError.
+The session key is the hash of both nonces, so neither party alone picks it.
+"""
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import logging
+from ot_extension import OTExtensionReceiver, OTExtensionSender
+import receiver
+import secrets
+import sender
+from tracing import span
+from transport import FramedConnection, recv_async, send_async
+import wire_format
+
+logger = logging.getLogger(__name__)
+
+NONCE_LEN = 16
+DEFAULT_TIMEOUT = 60.0  # seconds the sender waits on the socket before giving up
+
+
+class SessionError(ConnectionError):
+    """
+    The peer of a session failed and closed the connection
+    """
+
+
+def session_key(receiver_nonce, sender_nonce):
+    return hashlib.sha256(receiver_nonce + sender_nonce).digest()[:16]
+
+
+def _solve_payload(payload, labels, outputs):
+    receiver.solve_chunk(wire_format.load_circuit(payload, extra_wires=None), labels, outputs)
+
+
+class ReceiverService:
+    def __init__(self, receiver_input, host="localhost", port=9999, workers=None, on_output=None):
+        """
+        Receiver that stays up and evaluates circuits for any number of senders, each of which can
+        request any number of evaluations over its connection.
+
+        Args:
+            receiver_input: non-negative integer that fits in the receiver's input group of every
+                            circuit, or a function called with no arguments that returns the
+                            input for the next evaluation
+            host (str): The host address to listen on. Defaults to "localhost".
+            port (int): The port number to listen on; 0 picks a free port. Defaults to 9999.
+            workers (int): Number of processes used to evaluate each circuit, started once for the
+                           service. Defaults to None (serial).
+            on_output: function called with the output of every evaluation
+        """
+        self.receiver_input = receiver_input
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.on_output = on_output
+        self._server = None
+        self._executor = None
+
+    async def start(self):
+        if self.workers:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("Listening on %s:%d", self.host, self.port)
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def _next_input(self):
+        return self.receiver_input() if callable(self.receiver_input) else self.receiver_input
+
+    async def _handle(self, reader, writer):
+        try:
+            await self._serve(reader, writer)
+        except Exception as e:
+            # Tell the sender instead of leaving it waiting for a reply that never comes
+            logger.exception("Session failed")
+            try:
+                await send_async(writer, wire_format.dumps({"error": f"{type(e).__name__}: {e}"}))
+            except (ConnectionError, OSError):
+                pass
+        finally:
+            writer.close()
+
+    async def _serve(self, reader, writer):
+        with span("session handshake"):
+            extension = await self._handshake(reader, writer)
+        count = 0
+        while True:
+            try:
+                request = wire_format.loads(await recv_async(reader))
+            except asyncio.IncompleteReadError:
+                break
+            if request["op"] == "close":
+                break
+            elif request["op"] == "evaluate":
+                with span("session evaluation"):
+                    await self._evaluate(reader, writer, extension, request["bits"])
+                count += 1
+                await send_async(writer, wire_format.dumps({"evaluated": count}))
+            else:
+                raise ValueError(f"Unsupported request: {request['op']}")
+        logger.info("Session closed after %d evaluations", count)
+
+    async def _handshake(self, reader, writer):
+        """
+        Runs the base OTs of the session, once per connection
+        """
+        extension = OTExtensionReceiver()
+        nonce = secrets.token_bytes(NONCE_LEN)
+        # Key generation for the base OTs is slow, so it must not block the other sessions
+        setup = await asyncio.to_thread(extension.setup)
+        await send_async(writer, wire_format.dumps({"nonce": nonce, **setup}))
+        data = wire_format.loads(await recv_async(reader))
+        extension.session_key = session_key(nonce, data["nonce"])
+        G = await asyncio.to_thread(extension.transmit, data["f"])
+        await send_async(writer, wire_format.dumps({"G": G}))
+        logger.info("Session established with the sender")
+        return extension
+
+    async def _evaluate(self, reader, writer, extension, bits):
+        receiver_input = self._next_input()
+        choices = receiver.input_choices(receiver_input, bits)
+        # The OT extension and decoding scale with the input and the circuit, so like evaluation
+        # they run off the event loop, which keeps serving the other sessions meanwhile
+        u = await asyncio.to_thread(extension.extend, choices)
+        await send_async(writer, wire_format.dumps({"u": u}))
+        data = wire_format.loads(await recv_async(reader))
+        keys = await asyncio.to_thread(extension.receive, data["y"])
+        garbled_circuit = await asyncio.to_thread(wire_format.load_circuit, await recv_async(reader),
+                                                  None if data["stream"] else len(keys))
+        receiver.assign_input_labels(garbled_circuit, data["wires"], keys)
+        if data["stream"]:
+            labels, outputs = receiver.start_stream(garbled_circuit)
+            while payload := await recv_async(reader):
+                await asyncio.to_thread(_solve_payload, payload, labels, outputs)
+            output = receiver.stream_output(outputs)
+        else:
+            output = await asyncio.to_thread(receiver.solve_circuit, garbled_circuit, self.workers,
+                                             executor=self._executor)
+        logger.info("Decrypted output: %s", output)
+        if self.on_output is not None:
+            self.on_output(output)
+
+
+class SenderSession:
+    def __init__(self, host="localhost", port=9999, scheme="halfgates", workers=None, pool=None, circuit=None,
+                 timeout=DEFAULT_TIMEOUT, **transport_options):
+        """
+        Connection to a ReceiverService over which the sender requests any number of evaluations.
+
+        Args:
+            host (str): The host address of the receiver. Defaults to "localhost".
+            port (int): The port number of the receiver. Defaults to 9999.
+            scheme (str): The garbling scheme passed to Circuit.garble. Defaults to "halfgates".
+            workers (int): Number of processes used to garble each circuit, started once for the
+                           session. Defaults to None (serial).
+            pool (GarbledPool): Take pre-garbled circuits from this pool, using its scheme, for the
+                                evaluations that are not streamed. Defaults to None.
+            circuit (Circuit): see sender.run
+            timeout (float): Seconds to wait for the receiver when connecting and on every message,
+                             after which socket.timeout is raised; None waits forever. Defaults to
+                             DEFAULT_TIMEOUT.
+            transport_options: buffer_size, nodelay and cork, see FramedConnection
+        """
+        self.scheme = pool.scheme if pool is not None else scheme
+        self.pool = pool
+        self.workers = workers
+        self.circuit = sender.comparator() if circuit is None else circuit
+        assert len(self.circuit.inputs) == 2, "The circuit must have one input group per party"
+        self._connection = FramedConnection.connect(host, port, timeout=timeout, **transport_options)
+        self._extension = OTExtensionSender()
+        try:
+            self._handshake()
+        except BaseException:
+            self._connection.close()
+            raise
+        self._executor = ProcessPoolExecutor(max_workers=workers) if workers else None
+
+    def _recv(self):
+        """
+        Returns:
+            the next message of the receiver; raises SessionError if it reports a failure
+        """
+        data = wire_format.loads(self._connection.recv())
+        if "error" in data:
+            raise SessionError(f"The receiver closed the session: {data['error']}")
+        return data
+
+    def _handshake(self):
+        data = self._recv()
+        nonce = secrets.token_bytes(NONCE_LEN)
+        self._extension.session_key = session_key(data["nonce"], nonce)
+        self._connection.send(wire_format.dumps({"nonce": nonce, "f": self._extension.setup(data)}))
+        self._extension.receive(self._recv()["G"])
+        logger.info("Session established with the receiver")
+
+    def evaluate(self, sender_input, stream=False, chunk_size=1024):
+        """
+        Garbles a fresh copy of the circuit and has the receiver evaluate it. Returns once the
+        receiver has finished.
+
+        Args:
+            sender_input: non-negative integer that fits in the sender's input group
+            stream, chunk_size: see sender.run
+        """
+        if self.pool is not None and not stream:
+            garbled_circuit = sender.select_input(self.circuit, self.pool.take(self.circuit), sender_input)
+            chunks = None
+        else:
+            garbled_circuit, chunks = sender.garble_input(self.circuit, sender_input, self.scheme, self.workers,
+                                                          stream, chunk_size, self._executor)
+        wires, pairs = sender.take_receiver_labels(self.circuit, garbled_circuit)
+        self._connection.send(wire_format.dumps({"op": "evaluate", "bits": len(pairs)}))
+        data = self._recv()
+        y = self._extension.extend(data["u"], pairs)
+        with self._connection.corked():
+            self._connection.send(wire_format.dumps({"y": y, "wires": wires, "stream": stream}))
+            sender.send_circuit(self._connection, garbled_circuit, chunks, self.scheme)
+        return self._recv()["evaluated"]
+
+    def close(self):
+        try:
+            self._connection.send(wire_format.dumps({"op": "close"}))
+        except OSError:
+            # The receiver already closed the connection (e.g. after reporting an error)
+            pass
+        finally:
+            self._connection.close()
+            if self._executor is not None:
+                self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
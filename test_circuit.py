@@ -0,0 +1,417 @@
+import benchmark
+import pytest
+from bristol import parse_bristol
+from garbled_table import GarbledTable
+from pool import GarbledPool, circuit_key
+from circuit import Circuit, Gate, PARALLEL_MIN_GATES
+import circuit_library
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from cryptography.fernet import InvalidToken
+from metrics import Metrics
+import optimizer
+import random
+import receiver
+import sender
+import socket
+from transport import FramedConnection
+import wire_format
+
+
+# 2-bit adder in Bristol Fashion: a = wires 0-1, b = wires 2-3 (least significant bit first),
+# sum = wires 10-11
+ADDER_2BIT = """\
+8 12
+2 2 2
+1 2
+
+2 1 0 2 4 XOR
+2 1 0 2 5 AND
+2 1 1 3 6 XOR
+2 1 6 5 7 XOR
+1 1 7 8 INV
+1 1 8 9 INV
+1 1 4 10 EQW
+1 1 9 11 EQW
+"""
+
+
+def evaluate(circuit, values, scheme="halfgates", workers=None, executor=None):
+    """
+    Garbles the circuit, keeps the label matching each value of `values` (one list of bits per
+    input group) and evaluates it
+    """
+    garbled_circuit = circuit.garble(scheme, workers=workers, executor=executor)
+    for group, bits in zip(circuit.inputs, values):
+        for wire, bit in zip(group, bits):
+            garbled_circuit[wire]["value"] = garbled_circuit[wire]["value"][bit]
+    return receiver.solve_circuit(garbled_circuit, workers, executor=executor)
+
+
+@pytest.mark.parametrize("a, b", [(a, b) for a in range(4) for b in range(4)])
+def test_bristol_adder(a, b):
+    circuit = parse_bristol(ADDER_2BIT.splitlines())
+    assert len(circuit) == 8
+    assert circuit.inputs == [[0, 1], [2, 3]]
+    assert circuit.output_wires == [10, 11]
+    output = evaluate(circuit, [[a & 1, a >> 1], [b & 1, b >> 1]])
+    total = (a + b) % 4
+    assert output == [str(total & 1).encode(), str(total >> 1).encode()]
+
+
+def test_parallel_wide_circuit():
+    """
+    A level wide enough to be split across worker processes, mixing free and non-free gates
+    """
+    width = 2 * PARALLEL_MIN_GATES
+    types = ["AND", "OR", "XOR", "XNOR"]
+    gates = [Gate(types[i % 4], i, width + i, 2 * width + i) for i in range(width)]
+    a = [random.getrandbits(1) for _ in range(width)]
+    b = [random.getrandbits(1) for _ in range(width)]
+    circuit = Circuit(gates, inputs=[list(range(width)), list(range(width, 2 * width))])
+    ops = [lambda x, y: x & y, lambda x, y: x | y, lambda x, y: x ^ y, lambda x, y: 1 - (x ^ y)]
+    truth = [str(ops[i % 4](a[i], b[i])).encode() for i in range(width)]
+    assert evaluate(circuit, [a, b], workers=2) == truth
+    # A caller-owned executor is reused across garbling and evaluating several circuits
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        for _ in range(2):
+            assert evaluate(circuit, [a, b], workers=2, executor=executor) == truth
+        # and shared by threads, which garble and evaluate the narrow levels themselves
+        deep = circuit_library.adder(64, low_depth=True)
+        pairs = [(random.getrandbits(64), random.getrandbits(64)) for _ in range(4)]
+        with ThreadPoolExecutor(max_workers=len(pairs)) as threads:
+            results = list(threads.map(
+                lambda x, y: evaluate(deep, [[x >> i & 1 for i in range(64)], [y >> i & 1 for i in range(64)]],
+                                      workers=2, executor=executor), *zip(*pairs)))
+        assert [receiver.output_value(output) for output in results] == [x + y for x, y in pairs]
+
+
+def test_threaded_hashing():
+    """
+    Threads garbling and evaluating a level at a time at once each hash with their own AES encryptor
+    """
+    circuit = circuit_library.adder(64, low_depth=True)
+
+    def garble_and_solve(a, b):
+        garbled_circuit = circuit.garble("halfgates", layered=True)
+        for wire, bit in circuit.input_bits(a) + circuit.input_bits(b, 1):
+            garbled_circuit[wire]["value"] = garbled_circuit[wire]["value"][bit]
+        return receiver.output_value(receiver.solve_batch(garbled_circuit, 1)[0])
+
+    pairs = [(random.getrandbits(64), random.getrandbits(64)) for _ in range(6)]
+    with ThreadPoolExecutor(max_workers=len(pairs)) as threads:
+        results = list(threads.map(garble_and_solve, *zip(*pairs)))
+    assert results == [a + b for a, b in pairs]
+
+
+def test_layered_garbling():
+    """
+    Garbling a level at a time evaluates the same as the default topological order
+    """
+    circuit = circuit_library.adder(8, low_depth=True)
+    assert circuit.stats()["depth"] > 2
+    for a, b in [(0, 0), (255, 1), (173, 94)]:
+        outputs = []
+        for layered in (False, True):
+            garbled_circuit = circuit.garble("halfgates", layered=layered)
+            for wire, bit in circuit.input_bits(a) + circuit.input_bits(b, 1):
+                garbled_circuit[wire]["value"] = garbled_circuit[wire]["value"][bit]
+            outputs.append(receiver.solve_circuit(garbled_circuit))
+        assert outputs[0] == outputs[1] and receiver.output_value(outputs[1]) == a + b
+
+
+@pytest.mark.parametrize("scheme", ["classic", "halfgates"])
+def test_wire_format_roundtrip(scheme):
+    circuit = parse_bristol(ADDER_2BIT.splitlines())
+    garbled_circuit = circuit.garble(scheme)
+    # The sender's own input wires hold only the chosen label
+    for wire in circuit.inputs[0]:
+        garbled_circuit[wire]["value"] = garbled_circuit[wire]["value"][1]
+    serialized = wire_format.dump_circuit(garbled_circuit, scheme)
+    assert wire_format.load_circuit(serialized) == garbled_circuit
+
+    # A label length that does not match the scheme, and an input wire without labels
+    header = wire_format.MAGIC + bytes([wire_format.VERSION, wire_format.KIND_CIRCUIT])
+    with pytest.raises(ValueError):
+        wire_format.load_circuit(serialized[:len(header) + 1] + bytes([1]) + serialized[len(header) + 2:])
+    with pytest.raises(ValueError):
+        wire_format.load_circuit(header + bytes([serialized[len(header)], serialized[len(header) + 1], 1, 0, 0, 0]))
+    # A wire label far beyond the wires in the message, which would size the evaluator's arrays
+    if scheme == "halfgates":
+        huge = {0: {"value": bytes(16)}, 1 << 40: {"type": "NOT", "inputs": [0, None], "rows": [], "positions": [0]}}
+        with pytest.raises(ValueError):
+            wire_format.load_circuit(wire_format.dump_circuit(huge, scheme))
+
+    message = {"pubkey": {"e": 65537, "n": 2 ** 2048 + 1}, "G": [[-1, b'\x00' * 16], (None, True)], "s": "x"}
+    assert wire_format.loads(wire_format.dumps(message)) == message
+
+
+@pytest.mark.parametrize("scheme", ["classic", "halfgates"])
+def test_output_order(scheme):
+    """
+    Outputs are decoded in the circuit's order, including an output read by another gate and a
+    repeated one, and a gate that leads to no output is not reported
+    """
+    gates = [Gate("AND", 0, 1, 2), Gate("XOR", 2, 1, 3), Gate("OR", 0, 1, 4)]
+    circuit = Circuit(gates, outputs=[3, 2, 3], inputs=[[0], [1]])
+    for a, b in [(0, 0), (0, 1), (1, 0), (1, 1)]:
+        truth = [str((a & b) ^ b).encode(), str(a & b).encode(), str((a & b) ^ b).encode()]
+        garbled_circuit = circuit.garble(scheme)
+        for wire, bit in ((0, a), (1, b)):
+            garbled_circuit[wire]["value"] = garbled_circuit[wire]["value"][bit]
+        received = wire_format.load_circuit(wire_format.dump_circuit(garbled_circuit, scheme))
+        assert receiver.solve_circuit(received) == truth
+        if scheme == "halfgates":
+            chunks = circuit.garble_stream(chunk_size=1)
+            garbled_inputs = next(chunks)
+            for wire, bit in ((0, a), (1, b)):
+                garbled_inputs[wire]["value"] = garbled_inputs[wire]["value"][bit]
+            assert receiver.solve_stream(garbled_inputs, chunks) == truth
+
+
+def test_stream_releases_labels():
+    """
+    A streamed evaluation only keeps the labels of the wires that are still to be read
+    """
+    circuit = circuit_library.adder(32)
+    a, b = 3_000_000_000, 1_234_567_890
+    chunks = circuit.garble_stream(chunk_size=16)
+    garbled_inputs = next(chunks)
+    for wire, bit in circuit.input_bits(a) + circuit.input_bits(b, 1):
+        garbled_inputs[wire]["value"] = garbled_inputs[wire]["value"][bit]
+    labels, outputs = receiver.start_stream(garbled_inputs)
+    sizes = []
+    for chunk in chunks:
+        receiver.solve_chunk(wire_format.load_circuit(wire_format.dump_circuit(chunk, "halfgates"), None), labels,
+                             outputs)
+        sizes.append(len(labels))
+    assert receiver.output_value(receiver.stream_output(outputs)) == a + b
+    assert max(sizes) <= len(circuit.input_wires) + 16 and not labels
+
+
+@pytest.mark.parametrize("scheme", ["classic", "halfgates"])
+def test_transmitted_labels(scheme):
+    """
+    The circuit the sender transmits holds one label per input wire: the receiver's labels only
+    come from the OT
+    """
+    circuit = circuit_library.adder(4)
+    garbled_circuit, _ = sender.garble_input(circuit, 9, scheme)
+    wires, pairs = sender.take_receiver_labels(circuit, garbled_circuit)
+    serialized = wire_format.dump_circuit(garbled_circuit, scheme)
+    # Wire labels are bounded by the wires in the message and the receiver's input wires
+    with pytest.raises(ValueError):
+        wire_format.load_circuit(serialized)
+    transmitted = wire_format.load_circuit(serialized, len(wires))
+    inputs = {wire: entry["value"] for wire, entry in transmitted.items() if "inputs" not in entry}
+    assert set(inputs) == set(circuit.inputs[0])
+    assert all(isinstance(value, bytes) for value in inputs.values())
+
+    keys = [pair[bit] for pair, bit in zip(pairs, receiver.input_choices(5, len(wires)))]
+    receiver.assign_input_labels(transmitted, wires, keys)
+    assert receiver.output_value(receiver.solve_circuit(transmitted)) == 9 + 5
+    with pytest.raises(ValueError):
+        receiver.assign_input_labels(transmitted, wires, keys)
+
+    # Every sending path (base OT, OT extension, sessions, batches) refuses to send label pairs
+    left, right = socket.socketpair()
+    with FramedConnection(left, nodelay=False) as connection, right:
+        with pytest.raises(ValueError):
+            sender.send_circuit(connection, circuit.garble(scheme), None, scheme)
+
+
+def test_garbled_pool():
+    adder = parse_bristol(ADDER_2BIT.splitlines())
+    negation = Circuit([Gate("NOT", 0, None, 1)])
+    with GarbledPool(capacity=3, max_circuits=1) as pool:
+        assert pool.wait(adder, timeout=30)
+        assert pool.ready(adder) == 3
+        first, second = pool.take(adder), pool.take(adder)
+        # Instances are single use: every one has fresh labels
+        assert first[0]["value"] != second[0]["value"]
+        assert pool.hits == 2
+        for group, bits in zip(adder.inputs, [[1, 0], [1, 1]]):
+            for wire, bit in zip(group, bits):
+                first[wire]["value"] = first[wire]["value"][bit]
+        assert receiver.solve_circuit(first) == [b'0', b'0']
+
+        # Adding a second circuit evicts the first one and its instances
+        assert pool.wait(negation, timeout=30)
+        assert pool.ready(adder) == 0
+
+    # Circuits that only differ in an input no gate reads, or in the grouping of their inputs, do
+    # not share instances
+    unread = Circuit([Gate("NOT", 0, None, 1)], inputs=[[0], [2]])
+    regrouped = Circuit([Gate("AND", 0, 1, 2)], inputs=[[0, 1]])
+    assert len({circuit_key(c) for c in (negation, unread, regrouped,
+                                           Circuit([Gate("AND", 0, 1, 2)], inputs=[[0], [1]]))}) == 4
+
+
+def test_garbled_pool_errors(caplog):
+    """
+    A circuit that fails to garble is logged and evicted, the refill thread keeps running, and
+    take() raises the error
+    """
+    def fail(*args, **kwargs):
+        raise RuntimeError("garbling failed")
+
+    broken = Circuit([Gate("NOT", 0, None, 1)])
+    broken.garble = fail
+    adder = parse_bristol(ADDER_2BIT.splitlines())
+    with GarbledPool(capacity=2) as pool:
+        pool.add(broken)
+        # Returns once the broken circuit is evicted
+        assert pool.wait(broken, timeout=30) and pool.ready(broken) == 0
+        assert "garbling failed" in caplog.text
+        assert pool.wait(adder, timeout=30)
+        with pytest.raises(RuntimeError):
+            pool.take(broken)
+
+
+GENERATED = [
+    (circuit_library.less_than, lambda a, b: int(a < b)),
+    (lambda bits: circuit_library.less_than(bits, low_depth=True), lambda a, b: int(a < b)),
+    (circuit_library.equality, lambda a, b: int(a == b)),
+    (circuit_library.adder, lambda a, b: a + b),
+    (lambda bits: circuit_library.adder(bits, low_depth=True), lambda a, b: a + b),
+    (circuit_library.hamming_distance, lambda a, b: bin(a ^ b).count("1")),
+    (circuit_library.minimum, min),
+    (lambda bits: circuit_library.maximum(bits, low_depth=True), max),
+]
+
+
+@pytest.mark.parametrize("generator, reference", GENERATED)
+def test_circuit_library(generator, reference):
+    circuit = generator(5)
+    for a, b in [(0, 0), (31, 31), (7, 8), (8, 7), (19, 22), (30, 1)]:
+        values = [[bit for _, bit in circuit.input_bits(value, group)] for group, value in enumerate((a, b))]
+        assert receiver.output_value(evaluate(circuit, values)) == reference(a, b), f"{a}, {b}"
+
+
+def test_circuit_library_mux():
+    circuit = circuit_library.mux(4)
+    for a, b, s in [(5, 10, 0), (5, 10, 1), (15, 0, 1)]:
+        values = [[(value >> i) & 1 for i in range(len(group))] for group, value in zip(circuit.inputs, (a, b, s))]
+        assert receiver.output_value(evaluate(circuit, values)) == (b if s else a)
+
+
+def test_circuit_library_stats():
+    bits = 32
+    assert circuit_library.less_than(bits).stats()["non_free"] == bits
+    assert circuit_library.adder(bits).stats()["non_free"] == bits
+    assert circuit_library.equality(bits).stats()["non_free"] == bits - 1
+    assert circuit_library.mux(bits).stats()["non_free_depth"] == 1
+    assert circuit_library.hamming_distance(bits).stats()["non_free"] < bits
+    assert circuit_library.less_than(bits, low_depth=True).stats()["non_free_depth"] == 6
+    assert circuit_library.adder(bits, low_depth=True).stats()["non_free_depth"] == 6
+
+
+def test_optimizer():
+    # Bristol adder: the INV pairs and EQW buffers disappear
+    circuit = parse_bristol(ADDER_2BIT.splitlines(), optimize=True)
+    assert len(circuit) < 8 and circuit.stats()["non_free"] == 1
+    for a, b in [(1, 3), (2, 2), (3, 0)]:
+        output = evaluate(circuit, [[a & 1, a >> 1], [b & 1, b >> 1]])
+        assert receiver.output_value(output) == (a + b) % 4
+
+    # Duplicate gates, double negation, OR of negations and a constant input
+    gates = [
+        Gate("AND", 0, 1, 3), Gate("AND", 1, 0, 4), Gate("XOR", 3, 4, 5),   # 5 == 0
+        Gate("NOT", 0, None, 6), Gate("NOT", 6, None, 7),                  # 7 == a
+        Gate("NOT", 1, None, 8), Gate("OR", 6, 8, 9),                       # 9 == NOT(a & b)
+        Gate("OR", 5, 9, 10), Gate("XNOR", 7, 10, 11), Gate("AND", 11, 2, 12),
+    ]
+    circuit = Circuit(gates, inputs=[[0, 1, 2]])
+    optimized = optimizer.optimize(circuit)
+    assert optimized.stats()["non_free"] < circuit.stats()["non_free"]
+    for value in range(8):
+        bits = [[(value >> i) & 1 for i in range(3)]]
+        assert evaluate(optimized, bits) == evaluate(circuit, bits)
+    fixed = optimizer.optimize(circuit, constants={2: 0})
+    assert fixed.stats()["non_free"] == 0
+    assert evaluate(fixed, [[1, 1, 0]]) == b'0'
+
+    # Constant inputs with both schemes: an input no gate reads anymore, the highest one included,
+    # and a constant output emitted as XOR(w, w)
+    adder = optimizer.optimize(circuit_library.adder(4), {0: 1, 7: 0})
+    for scheme in ("classic", "halfgates"):
+        for a, b in [(5, 2), (15, 6)]:
+            garbled_circuit = sender.garble_input(adder, a | 1, scheme)[0]
+            for wire, bit in adder.input_bits(b, 1):
+                garbled_circuit[wire]["value"] = garbled_circuit[wire]["value"][bit]
+            assert receiver.output_value(receiver.solve_circuit(garbled_circuit)) == (a | 1) + (b & 7)
+    circuit = Circuit([Gate("AND", 0, 1, 2), Gate("XOR", 2, 1, 3)], outputs=[2, 3], inputs=[[0], [1]])
+    fixed = optimizer.optimize(circuit, {0: 0})
+    for scheme in ("classic", "halfgates"):
+        for b in (0, 1):
+            assert evaluate(fixed, [[0], [b]], scheme) == [b'0', str(b).encode()]
+
+
+def test_benchmark_smoke():
+    report = benchmark.run(sizes=[60], ot_bits=[4], repeat=1, workers=[1, 2])
+    circuit_results = [r for r in report["results"] if r["benchmark"] == "circuit"]
+    names = ("comparator", "adder10", "adder10_low_depth")
+    assert {(r["circuit"], r["scheme"], r["workers"]) for r in circuit_results} == \
+        {(name, scheme, 1) for name in names for scheme in ("classic", "halfgates")} | \
+        {(name, "halfgates", 2) for name in names}
+    assert all(r["garble_gates_per_sec"] > 0 and r["bytes_per_gate"] > 0 for r in circuit_results)
+    assert all(r["layered_garble_speedup"] > 0 for r in circuit_results if r["scheme"] == "halfgates" and
+               r["workers"] == 1)
+    assert {r["protocol"] for r in report["results"] if r["benchmark"] == "ot"} == {"base", "extension"}
+
+
+def test_framed_connection():
+    """
+    Messages larger than the receive buffer grow it, and every message keeps its boundaries
+    """
+    with socket.create_server(("localhost", 0)) as server:
+        port = server.getsockname()[1]
+        client = FramedConnection.connect("localhost", port, buffer_size=16, cork=True)
+        connection = FramedConnection(server.accept()[0], buffer_size=16)
+        with client, connection:
+            messages = [b'', b'small', bytes(range(256)) * 1000, b'', b'last']
+            with client.corked():
+                for message in messages:
+                    client.send(message)
+            assert [bytes(connection.recv()) for _ in messages] == messages
+            client.close()
+            with pytest.raises(ConnectionError):
+                connection.recv()
+
+
+def test_garbled_table(tmp_path):
+    circuit = circuit_library.adder(8)
+    table = GarbledTable.garble(circuit)
+    a, b = 200, 99
+    labels = {wire: table.label_pair(wire)[bit] for wire, bit in circuit.input_bits(a) + circuit.input_bits(b, 1)}
+    assert receiver.output_value(table.evaluate(labels)) == a + b
+
+    # Saved without the label pairs and mapped back into memory for the evaluator
+    table.save(tmp_path / "adder.gt", input_labels=False)
+    with GarbledTable.load(tmp_path / "adder.gt") as loaded:
+        assert not loaded.input_labels
+        assert receiver.output_value(loaded.evaluate(labels)) == a + b
+    assert receiver.output_value(receiver.solve_table(tmp_path / "adder.gt", labels)) == a + b
+    with pytest.raises(KeyError):
+        table.label_pair(circuit.output_wires[0])
+
+    # Tables converted from the dictionary format evaluate the same
+    garbled_circuit = circuit.garble("halfgates")
+    converted = GarbledTable.from_buffer(GarbledTable.from_garbled(garbled_circuit).dumps())
+    labels = {wire: converted.label_pair(wire)[bit] for wire, bit in circuit.input_bits(a) + circuit.input_bits(b, 1)}
+    assert receiver.output_value(converted.evaluate(labels)) == a + b
+    with pytest.raises(ValueError):
+        GarbledTable.from_garbled(circuit.garble("classic"))
+
+
+def test_invalid_token_metrics():
+    circuit = parse_bristol(ADDER_2BIT.splitlines())
+    garbled_circuit = circuit.garble("classic")
+    for wire in circuit.input_wires:
+        garbled_circuit[wire]["value"] = garbled_circuit[wire]["value"][0]
+    gate = circuit.topological_order()[0]
+    garbled_circuit[gate]["rows"] = [row[:-4] + b'AAAA' for row in garbled_circuit[gate]["rows"]]
+    metrics = Metrics()
+    with pytest.raises(InvalidToken):
+        receiver.solve_circuit(garbled_circuit, metrics=metrics)
+    assert metrics.counters["invalid_token"] == 1
+    assert metrics.counters["evaluated_gates"] == 1 and metrics.counters["decrypt_attempts"] >= 1
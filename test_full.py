@@ -1,27 +1,265 @@
 # test_full.py
+import asyncio
+from circuit import Circuit
+import circuit_library
+from contextlib import contextmanager
+import json
+import logging
+from metrics import Metrics
+from pool import GarbledPool
 import pytest
 import receiver
 import sender
+import session
+import socket
+import tracing
 from threading import Thread
 
 
-testdata = [(i, j) for i in range(4) for j in range(4)]
+@contextmanager
+def receiving(run, *args, **kwargs):
+    """
+    Binds a free port, then runs the receiver function `run` on it in another thread until the
+    block exits, so the sender cannot connect before the receiver listens
+
+    Yields:
+        the port to connect the sender to
+    """
+    with socket.create_server(("localhost", 0)) as server:
+        # A sender that fails before connecting must not leave the receiver waiting forever
+        server.settimeout(60)
+        receiver_thread = Thread(target=run, args=args, kwargs={**kwargs, "server": server})
+        receiver_thread.start()
+        try:
+            yield server.getsockname()[1]
+        finally:
+            receiver_thread.join()
+
+
+testdata = [(i, j, scheme) for i in range(4) for j in range(4) for scheme in ("classic", "halfgates")]
 
 
-@pytest.mark.parametrize("sender_input, receiver_input", testdata)
-def test_2bit_comparator(sender_input, receiver_input):
+@pytest.mark.parametrize("sender_input, receiver_input, scheme", testdata)
+def test_2bit_comparator(sender_input, receiver_input, scheme):
     """
     End-to-end test that validates correct answers for all 2-bit values in the comparator a < b
     """
     truth = b'1' if sender_input < receiver_input else b'0'
     output = [None]
 
-    receiver_thread = Thread(target=receiver.run, args=(receiver_input,), kwargs={'store_output': output})
-    receiver_thread.start()
+    with receiving(receiver.run, receiver_input, store_output=output) as port:
+        sender.run(sender_input, scheme=scheme, port=port)
+
+    assert truth == output[0], f"Invalid: {sender_input} < {receiver_input}"
+
+
+@pytest.mark.parametrize("scheme", ["classic", "halfgates"])
+def test_logging(caplog, scheme):
+    """
+    Per-gate messages and span timings appear at DEBUG
+    """
+    caplog.set_level(logging.DEBUG)
+    # Restored afterwards, so the span level does not leak into other tests
+    previous = tracing.SPANS.level
+    tracing.SPANS.setLevel(logging.INFO)
+    try:
+        output = [None]
+        with receiving(receiver.run, 1, store_output=output) as port:
+            sender.run(0, scheme=scheme, port=port)
+    finally:
+        tracing.SPANS.setLevel(previous)
+    messages = caplog.text
+    assert output[0] == b'1'
+    assert "Decrypted output" in messages and "sender OT took" in messages
+    assert ("Decrypted gate" if scheme == "classic" else "Evaluated AND gate") in messages
+
+
+@pytest.mark.parametrize("sender_input, receiver_input", [(i, j) for i in range(4) for j in range(4)])
+def test_2bit_comparator_stream(sender_input, receiver_input):
+    """
+    Same as test_2bit_comparator, with the garbled gates streamed a few at a time
+    """
+    truth = b'1' if sender_input < receiver_input else b'0'
+    output = [None]
+
+    with receiving(receiver.run, receiver_input, store_output=output) as port:
+        sender.run(sender_input, scheme="halfgates", stream=True, chunk_size=2, port=port)
 
-    sender.run(sender_input)
+    assert truth == output[0], f"Invalid: {sender_input} < {receiver_input}"
 
-    receiver_thread.join()
+
+@pytest.mark.parametrize("sender_input, receiver_input", [(0, 3), (2, 1), (3, 3)])
+def test_2bit_comparator_ot_extension(sender_input, receiver_input):
+    """
+    Same as test_2bit_comparator, transferring the receiver's labels with OT extension
+    """
+    truth = b'1' if sender_input < receiver_input else b'0'
+    output = [None]
+
+    with receiving(receiver.run, receiver_input, store_output=output) as port:
+        sender.run(sender_input, scheme="halfgates", ot_extension=True, port=port)
 
     assert truth == output[0], f"Invalid: {sender_input} < {receiver_input}"
 
+
+@pytest.mark.parametrize("ot_extension", [False, True])
+def test_8bit_adder(ot_extension):
+    """
+    End-to-end run of a generated circuit wider than the default comparator
+    """
+    output = [None]
+    with receiving(receiver.run, 201, store_output=output) as port:
+        sender.run(117, scheme="halfgates", circuit=circuit_library.adder(8), ot_extension=ot_extension, port=port)
+
+    assert receiver.output_value(output[0]) == 117 + 201
+
+
+ADDER = circuit_library.adder(2)
+# Outputs out of wire order, most significant bit first
+REVERSED_ADDER = Circuit.from_arrays(ADDER.types, ADDER.input1, ADDER.input2, ADDER.output,
+                                     outputs=ADDER.output_wires[::-1], inputs=ADDER.inputs)
+
+
+@pytest.mark.parametrize("circuit, reference", [(None, lambda a, b: int(a < b)),
+                                                (circuit_library.adder(4), lambda a, b: a + b),
+                                                (REVERSED_ADDER, lambda a, b: int(f"{a + b:03b}"[::-1], 2))])
+def test_batch(circuit, reference):
+    """
+    Every pair of inputs of a batch is evaluated over one connection, with one OT
+    """
+    sender_inputs, receiver_inputs = [a for a in range(4) for _ in range(4)], [b for _ in range(4) for b in range(4)]
+    output = [None]
+    with receiving(receiver.run_batch, receiver_inputs, store_output=output) as port:
+        sender.run_batch(sender_inputs, circuit=circuit, port=port)
+
+    assert [receiver.output_value(value) for value in output[0]] == \
+        [reference(a, b) for a, b in zip(sender_inputs, receiver_inputs)]
+
+
+def test_metrics():
+    """
+    Both parties return per-phase timings, traffic and crypto counts
+    """
+    result = [None]
+    with receiving(lambda **kwargs: result.__setitem__(0, receiver.run(2, **kwargs))) as port:
+        sent = sender.run(1, scheme="halfgates", port=port, metrics=Metrics(profile=True, memory=True))
+    received = result[0]
+    assert set(sent.phases) >= {"sender garbling", "sender OT", "sender circuit transfer", "sender serialization"}
+    assert set(received.phases) >= {"receiver OT", "receiver circuit transfer", "receiver evaluation"}
+    # The last OT message travels with the circuit, so only the totals of both sides match
+    assert sum(phase["bytes_sent"] for phase in sent.phases.values()) == \
+        sum(phase["bytes_received"] for phase in received.phases.values()) > 0
+    assert sent.counters["ot_transfers"] == received.counters["ot_transfers"] == 2
+    # The comparator has 7 AND/OR gates, each hashing both of its input labels
+    assert received.counters["aes_hashes"] == 14 and received.counters["invalid_token"] == 0
+    # Counters are also attributed to the phases that ran them
+    assert sent.phases["sender OT"]["counters"]["ot_transfers"] == received.phases["receiver OT"]["counters"]["ot_transfers"] == 2
+    assert received.phases["receiver evaluation"]["counters"]["aes_hashes"] == 14
+    assert "aes_hashes" not in received.phases["receiver OT"]["counters"]
+    assert json.loads(json.dumps(received.as_dict()))["phases"]["receiver evaluation"]["counters"]["aes_hashes"] == 14
+    assert sent.peak_memory > 0 and "garble_input" in sent.profile_stats()
+
+
+def test_2bit_comparator_pool():
+    """
+    Same as test_2bit_comparator, with circuits garbled ahead of time by a GarbledPool
+    """
+    with GarbledPool(capacity=2) as pool:
+        for sender_input, receiver_input in [(0, 3), (2, 1), (1, 1)]:
+            truth = b'1' if sender_input < receiver_input else b'0'
+            output = [None]
+            with receiving(receiver.run, receiver_input, store_output=output) as port:
+                sender.run(sender_input, pool=pool, port=port)
+            assert truth == output[0], f"Invalid: {sender_input} < {receiver_input}"
+
+
+@contextmanager
+def serving(service):
+    """
+    Runs the ReceiverService on an event loop in another thread until the block exits
+    """
+    loop = asyncio.new_event_loop()
+    loop_thread = Thread(target=loop.run_forever)
+    loop_thread.start()
+    try:
+        asyncio.run_coroutine_threadsafe(service.start(), loop).result()
+        yield service
+    finally:
+        if service._server is not None:
+            asyncio.run_coroutine_threadsafe(service.stop(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        loop_thread.join()
+        loop.close()
+
+
+def run_sessions(configurations, run_session):
+    """
+    Runs run_session(*args) for every configuration in its own thread
+
+    Returns:
+        dictionary of configuration -> the result of run_session, or the exception it raised,
+        checked by the caller since a failure in a thread does not fail the test
+    """
+    results = dict()
+
+    def run(args):
+        try:
+            results[args] = run_session(*args)
+        except Exception as e:
+            results[args] = e
+
+    threads = [Thread(target=run, args=(args,)) for args in configurations]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_session_service():
+    """
+    One long-lived receiver serving several concurrent senders, each running several evaluations
+    over its connection
+    """
+    receiver_input = 2
+    outputs = []
+    service = session.ReceiverService(receiver_input, port=0, on_output=outputs.append)
+
+    def run_session(scheme, stream):
+        with session.SenderSession(port=service.port, scheme=scheme) as sender_session:
+            return [sender_session.evaluate(sender_input, stream=stream, chunk_size=2) for sender_input in range(4)]
+
+    configurations = [("classic", False), ("halfgates", False), ("halfgates", True)]
+    with serving(service):
+        results = run_sessions(configurations, run_session)
+
+    assert results == {args: [1, 2, 3, 4] for args in configurations}
+    truth = [b'1' if sender_input < receiver_input else b'0' for sender_input in range(4)] * 3
+    assert sorted(outputs) == sorted(truth)
+
+
+def test_session_service_workers():
+    """
+    Concurrent sessions sharing the service's worker processes on a circuit with wide levels, and a
+    failing evaluation reported to its sender instead of leaving it waiting
+    """
+    bits = 512
+    circuit = circuit_library.hamming_distance(bits)
+    receiver_input = (1 << bits) - 1
+    outputs = []
+    service = session.ReceiverService(receiver_input, port=0, workers=2, on_output=outputs.append)
+
+    def run_session(sender_input, stream):
+        with session.SenderSession(port=service.port, circuit=circuit, workers=2, timeout=120) as sender_session:
+            return sender_session.evaluate(sender_input, stream=stream, chunk_size=256)
+
+    configurations = [(0, False), (1 << 100, False), ((1 << bits) - 1, False), (12345, True)]
+    with serving(service):
+        results = run_sessions(configurations, run_session)
+        # The receiver's input does not fit in the comparator
+        with session.SenderSession(port=service.port) as sender_session, pytest.raises(session.SessionError):
+            sender_session.evaluate(0)
+
+    assert results == {args: 1 for args in configurations}
+    truth = [bin(sender_input ^ receiver_input).count("1") for sender_input, _ in configurations]
+    assert sorted(receiver.output_value(output) for output in outputs) == sorted(truth)
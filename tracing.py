@@ -0,0 +1,54 @@
+# tracing.py
+"""
+Logging helpers. Every module logs through logging.getLogger(__name__): protocol steps at INFO,
+per-gate details and labels at DEBUG. Per-gate messages are guarded by isEnabledFor, and large
+objects are wrapped in `pretty`, so a disabled level costs no formatting and no pprint traversal.
+
+`span` times a phase of the protocol and logs it to the SPANS logger, only when that logger is
+enabled for INFO.
+"""
+from contextlib import contextmanager
+import logging
+from pprint_custom import CustomPrettyPrinter
+import time
+
+SPANS = logging.getLogger("spans")
+
+
+class pretty:
+    """
+    Pretty-prints an object (shortening long byte strings) only when a log record is formatted:
+        logger.debug("Garbled circuit:\\n%s", pretty(garbled_circuit))
+    """
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return CustomPrettyPrinter(indent=1).pformat(self.obj)
+
+
+@contextmanager
+def span(name):
+    """
+    Logs the wall time spent in the `with` block as `name`
+    """
+    if not SPANS.isEnabledFor(logging.INFO):
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        SPANS.info("%s took %.3f ms", name, 1000 * (time.perf_counter() - start))
+
+
+def configure(level=logging.INFO, spans=False):
+    """
+    Sends the logs to stderr, e.g. for the command-line scripts
+
+    Args:
+        level: level of the messages to show; DEBUG shows every gate and label
+        spans: show the time of each protocol phase
+    """
+    logging.basicConfig(level=level, format="[%(name)s] %(message)s")
+    SPANS.setLevel(logging.INFO if spans else logging.WARNING)
@@ -0,0 +1,139 @@
+# transport.py
+"""
+Length-framed messages over TCP. Each message is a 4-byte big-endian length followed by the
+payload; an empty message is valid (it ends a streamed circuit).
+
+FramedConnection reads every message with recv_into straight into one buffer that is reused from
+message to message, so receiving never copies or concatenates; the view it returns stays valid until
+the next recv. It counts the bytes it sends and receives, and the time spent blocked waiting for
+messages, for metrics.Metrics. send_async and recv_async speak the same framing over asyncio streams.
+"""
+from contextlib import contextmanager
+import socket
+import struct
+import time
+
+HEADER = struct.Struct('!I')
+DEFAULT_BUFFER_SIZE = 1 << 16
+MAX_MESSAGE_SIZE = 1 << 30  # larger length prefixes are rejected instead of allocated
+# Payloads up to this size are sent in the same call as their header
+_SMALL_PAYLOAD = 1 << 12
+
+
+class FramedConnection:
+    def __init__(self, sock, buffer_size=DEFAULT_BUFFER_SIZE, nodelay=True, cork=False,
+                 max_message_size=MAX_MESSAGE_SIZE):
+        """
+        Args:
+            sock: connected TCP socket; closed with the FramedConnection
+            buffer_size (int): Initial size of the receive buffer, which grows to the largest message
+                               received. Defaults to DEFAULT_BUFFER_SIZE.
+            nodelay (bool): Set TCP_NODELAY, so small protocol messages leave at once instead of
+                            waiting for the peer's ACK. Defaults to True.
+            cork (bool): Hold partial segments with TCP_CORK while sending a message or inside
+                         `corked` (Linux only; ignored elsewhere). Defaults to False.
+            max_message_size (int): Largest message accepted. Defaults to MAX_MESSAGE_SIZE.
+        """
+        self.sock = sock
+        self.max_message_size = max_message_size
+        self._cork = cork and hasattr(socket, "TCP_CORK")
+        self._corked = False
+        self._buffer = bytearray(buffer_size)
+        self._header = bytearray(HEADER.size)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.wait_seconds = 0.0
+        if nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    @classmethod
+    def connect(cls, host, port, timeout=None, **options):
+        """
+        Opens a connection to `host`:`port`; `timeout` (seconds) applies to connecting and to every
+        later send and recv, and `options` are passed to __init__
+        """
+        return cls(socket.create_connection((host, port), timeout), **options)
+
+    def send(self, payload):
+        """
+        Sends one message
+        """
+        with self.corked():
+            if len(payload) <= _SMALL_PAYLOAD:
+                self.sock.sendall(HEADER.pack(len(payload)) + payload)
+            else:
+                self.sock.sendall(HEADER.pack(len(payload)))
+                self.sock.sendall(payload)
+        self.bytes_sent += HEADER.size + len(payload)
+
+    def recv(self):
+        """
+        Reads one message sent with send
+
+        Returns:
+            memoryview of the payload, valid until the next call to recv
+        """
+        start = time.perf_counter()
+        self._recv_exact(memoryview(self._header))
+        size = HEADER.unpack(self._header)[0]
+        if size > self.max_message_size:
+            raise ConnectionError(f"Message of {size} bytes exceeds the limit of {self.max_message_size}")
+        if size > len(self._buffer):
+            self._buffer = bytearray(max(size, 2 * len(self._buffer)))
+        view = memoryview(self._buffer)[:size]
+        self._recv_exact(view)
+        self.wait_seconds += time.perf_counter() - start
+        self.bytes_received += HEADER.size + size
+        return view
+
+    def _recv_exact(self, view):
+        received = 0
+        while received < len(view):
+            n = self.sock.recv_into(view[received:])
+            if n == 0:
+                raise ConnectionError(f"Connection closed after {received} of {len(view)} bytes")
+            received += n
+
+    @contextmanager
+    def corked(self):
+        """
+        Coalesces every message sent inside the block into full segments, if `cork` is enabled
+        """
+        if not self._cork or self._corked:
+            yield
+            return
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+        self._corked = True
+        try:
+            yield
+        finally:
+            self._corked = False
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+async def send_async(writer, payload):
+    """
+    Same framing as FramedConnection.send, for an asyncio StreamWriter
+    """
+    writer.write(HEADER.pack(len(payload)))
+    writer.write(payload)
+    await writer.drain()
+
+
+async def recv_async(reader, max_message_size=MAX_MESSAGE_SIZE):
+    """
+    Same framing as FramedConnection.recv, for an asyncio StreamReader
+    """
+    size = HEADER.unpack(await reader.readexactly(HEADER.size))[0]
+    if size > max_message_size:
+        raise ConnectionError(f"Message of {size} bytes exceeds the limit of {max_message_size}")
+    return await reader.readexactly(size)
@@ -0,0 +1,342 @@
+# wire_format.py
+"""
+Binary encoding of the messages exchanged by the sender and the receiver, used instead of pickle
+so that nothing received from the other party is ever executed.
+
+Every message starts with MAGIC, the format VERSION and a kind byte:
+    value   := header(KIND_VALUE) item
+    item    := tag payload   (None, bool, int as zigzag varint, bytes/str with a varint length,
+                              list/tuple/dict with a varint count)
+    circuit := header(KIND_CIRCUIT) scheme label_len:varint
+               n_inputs:varint input* n_gates:varint gate*
+    input   := wire:varint count:byte label{count}
+    gate    := wire:varint type:byte flags:byte in1:varint [in2:varint]
+               [n_positions:varint position:varint*] rows
+Labels are sent raw at a fixed width (classic Fernet keys and tokens are base64-decoded). Half-gates
+AND/OR gates carry exactly two label-sized rows and free gates none; classic gates carry a varint
+count of rows, each with a varint length. Output gates carry their positions in the circuit's list
+of outputs. Streamed gates flag the wires whose labels the evaluator can drop after them (see
+Circuit.garble_stream). Wire labels are bounded by the number of wires of the circuit (see
+load_circuit), since the evaluator sizes its arrays by them.
+"""
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from circuit import GATE_CODES, GATE_TYPES
+from halfgates import LABEL_LEN
+
+MAGIC = b'GC'
+VERSION = 2
+KIND_VALUE = 1
+KIND_CIRCUIT = 2
+
+SCHEME_CLASSIC = 0
+SCHEME_HALFGATES = 1
+UNTYPED = 0xFF  # type byte of classic gates, which do not record their type
+_CLASSIC_LABEL_LEN = 33  # raw 32-byte Fernet key and the permute byte
+
+_HAS_INPUT2 = 0b001
+_HAS_DECODE = 0b010
+_DECODE_ONE = 0b100
+_IS_OUTPUT = 0b1000
+_RELEASE_INPUT1 = 0b10000
+_RELEASE_INPUT2 = 0b100000
+_RELEASE_OUTPUT = 0b1000000
+
+_MAX_DEPTH = 32  # nesting limit for values, so a malicious message cannot exhaust the stack
+_TABLE_GATES = (GATE_CODES["AND"], GATE_CODES["OR"])
+
+
+def _write_varint(out: bytearray, n):
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+class _Reader:
+    """
+    Cursor over a received buffer; slices are taken from a memoryview, so nothing is copied until a
+    field is turned into its final object
+    """
+    def __init__(self, buffer):
+        self.view = memoryview(buffer)
+        self.pos = 0
+
+    def byte(self):
+        if self.pos >= len(self.view):
+            raise ValueError("Truncated message")
+        self.pos += 1
+        return self.view[self.pos - 1]
+
+    def varint(self):
+        n = shift = 0
+        while True:
+            b = self.byte()
+            n |= (b & 0x7F) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def take(self, size):
+        if self.pos + size > len(self.view):
+            raise ValueError("Truncated message")
+        self.pos += size
+        return self.view[self.pos - size:self.pos]
+
+    def header(self, kind):
+        if bytes(self.take(len(MAGIC))) != MAGIC:
+            raise ValueError("Not a garbled circuit message")
+        if (version := self.byte()) != VERSION:
+            raise ValueError(f"Unsupported message version: {version}")
+        if (found := self.byte()) != kind:
+            raise ValueError(f"Expected message kind {kind}, got {found}")
+
+    def done(self):
+        if self.pos != len(self.view):
+            raise ValueError(f"{len(self.view) - self.pos} unexpected bytes after message")
+
+
+def _header(kind):
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    out.append(kind)
+    return out
+
+
+def dumps(value):
+    """
+    Encodes a value made of None, bool, int, bytes, str, list, tuple and dict (e.g. OT messages).
+    """
+    out = _header(KIND_VALUE)
+    _write_item(out, value)
+    return bytes(out)
+
+
+def loads(buffer):
+    """
+    Decodes a message written by dumps.
+    """
+    reader = _Reader(buffer)
+    reader.header(KIND_VALUE)
+    value = _read_item(reader, 0)
+    reader.done()
+    return value
+
+
+def _write_item(out, value):
+    if value is None:
+        out += b'N'
+    elif value is True:
+        out += b'T'
+    elif value is False:
+        out += b'F'
+    elif isinstance(value, int):
+        out += b'I'
+        _write_varint(out, (value << 1) if value >= 0 else ((-value << 1) - 1))
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        out += b'B'
+        _write_varint(out, len(value))
+        out += value
+    elif isinstance(value, str):
+        encoded = value.encode()
+        out += b'S'
+        _write_varint(out, len(encoded))
+        out += encoded
+    elif isinstance(value, (list, tuple)):
+        out += b'L' if isinstance(value, list) else b'U'
+        _write_varint(out, len(value))
+        for item in value:
+            _write_item(out, item)
+    elif isinstance(value, dict):
+        out += b'D'
+        _write_varint(out, len(value))
+        for key, item in value.items():
+            _write_item(out, key)
+            _write_item(out, item)
+    else:
+        raise TypeError(f"Cannot encode value of type {type(value).__name__}")
+
+
+def _read_item(reader, depth):
+    if depth > _MAX_DEPTH:
+        raise ValueError("Message is nested too deeply")
+    tag = reader.byte()
+    if tag == ord('N'):
+        return None
+    elif tag == ord('T'):
+        return True
+    elif tag == ord('F'):
+        return False
+    elif tag == ord('I'):
+        n = reader.varint()
+        return (n >> 1) if not n & 1 else -((n + 1) >> 1)
+    elif tag == ord('B'):
+        return bytes(reader.take(reader.varint()))
+    elif tag == ord('S'):
+        return str(reader.take(reader.varint()), "utf-8")
+    elif tag in (ord('L'), ord('U')):
+        items = [_read_item(reader, depth + 1) for _ in range(reader.varint())]
+        return items if tag == ord('L') else tuple(items)
+    elif tag == ord('D'):
+        return {_read_item(reader, depth + 1): _read_item(reader, depth + 1) for _ in range(reader.varint())}
+    else:
+        raise ValueError(f"Unknown value tag: {tag}")
+
+
+def dump_circuit(garbled_circuit, scheme="classic"):
+    """
+    Encodes a garbled circuit, or a chunk of one (more info in Circuit.garble and
+    Circuit.garble_stream). Input wires may hold either both labels or the chosen one.
+
+    Args:
+        garbled_circuit: dictionary in the format of Circuit.garble
+        scheme: the garbling scheme the circuit was garbled with
+    """
+    if scheme not in ("classic", "halfgates"):
+        raise ValueError(f"Unsupported garbling scheme: {scheme}")
+    is_halfgates = scheme == "halfgates"
+    inputs = [(wire, entry) for wire, entry in garbled_circuit.items() if "inputs" not in entry]
+    gates = [(wire, entry) for wire, entry in garbled_circuit.items() if "inputs" in entry]
+    raw = bytes if is_halfgates else _raw_label
+
+    label_len = LABEL_LEN if is_halfgates else _CLASSIC_LABEL_LEN
+    if any(len(raw(label)) != label_len for _, entry in inputs for label in _input_labels(entry)):
+        raise ValueError(f"Input labels must be {label_len} bytes")
+
+    out = _header(KIND_CIRCUIT)
+    out.append(SCHEME_HALFGATES if is_halfgates else SCHEME_CLASSIC)
+    _write_varint(out, label_len)
+    _write_varint(out, len(inputs))
+    for wire, entry in inputs:
+        wire_labels = _input_labels(entry)
+        _write_varint(out, wire)
+        out.append(len(wire_labels))
+        for label in wire_labels:
+            out += raw(label)
+
+    _write_varint(out, len(gates))
+    for wire, entry in gates:
+        input1, input2 = entry["inputs"]
+        code = GATE_CODES[entry["type"]] if is_halfgates else UNTYPED
+        flags = _HAS_INPUT2 if input2 is not None else 0
+        if "decode" in entry:
+            flags |= _HAS_DECODE | (_DECODE_ONE if entry["decode"] else 0)
+        if "positions" in entry:
+            flags |= _IS_OUTPUT
+        if release := entry.get("release"):
+            flags |= _release_flags(wire, input1, input2, release)
+        _write_varint(out, wire)
+        out.append(code)
+        out.append(flags)
+        _write_varint(out, input1)
+        if input2 is not None:
+            _write_varint(out, input2)
+        if "positions" in entry:
+            _write_varint(out, len(entry["positions"]))
+            for position in entry["positions"]:
+                _write_varint(out, position)
+        if is_halfgates:
+            for row in entry["rows"]:
+                out += row
+        else:
+            _write_varint(out, len(entry["rows"]))
+            for row in entry["rows"]:
+                row = urlsafe_b64decode(row)
+                _write_varint(out, len(row))
+                out += row
+    return bytes(out)
+
+
+def load_circuit(buffer, extra_wires=0):
+    """
+    Decodes a message written by dump_circuit into the dictionary format of Circuit.garble.
+
+    Args:
+        buffer: the message
+        extra_wires: number of wires of the circuit left out of the message (the receiver's input
+                     wires, which it gets by OT). Every wire label must be below the number of input
+                     wires and gates in the message plus `extra_wires`, so a message cannot make the
+                     evaluator allocate more than it holds; circuits are expected to number their
+                     wires densely (see circuit_library.CircuitBuilder). None skips the check, for
+                     the pieces of a streamed circuit, which are evaluated without such arrays.
+    """
+    reader = _Reader(buffer)
+    reader.header(KIND_CIRCUIT)
+    scheme = reader.byte()
+    if scheme not in (SCHEME_CLASSIC, SCHEME_HALFGATES):
+        raise ValueError(f"Unknown garbling scheme code: {scheme}")
+    is_halfgates = scheme == SCHEME_HALFGATES
+    label_len = reader.varint()
+    if label_len != (LABEL_LEN if is_halfgates else _CLASSIC_LABEL_LEN):
+        raise ValueError(f"Invalid label length for the scheme: {label_len}")
+    label = bytes if is_halfgates else _fernet_label
+
+    garbled_circuit = dict()
+    top = -1  # highest wire label in the message
+    for _ in range(n_inputs := reader.varint()):
+        wire = reader.varint()
+        top = max(top, wire)
+        if (count := reader.byte()) not in (1, 2):
+            raise ValueError(f"Input wire {wire} must hold one or two labels, not {count}")
+        wire_labels = tuple(label(reader.take(label_len)) for _ in range(count))
+        garbled_circuit[wire] = {"value": wire_labels if len(wire_labels) > 1 else wire_labels[0]}
+
+    for _ in range(n_gates := reader.varint()):
+        wire = reader.varint()
+        code = reader.byte()
+        flags = reader.byte()
+        input1 = reader.varint()
+        input2 = reader.varint() if flags & _HAS_INPUT2 else None
+        top = max(top, wire, input1, -1 if input2 is None else input2)
+        positions = [reader.varint() for _ in range(reader.varint())] if flags & _IS_OUTPUT else None
+        if is_halfgates:
+            if code >= len(GATE_TYPES):
+                raise ValueError(f"Unknown gate type code: {code}")
+            rows = [bytes(reader.take(label_len)) for _ in range(2 if code in _TABLE_GATES else 0)]
+            entry = {"type": GATE_TYPES[code], "inputs": [input1, input2], "rows": rows}
+        else:
+            rows = [urlsafe_b64encode(reader.take(reader.varint())) for _ in range(reader.varint())]
+            entry = {"inputs": [input1, input2], "rows": rows}
+        if flags & _HAS_DECODE:
+            entry["decode"] = 1 if flags & _DECODE_ONE else 0
+        if positions is not None:
+            entry["positions"] = positions
+        if release := _released_wires(wire, input1, input2, flags):
+            entry["release"] = release
+        garbled_circuit[wire] = entry
+    reader.done()
+    if extra_wires is not None and top >= n_inputs + n_gates + extra_wires:
+        raise ValueError(f"Wire {top} is out of range for a circuit of {n_inputs + n_gates + extra_wires} wires")
+    return garbled_circuit
+
+
+def _release_flags(wire, input1, input2, release):
+    # Only the gate's own wires can be released, so each fits in one flag
+    if not set(release) <= {input1, input2, wire}:
+        raise ValueError(f"Gate {wire} releases wires it does not use")
+    flags = _RELEASE_INPUT1 if input1 in release else 0
+    if input2 is not None and input2 != input1 and input2 in release:
+        flags |= _RELEASE_INPUT2
+    return flags | (_RELEASE_OUTPUT if wire in release else 0)
+
+
+def _released_wires(wire, input1, input2, flags):
+    release = [input1] if flags & _RELEASE_INPUT1 else []
+    if flags & _RELEASE_INPUT2 and input2 is not None and input2 != input1:
+        release.append(input2)
+    if flags & _RELEASE_OUTPUT:
+        release.append(wire)
+    return release
+
+
+def _input_labels(entry):
+    value = entry["value"]
+    return tuple(value) if isinstance(value, (tuple, list)) else (value,)
+
+
+def _raw_label(label):
+    # Classic label: base64 Fernet key followed by the permute byte
+    return urlsafe_b64decode(label[:-1]) + label[-1:]
+
+
+def _fernet_label(raw):
+    return urlsafe_b64encode(raw[:-1]) + bytes(raw[-1:])